@@ -0,0 +1,221 @@
+"""
+Stage-level benchmarks for the cannibalization pipeline.
+
+Each stage the app runs is timed (best of N runs) and then run once more
+under tracemalloc for its peak memory. Stages run in pipeline order, each
+fed the previous stage's output. Inputs come from benchmarks/synthetic_gsc.py,
+so every run sees identical data for a given size and seed.
+
+Results are compared against benchmarks/baselines.json. A stage regresses
+when its time or peak memory is more than --threshold (default 25%) above
+baseline. Timing differences under 10 ms are ignored as noise. The script
+exits non-zero if any stage regressed.
+
+Usage:
+    python benchmarks/bench_stages.py                      # 10k + 100k vs baselines
+    python benchmarks/bench_stages.py --sizes 1m,10m       # bigger runs
+    python benchmarks/bench_stages.py --update-baselines   # re-record baselines
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from cannibalization_engine import (  # noqa: E402
+    apply_filters,
+    build_query_summary,
+    expand_upload,
+    find_cannibalization,
+    find_cannibalization_two_pass,
+    generate_high_severity_docx,
+    read_gsc_data,
+    severity_labels,
+    to_excel,
+)
+from synthetic_gsc import generate_gsc_frame, parse_rows  # noqa: E402
+
+BASELINES = Path(__file__).with_name('baselines.json')
+EXCEL_MAX_ROWS = 1_048_575
+TIME_NOISE_S = 0.010
+
+
+class SkipStage(Exception):
+    """A stage that can't run at this size / in this environment."""
+
+
+def _stage_read_csv(ctx):
+    ctx['raw_str'] = pd.read_csv(BytesIO(ctx['csv']), dtype=str)
+    return len(ctx['raw_str'])
+
+
+def _stage_read_gsc_data(ctx):
+    ctx['raw'] = read_gsc_data(ctx['raw_str'].copy())
+    return len(ctx['raw'])
+
+
+def _stage_apply_filters(ctx):
+    ctx['filtered'], _ = apply_filters(
+        ctx['raw'].copy(), pos_min=1, pos_max=20, min_impressions=0, min_clicks=0,
+        filter_anchors=True, filter_templates=True,
+    )
+    return len(ctx['filtered'])
+
+
+def _stage_find_cannibalization(ctx):
+    ctx['cannibs'] = find_cannibalization(ctx['filtered'], min_pages=2)
+    return len(ctx['cannibs'])
+
+
+def _stage_two_pass(ctx):
+    # Same filters as apply_filters + find_cannibalization above, straight from the CSV
+    cannibs, _ = find_cannibalization_two_pass(
+        expand_upload('bench.csv', ctx['csv']), min_pages=2, pos_min=1, pos_max=20,
+        min_impressions=0, min_clicks=0, filter_anchors=True, filter_templates=True,
+    )
+    if len(cannibs) != len(ctx['cannibs']):
+        raise AssertionError(f"two-pass found {len(cannibs):,} rows, "
+                             f"in-memory found {len(ctx['cannibs']):,}")
+    return len(cannibs)
+
+
+def _stage_build_query_summary(ctx):
+    qs = build_query_summary(ctx['cannibs'])
+    qs['_sev'] = severity_labels(qs['Best Average Position'], qs['Impressions'])
+    ctx['query_sum'] = qs
+    return len(qs)
+
+
+def _stage_to_excel(ctx):
+    if len(ctx['cannibs']) > EXCEL_MAX_ROWS:
+        raise SkipStage("detail sheet exceeds Excel's row limit")
+    to_excel({'Query Summary': ctx['query_sum'].drop(columns=['_sev']),
+              'Detail View': ctx['cannibs']})
+    return len(ctx['cannibs'])
+
+
+def _stage_docx(ctx):
+    try:
+        generate_high_severity_docx(ctx['cannibs'], ctx['query_sum'])
+    except (RuntimeError, FileNotFoundError):
+        raise SkipStage("node + docx package unavailable")
+    return int((ctx['query_sum']['_sev'] == 'High').sum())
+
+
+STAGES = [
+    ('read_csv',                    _stage_read_csv),
+    ('read_gsc_data',               _stage_read_gsc_data),
+    ('apply_filters',               _stage_apply_filters),
+    ('find_cannibalization',        _stage_find_cannibalization),
+    ('find_cannibalization_two_pass', _stage_two_pass),
+    ('build_query_summary',         _stage_build_query_summary),
+    ('to_excel',                    _stage_to_excel),
+    ('generate_high_severity_docx', _stage_docx),
+]
+
+
+def run_size(n_rows: int, seed: int, repeat: int) -> list[dict]:
+    """Benchmark every stage on a synthetic export of `n_rows` rows."""
+    ctx = {'csv': generate_gsc_frame(n_rows, seed).to_csv(index=False).encode()}
+    results = []
+    for name, fn in STAGES:
+        rec = {'stage': name, 'rows': n_rows}
+        try:
+            best = float('inf')
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                rows_out = fn(ctx)
+                best = min(best, time.perf_counter() - t0)
+            tracemalloc.start()
+            fn(ctx)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        except SkipStage as e:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            rec['skipped'] = str(e)
+        else:
+            rec.update(seconds=round(best, 4), peak_mb=round(peak / 2**20, 2), rows_out=rows_out)
+        results.append(rec)
+    return results
+
+
+def compare(results: list[dict], baselines: dict, threshold: float) -> list[str]:
+    """Regressions of `results` against stored baselines, as readable lines."""
+    problems = []
+    for rec in results:
+        base = baselines.get('results', {}).get(f"{rec['stage']}@{rec['rows']}")
+        if not base or 'skipped' in rec or 'skipped' in base:
+            continue
+        if (rec['seconds'] > base['seconds'] * (1 + threshold)
+                and rec['seconds'] - base['seconds'] > TIME_NOISE_S):
+            problems.append(f"{rec['stage']}@{rec['rows']:,}: {rec['seconds']:.3f}s "
+                            f"vs baseline {base['seconds']:.3f}s")
+        if rec['peak_mb'] > base['peak_mb'] * (1 + threshold):
+            problems.append(f"{rec['stage']}@{rec['rows']:,}: {rec['peak_mb']:.1f} MB peak "
+                            f"vs baseline {base['peak_mb']:.1f} MB")
+    return problems
+
+
+def _print_table(results: list[dict]) -> None:
+    print(f"{'stage':<30}{'rows':>12}{'seconds':>10}{'peak MB':>10}{'rows out':>12}")
+    for r in results:
+        if 'skipped' in r:
+            print(f"{r['stage']:<30}{r['rows']:>12,}  skipped: {r['skipped']}")
+        else:
+            print(f"{r['stage']:<30}{r['rows']:>12,}{r['seconds']:>10.3f}"
+                  f"{r['peak_mb']:>10.1f}{r['rows_out']:>12,}")
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="Time and memory-profile each pipeline stage.")
+    ap.add_argument('--sizes', default='10k,100k', help="comma-separated row counts (10k..10m)")
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--repeat', type=int, default=3, help="timing runs per stage (best is kept)")
+    ap.add_argument('--threshold', type=float, default=0.25, help="allowed regression, as a fraction")
+    ap.add_argument('--update-baselines', action='store_true', help=f"rewrite {BASELINES.name}")
+    ap.add_argument('--json', help="also write raw results to this file")
+    args = ap.parse_args()
+
+    results = []
+    for size in args.sizes.split(','):
+        results += run_size(parse_rows(size), args.seed, args.repeat)
+    _print_table(results)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+    if args.update_baselines:
+        baselines = json.loads(BASELINES.read_text()) if BASELINES.exists() else {}
+        baselines['env'] = {'python': platform.python_version(), 'pandas': pd.__version__,
+                            'machine': platform.machine()}
+        baselines.setdefault('results', {}).update(
+            {f"{r['stage']}@{r['rows']}": {k: r[k] for k in ('seconds', 'peak_mb', 'skipped') if k in r}
+             for r in results})
+        BASELINES.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+        print(f"\nbaselines written to {BASELINES}")
+        return 0
+
+    if not BASELINES.exists():
+        print("\nno baselines recorded yet — run with --update-baselines")
+        return 0
+    problems = compare(results, json.loads(BASELINES.read_text()), args.threshold)
+    if problems:
+        print(f"\n{len(problems)} regression(s) over {args.threshold:.0%}:")
+        for p in problems:
+            print("  " + p)
+        return 1
+    print(f"\nno regressions over {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
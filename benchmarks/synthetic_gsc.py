@@ -0,0 +1,192 @@
+"""
+Synthetic GSC export generator.
+
+Emits CSVs in the Edstellar GSC export layout
+(Query | Landing Page | Url Clicks | Impressions | URL CTR | Average Position)
+that look like the real thing as far as the pipeline is concerned:
+
+- query demand is Zipfian — a few head terms carry most impressions
+- most queries have one landing page, a minority have several (the
+  cannibalization candidates)
+- a share of landing pages are geo-templated slugs that the template rules
+  must catch, plus #anchor variants of ordinary pages
+- position, impressions and CTR are correlated the way GSC data is
+
+Output is fully determined by (rows, seed), so benchmark runs are reproducible.
+
+Usage:
+    python benchmarks/synthetic_gsc.py 1m -o gsc_1m.csv --seed 7
+"""
+
+import argparse
+import sys
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from cannibalization_engine import load_rules  # noqa: E402
+
+SITE = "https://www.edstellar.com/"
+
+TOPICS = [
+    'python', 'java', 'excel', 'power-bi', 'tableau', 'sql', 'aws', 'azure',
+    'devops', 'kubernetes', 'docker', 'agile', 'scrum', 'pmp', 'itil', 'six-sigma',
+    'leadership', 'communication', 'negotiation', 'time-management', 'sales',
+    'customer-service', 'data-science', 'machine-learning', 'ai', 'cyber-security',
+    'blockchain', 'salesforce', 'sap', 'oracle', 'linux', 'networking', 'ccna',
+    'react', 'angular', 'javascript', 'digital-marketing', 'seo', 'finance',
+    'accounting', 'hr', 'compliance', 'presentation-skills', 'team-building',
+    'conflict-management', 'emotional-intelligence', 'design-thinking',
+    'change-management', 'risk-management', 'business-analysis',
+]
+MODIFIERS = [
+    'training', 'course', 'certification', 'corporate training', 'online course',
+    'training for employees', 'workshop', 'classes', 'training companies',
+    'training providers', 'skills', 'for beginners', 'program', 'bootcamp',
+    'what is', 'best', 'top', 'cost', 'syllabus', 'near me',
+]
+COUNTRY_LIST = load_rules().sites['default'].lists['country']
+
+# Geo-template skeletons — each must be matched by a default-site template rule
+TEMPLATE_SKELETONS = [
+    'corporate-training-companies-{c}',
+    'skills-in-demand-in-{c}',
+    '{c}-work-culture',
+    'corporate-training-in-{c}',
+    'best-{t}-training-companies-{c}',
+    'top-{t}-training-companies-{c}',
+]
+ANCHORS = ['#faq', '#overview', '#curriculum', '#pricing', '#benefits']
+
+OUTPUT_COLS = ['Query', 'Landing Page', 'Url Clicks', 'Impressions',
+               'URL CTR', 'Average Position']
+
+
+def parse_rows(text: str) -> int:
+    """'10k' / '2.5m' / '10000' → row count."""
+    text = text.strip().lower().replace('_', '')
+    mult = {'k': 1_000, 'm': 1_000_000}.get(text[-1:], 1)
+    return int(float(text.rstrip('km')) * mult)
+
+
+def _slug_universe(rng: np.random.Generator, n_slugs: int) -> np.ndarray:
+    """Site slugs: course/landing pages, blog posts and geo-templated series."""
+    slugs = []
+    for t in TOPICS:
+        slugs += [f'{t}-training', f'{t}-course', f'{t}-certification-training',
+                  f'blog/what-is-{t}', f'blog/{t}-best-practices']
+    for skel in TEMPLATE_SKELETONS:
+        for c in COUNTRY_LIST:
+            slugs.append(skel.format(c=c, t=rng.choice(TOPICS)))
+    i = 0
+    while len(slugs) < n_slugs:
+        t = TOPICS[i % len(TOPICS)]
+        slugs.append(f'blog/{t}-guide-{i}' if i % 3 else f'{t}-training-program-{i}')
+        i += 1
+    return np.array(slugs, dtype=object)
+
+
+def _query_text(qids: np.ndarray) -> np.ndarray:
+    """Deterministic query string per query id (head ids get the short terms)."""
+    n_t, n_m = len(TOPICS), len(MODIFIERS)
+    topic = np.array([t.replace('-', ' ') for t in TOPICS], dtype=object)[qids % n_t]
+    mod   = np.array(MODIFIERS, dtype=object)[(qids // n_t) % n_m]
+    base  = np.where(np.isin(mod, ['what is', 'best', 'top']), mod + ' ' + topic, topic + ' ' + mod)
+    tier  = qids // (n_t * n_m)
+    geo   = np.array(COUNTRY_LIST, dtype=object)[(tier - 1) % len(COUNTRY_LIST)]
+    tail  = tier // (len(COUNTRY_LIST) + 1)
+    out   = np.where(tier == 0, base, base + ' ' + np.char.replace(geo.astype(str), '-', ' '))
+    return np.where(tail > 0, out + ' ' + tail.astype(str), out)
+
+
+def generate_gsc_export(n_rows: int, seed: int = 0,
+                        chunk_rows: int = 1_000_000) -> Iterator[pd.DataFrame]:
+    """Yield a synthetic GSC export of exactly `n_rows` rows in chunks.
+
+    Every chunk covers a disjoint range of queries, so (query, page) pairs are
+    unique across the whole export.
+    """
+    rng = np.random.default_rng(seed)
+    # Pages per query: ~70% single-page, a long tail up to 8 competing pages
+    pages_per_query = np.minimum(rng.geometric(0.7, size=n_rows), 8)
+    n_queries = int(np.searchsorted(np.cumsum(pages_per_query), n_rows) + 1)
+    pages_per_query = pages_per_query[:n_queries]
+    pages_per_query[-1] -= pages_per_query.sum() - n_rows
+
+    # Zipfian demand: query at rank r has ~ 2M / r^0.95 impressions of search volume
+    demand = np.maximum(2_000_000 / np.arange(1, n_queries + 1) ** 0.95, 20.0)
+    slugs  = _slug_universe(rng, max(500, n_rows // 40))
+
+    q_start = 0
+    while q_start < n_queries:
+        rows_cum = np.cumsum(pages_per_query[q_start:])
+        q_stop = q_start + int(np.searchsorted(rows_cum, chunk_rows) + 1)
+        q_stop = min(q_stop, n_queries)
+        k   = pages_per_query[q_start:q_stop]
+        qid = np.repeat(np.arange(q_start, q_stop), k)
+        n   = len(qid)
+
+        # Each query's pages are spaced by a per-query stride from a hashed
+        # "home" slug — always distinct, since 8 strides never wrap the universe
+        rank_in_q = np.arange(n) - np.repeat(np.cumsum(k) - k, k)
+        home   = (qid * 2654435761) % len(slugs)
+        stride = 1 + (qid * 40503) % (len(slugs) // 9)
+        page   = SITE + slugs[(home + rank_in_q * stride) % len(slugs)]
+        anchor = rng.random(n) < 0.03
+        page[anchor] = page[anchor] + np.array(ANCHORS, dtype=object)[rng.integers(0, len(ANCHORS), anchor.sum())]
+
+        # Head queries rank better; second/third pages for a query rank worse
+        position  = np.exp(rng.normal(np.log(3 + 3 * np.log10(qid + 10)), 0.6, n)) + rank_in_q * 4
+        position  = np.clip(position, 1, 100).round(1)
+
+        share       = rng.beta(2, 2 + rank_in_q)
+        visibility  = 1.0 / np.sqrt(position)
+        # GSC only reports rows that earned at least one impression
+        impressions = np.maximum((demand[qid] * share * visibility).round(), 1).astype(np.int64)
+
+        ctr    = np.clip(0.32 * position ** -1.1 * rng.lognormal(0, 0.3, n), 0, 0.9)
+        clicks = rng.binomial(impressions, ctr)
+        ctr_out = clicks / impressions * 100
+
+        df = pd.DataFrame({
+            'Query':            _query_text(qid),
+            'Landing Page':     page,
+            'Url Clicks':       clicks,
+            'Impressions':      impressions,
+            'URL CTR':          np.char.add(np.round(ctr_out, 2).astype(str), '%'),
+            'Average Position': position,
+        }, columns=OUTPUT_COLS)
+        yield df
+        q_start = q_stop
+
+
+def generate_gsc_frame(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """Whole synthetic export as one DataFrame (in-memory benchmarks)."""
+    return pd.concat(generate_gsc_export(n_rows, seed), ignore_index=True)
+
+
+def write_gsc_csv(path, n_rows: int, seed: int = 0) -> None:
+    """Stream a synthetic export to CSV without holding it all in memory."""
+    with open(path, 'w', encoding='utf-8', newline='') as fh:
+        for i, chunk in enumerate(generate_gsc_export(n_rows, seed)):
+            chunk.to_csv(fh, index=False, header=(i == 0))
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('rows', help="row count, e.g. 10k, 1m, 10m")
+    ap.add_argument('-o', '--out', default=None, help="output CSV (default gsc_<rows>.csv)")
+    ap.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args()
+    n = parse_rows(args.rows)
+    out = args.out or f'gsc_{args.rows}.csv'
+    write_gsc_csv(out, n, args.seed)
+    print(f"wrote {out} ({n:,} rows, seed {args.seed})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,543 @@
+"""
+Local HTTP API for the cannibalization engine.
+
+Serves the same pipeline as the Streamlit app to dashboards and scripts:
+
+    POST   /uploads                 GSC export as the request body (?name=gsc.csv; .csv,
+                                    .csv.gz, .xlsx or .zip) → {upload_id, rows, files}
+    GET    /uploads/<upload_id>     the parsed upload's row count and load log
+    POST   /analyze                 JSON {upload_id, prev_upload_id?, <sidebar filters>}
+                                    → 202 {job_id} while it runs, 200 {run_id} once done
+    GET    /jobs/<job_id>           status, current stage, progress and run_id when done
+    DELETE /jobs/<job_id>           cancel at the next stage boundary
+    GET    /runs/<run_id>           audit counts, KPIs, settings and rules version
+    GET    /runs/<run_id>/summary   query summary rows (?limit, ?offset, ?severity=High)
+    GET    /runs/<run_id>/pairs     query × slug rows (?limit, ?offset, ?query=...)
+    GET    /runs/<run_id>/export/<name>
+                                    summary.csv, detail.csv, report.xlsx, compare.csv
+                                    or redirects.csv (site-wide redirect map)
+    GET    /health
+
+POST /analyze and GET /jobs/<id> take ?wait=<seconds> to block until the job
+finishes or the wait runs out.
+
+Identical requests are coalesced: an upload of bytes already being parsed
+joins that parse (uploads live in the engine's DatasetCache), and an
+analysis of the same inputs with the same filters joins the running job —
+or, if it already finished, answers straight from the snapshot store the
+app saves runs to, so a run started in the UI is reusable here and vice
+versa. Results are also kept in a small in-memory LRU.
+
+Every request gets its own thread and jobs never run on request threads.
+Jobs over LARGE_JOB_ROWS rows queue on their own single-worker pool, so a
+huge export can't hold up the workers small analyses run on.
+
+There is no authentication — bind to localhost (the default) or put it
+behind something that adds it.
+
+Usage:
+    python cannibalization_api.py                    # 127.0.0.1:8765
+    python cannibalization_api.py --host 0.0.0.0 --port 9000 --workers 4
+"""
+
+import argparse
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+from cannibalization_engine import (
+    ANALYSIS_PARAMS,
+    DatasetCache,
+    JobCancelled,
+    PipelineJob,
+    RuleError,
+    SnapshotStore,
+    analyze_and_save,
+    build_redirect_map,
+    cannibalization_kpis,
+    export_tables,
+    fingerprint_uploads,
+    load_rules,
+    rename_for_display,
+    to_csv,
+    to_excel,
+)
+
+# Same defaults as the app's sidebar
+ANALYSIS_DEFAULTS = {
+    'pos_min': 1, 'pos_max': 20, 'min_impressions': 0, 'min_clicks': 0, 'min_pages': 2,
+    'filter_anchors': True, 'filter_templates': True, 'extra_templates': [],
+}
+
+# Jobs on inputs this big run on the single-worker "large" pool
+LARGE_JOB_ROWS     = 1_000_000
+LARGE_UPLOAD_BYTES = 100 * 2**20
+MAX_UPLOAD_BYTES   = 2 * 2**30
+MAX_PAGE_ROWS      = 10_000
+
+EXPORTS = {
+    'summary.csv': 'text/csv',
+    'detail.csv':  'text/csv',
+    'report.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'compare.csv': 'text/csv',
+    'redirects.csv': 'text/csv',
+}
+
+
+class ApiError(Exception):
+    """An error answered to the client as {"error": message} with `status`."""
+
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _LRU(OrderedDict):
+    """Dict that drops its least recently used entries beyond `maxsize`,
+    handing each dropped value to `on_evict`."""
+
+    def __init__(self, maxsize: int, on_evict: Callable[[object], None] | None = None):
+        super().__init__()
+        self.maxsize  = maxsize
+        self.on_evict = on_evict
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value) -> None:
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            _, dropped = self.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(dropped)
+
+
+def _parse_params(spec: dict) -> dict:
+    """Sidebar filter settings from a request body, defaults filled in and types checked."""
+    unknown = set(spec) - set(ANALYSIS_PARAMS) - {'upload_id', 'prev_upload_id'}
+    if unknown:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"unknown field(s): {', '.join(sorted(unknown))}")
+    params = {}
+    for name in ANALYSIS_PARAMS:
+        value, default = spec.get(name, ANALYSIS_DEFAULTS[name]), ANALYSIS_DEFAULTS[name]
+        if isinstance(default, bool):
+            ok = isinstance(value, bool)
+        elif isinstance(default, list):
+            ok = isinstance(value, list) and all(isinstance(v, str) for v in value)
+        else:
+            ok = isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+        if not ok:
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"invalid {name}: {value!r}")
+        params[name] = value
+    if params['pos_min'] > params['pos_max']:
+        raise ApiError(HTTPStatus.BAD_REQUEST, "pos_min is above pos_max")
+    if params['min_pages'] < 2:
+        raise ApiError(HTTPStatus.BAD_REQUEST, "min_pages must be at least 2")
+    return params
+
+
+class AnalysisService:
+    """Uploads, analysis jobs and results behind the HTTP handler.
+
+    Parsed uploads live in a DatasetCache, keyed by content fingerprint;
+    the service holds leases on the last `max_datasets` of them. Finished
+    results are kept by run ID (the last `max_results`), and older ones are
+    reloaded from the snapshot store on demand.
+    """
+
+    def __init__(self, store: SnapshotStore, cache: DatasetCache | None = None, workers: int = 4,
+                 max_datasets: int = 4, max_results: int = 16, max_jobs: int = 256):
+        self.store    = store
+        self.cache    = cache or DatasetCache()
+        self.pools    = {'small': ThreadPoolExecutor(workers, thread_name_prefix='kcf-api'),
+                         'large': ThreadPoolExecutor(1, thread_name_prefix='kcf-api-large')}
+        self.datasets = _LRU(max_datasets, on_evict=lambda ds: ds['lease'].release())
+        self.results  = _LRU(max_results)
+        self.jobs     = _LRU(max_jobs)
+        self._running: dict[tuple, PipelineJob] = {}
+        self._lock    = threading.Lock()
+
+    # ── Uploads ──
+
+    def upload(self, name: str, data: bytes) -> dict:
+        """Parse an upload (or join the parse of the same bytes) and return its summary."""
+        upload_id = fingerprint_uploads([(name, data)])
+        with self._lock:
+            ds = self.datasets.get(upload_id)
+        if ds is None:
+            pool = self.pools['large' if len(data) >= LARGE_UPLOAD_BYTES else 'small']
+            try:
+                lease = pool.submit(self.cache.load, [(name, data)]).result()
+            except Exception as e:
+                raise ApiError(HTTPStatus.UNPROCESSABLE_ENTITY, f"could not read {name}: {e}")
+            with self._lock:
+                # The same bytes uploaded concurrently: the first to get here keeps its lease
+                ds = self.datasets.get(upload_id)
+                if ds is None:
+                    ds = {'raw_df': lease.df, 'load_log': lease.load_log, 'lease': lease}
+                    self.datasets.put(upload_id, ds)
+                    lease = None
+            if lease is not None:
+                lease.release()
+        return self._upload_summary(upload_id, ds)
+
+    def upload_info(self, upload_id: str) -> dict:
+        with self._lock:
+            ds = self.datasets.get(upload_id)
+        if ds is None:
+            raise ApiError(HTTPStatus.NOT_FOUND, f"upload {upload_id} not found — upload it again")
+        return self._upload_summary(upload_id, ds)
+
+    @staticmethod
+    def _upload_summary(upload_id: str, ds: dict) -> dict:
+        log = ds['load_log']
+        return {'upload_id': upload_id, 'rows': len(ds['raw_df']),
+                'files': [{'name': n, 'rows': r} for n, r in log['files']],
+                'duplicates_removed': log['duplicates_removed']}
+
+    def _dataset(self, upload_id: str | None) -> dict | None:
+        if upload_id is None:
+            return None
+        with self._lock:
+            ds = self.datasets.get(upload_id)
+        if ds is None:
+            raise ApiError(HTTPStatus.NOT_FOUND, f"upload {upload_id} not found — upload it again")
+        return ds
+
+    # ── Analysis jobs ──
+
+    def submit(self, spec: dict) -> dict:
+        """Start (or join) the analysis `spec` describes; returns the job's status."""
+        if 'upload_id' not in spec:
+            raise ApiError(HTTPStatus.BAD_REQUEST, "upload_id is required")
+        params = _parse_params(spec)
+        ds, prev = self._dataset(spec['upload_id']), self._dataset(spec.get('prev_upload_id'))
+        fingerprint = ds['load_log']['fingerprint'] + (
+            ':' + prev['load_log']['fingerprint'] if prev is not None else '')
+        settings = dict(params, files=[n for n, _ in ds['load_log']['files']], rows=len(ds['raw_df']),
+                        previous_files=[n for n, _ in prev['load_log']['files']] if prev else [])
+
+        try:
+            rules_version = load_rules().version
+        except RuleError as e:
+            raise ApiError(HTTPStatus.SERVICE_UNAVAILABLE, f"template rules: {e}")
+        run_id = self.store.find(fingerprint, settings, rules_version)
+        if run_id is not None:
+            return {'job_id': None, 'status': 'done', 'run_id': run_id, 'cached': True}
+
+        key = (fingerprint, self.store.settings_key(settings, rules_version))
+        with self._lock:
+            job = self._running.get(key)
+            if job is None or job.done() or job.cancelled:
+                rows = len(ds['raw_df']) + (len(prev['raw_df']) if prev is not None else 0)
+                pool = self.pools['large' if rows >= LARGE_JOB_ROWS else 'small']
+                job = PipelineJob('api analysis', analyze_and_save, pool, key=key,
+                                  raw_df=ds['raw_df'], prev_raw_df=prev['raw_df'] if prev else None,
+                                  store=self.store, fingerprint=fingerprint, settings=settings,
+                                  cube=False, **params)  # nothing here slices by dimension
+                self._running[key] = job
+                self.jobs.put(job.trace.run_id, job)
+        return self.status(job.trace.run_id)
+
+    def _job(self, job_id: str) -> PipelineJob:
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            raise ApiError(HTTPStatus.NOT_FOUND, f"job {job_id} not found")
+        return job
+
+    def wait(self, job_id: str, timeout: float) -> None:
+        try:
+            self._job(job_id).future.result(timeout=timeout)
+        except Exception:  # timed out, or finished badly — status() reports which
+            pass
+
+    def status(self, job_id: str) -> dict:
+        job = self._job(job_id)
+        out = {'job_id': job_id, 'status': 'queued', 'stage': job.current,
+               'stages_done': [r['stage'] for r in job.finished]}
+        if job.progress:
+            out['progress'] = {'done': job.progress[0], 'total': job.progress[1]}
+        if not job.done():
+            if job.cancelled:
+                out['status'] = 'cancelling'
+            elif job.current or job.finished:
+                out['status'] = 'running'
+            return out
+
+        with self._lock:
+            if self._running.get(job.key) is job:
+                del self._running[job.key]
+        try:
+            result = job.result()
+        except JobCancelled:
+            out['status'] = 'cancelled'
+        except Exception as e:
+            out.update(status='failed', error=str(e))
+        else:
+            out.update(status='done', run_id=result['run_id'])
+            if result['run_id'] is None:
+                out['error'] = f"result not saved: {result.get('snapshot_error')}"
+            else:
+                with self._lock:
+                    self.results.put(result['run_id'], result)
+        return out
+
+    def cancel(self, job_id: str) -> dict:
+        self._job(job_id).cancel()
+        return self.status(job_id)
+
+    # ── Results ──
+
+    def result(self, run_id: str) -> dict:
+        with self._lock:
+            result = self.results.get(run_id)
+        if result is None:
+            result = self.store.load(run_id)
+            if result is None:
+                raise ApiError(HTTPStatus.NOT_FOUND, f"run {run_id} not found — it may have expired")
+            with self._lock:
+                self.results.put(run_id, result)
+        return result
+
+    def run_info(self, run_id: str) -> dict:
+        r = self.result(run_id)
+        kpis = (cannibalization_kpis(r['cannibs'], r['query_sum'])
+                if not r['query_sum'].empty else None)
+        snap = r.get('snapshot') or {}
+        return {'run_id': run_id, 'rules_version': r['rules_version'], 'audit': r['audit'],
+                'kpis': kpis, 'queries': len(r['query_sum']), 'pairs': len(r['cannibs']),
+                'has_compare': r['compare'] is not None,
+                'settings': r.get('settings', snap.get('settings')), 'created': snap.get('created')}
+
+    def export(self, run_id: str, name: str) -> bytes:
+        r = self.result(run_id)
+        cache = r.setdefault('api_exports', {})
+        if name not in cache:
+            tables = export_tables(r['cannibs'], r['query_sum'])
+            if name == 'summary.csv':
+                cache[name] = to_csv(tables['Query Summary'])
+            elif name == 'detail.csv':
+                cache[name] = to_csv(tables['Detail View'])
+            elif name == 'report.xlsx':
+                cache[name] = to_excel(tables)
+            elif name == 'compare.csv' and r['compare'] is not None:
+                cache[name] = to_csv(r['compare']['query_diff'])
+            elif name == 'redirects.csv':
+                cache[name] = to_csv(build_redirect_map(r['cannibs'])[0])
+            else:
+                raise ApiError(HTTPStatus.NOT_FOUND, f"no export {name} for run {run_id}")
+        return cache[name]
+
+    def shutdown(self) -> None:
+        for pool in self.pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _page(df: pd.DataFrame, query: dict) -> dict:
+    """One page of `df` as JSON-ready records, per ?limit and ?offset."""
+    try:
+        limit  = min(int(query.get('limit', 100)), MAX_PAGE_ROWS)
+        offset = max(int(query.get('offset', 0)), 0)
+    except ValueError:
+        raise ApiError(HTTPStatus.BAD_REQUEST, "limit and offset must be integers")
+    rows = df.iloc[offset:offset + limit]
+    return {'total': len(df), 'offset': offset, 'limit': limit,
+            'rows': json.loads(rows.to_json(orient='records', force_ascii=False))}
+
+
+def _json_default(o):
+    # numpy scalars in audit counts and KPIs
+    if hasattr(o, 'item'):
+        return o.item()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """Routes requests to the server's AnalysisService."""
+
+    server_version = 'kcf-api/1'
+    ROUTES = [
+        ('GET',    r'/health',                          'health'),
+        ('POST',   r'/uploads',                         'post_upload'),
+        ('GET',    r'/uploads/(?P<upload_id>[0-9a-f]{64})', 'get_upload'),
+        ('POST',   r'/analyze',                         'post_analyze'),
+        ('GET',    r'/jobs/(?P<job_id>[0-9a-f]{12})',   'get_job'),
+        ('DELETE', r'/jobs/(?P<job_id>[0-9a-f]{12})',   'delete_job'),
+        ('GET',    r'/runs/(?P<run_id>[0-9a-f]{12})',   'get_run'),
+        ('GET',    r'/runs/(?P<run_id>[0-9a-f]{12})/summary', 'get_summary'),
+        ('GET',    r'/runs/(?P<run_id>[0-9a-f]{12})/pairs',   'get_pairs'),
+        ('GET',    r'/runs/(?P<run_id>[0-9a-f]{12})/export/(?P<name>[a-z]+\.[a-z]+)', 'get_export'),
+    ]
+
+    @property
+    def service(self) -> AnalysisService:
+        return self.server.service
+
+    # ── Plumbing ──
+
+    def _dispatch(self, method: str) -> None:
+        url = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            for verb, pattern, handler in self.ROUTES:
+                m = re.fullmatch(pattern, url.path.rstrip('/') or '/')
+                if m and verb == method:
+                    return getattr(self, handler)(query, **m.groupdict())
+            raise ApiError(HTTPStatus.NOT_FOUND, f"no route for {method} {url.path}")
+        except ApiError as e:
+            self._send_json({'error': str(e)}, e.status)
+        except Exception as e:
+            self.log_error("%s %s failed: %r", method, self.path, e)
+            self._send_json({'error': f"internal error: {e}"}, HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_UPLOAD_BYTES:
+            raise ApiError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                           f"body over {MAX_UPLOAD_BYTES // 2**20:,} MB")
+        return self.rfile.read(length)
+
+    def _json_body(self) -> dict:
+        try:
+            spec = json.loads(self._body() or b'{}')
+        except json.JSONDecodeError as e:
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"body is not JSON: {e}")
+        if not isinstance(spec, dict):
+            raise ApiError(HTTPStatus.BAD_REQUEST, "body must be a JSON object")
+        return spec
+
+    def _send(self, body: bytes, content_type: str, status=HTTPStatus.OK, headers=None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, payload, status=HTTPStatus.OK) -> None:
+        body = json.dumps(payload, default=_json_default, ensure_ascii=False).encode()
+        self._send(body, 'application/json; charset=utf-8', status)
+
+    def _wait(self, query: dict, job_id: str) -> None:
+        if 'wait' in query:
+            try:
+                self.service.wait(job_id, timeout=min(float(query['wait']), 300))
+            except ValueError:
+                raise ApiError(HTTPStatus.BAD_REQUEST, "wait must be a number of seconds")
+
+    def _job_response(self, status: dict) -> None:
+        done = status['status'] in ('done', 'failed', 'cancelled')
+        self._send_json(status, HTTPStatus.OK if done else HTTPStatus.ACCEPTED)
+
+    # ── Endpoints ──
+
+    def health(self, query):
+        try:
+            rules = load_rules().version
+        except RuleError as e:
+            rules = f"error: {e}"
+        self._send_json({'status': 'ok', 'rules_version': rules})
+
+    def post_upload(self, query):
+        name = query.get('name') or self.headers.get('X-Filename') or 'upload.csv'
+        data = self._body()
+        if not data:
+            raise ApiError(HTTPStatus.BAD_REQUEST, "empty body — send the export file as the request body")
+        self._send_json(self.service.upload(os.path.basename(name), data), HTTPStatus.CREATED)
+
+    def get_upload(self, query, upload_id):
+        self._send_json(self.service.upload_info(upload_id))
+
+    def post_analyze(self, query):
+        status = self.service.submit(self._json_body())
+        if status['job_id'] is not None:
+            self._wait(query, status['job_id'])
+            status = self.service.status(status['job_id'])
+        self._job_response(status)
+
+    def get_job(self, query, job_id):
+        self._wait(query, job_id)
+        self._job_response(self.service.status(job_id))
+
+    def delete_job(self, query, job_id):
+        self._job_response(self.service.cancel(job_id))
+
+    def get_run(self, query, run_id):
+        self._send_json(self.service.run_info(run_id))
+
+    def get_summary(self, query, run_id):
+        qs = self.service.result(run_id)['query_sum']
+        if not qs.empty:
+            qs = qs.rename(columns={'_sev': 'Severity'})
+            if 'severity' in query:
+                qs = qs[qs['Severity'] == query['severity']]
+        self._send_json(_page(qs, query))
+
+    def get_pairs(self, query, run_id):
+        pairs = rename_for_display(self.service.result(run_id)['cannibs'])
+        if 'query' in query and not pairs.empty:
+            pairs = pairs[pairs['Query'] == query['query']]
+        self._send_json(_page(pairs, query))
+
+    def get_export(self, query, run_id, name):
+        if name not in EXPORTS:
+            raise ApiError(HTTPStatus.NOT_FOUND, f"unknown export {name}; one of {', '.join(EXPORTS)}")
+        data = self.service.export(run_id, name)
+        self._send(data, EXPORTS[name], headers={
+            'Content-Disposition': f'attachment; filename="cannibalization_{run_id}_{name}"'})
+
+
+def make_server(host: str = '127.0.0.1', port: int = 8765,
+                service: AnalysisService | None = None) -> ThreadingHTTPServer:
+    """An API server bound to (host, port); call serve_forever() on it."""
+    server = ThreadingHTTPServer((host, port), ApiHandler)
+    server.daemon_threads = True
+    server.service = service or AnalysisService(SnapshotStore())
+    return server
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8765)
+    ap.add_argument('--workers', type=int, default=max(2, min(4, os.cpu_count() or 1)),
+                    help="analysis workers for normal-sized jobs (large jobs get one more)")
+    args = ap.parse_args()
+
+    server = make_server(args.host, args.port, AnalysisService(SnapshotStore(), workers=args.workers))
+    print(f"cannibalization API on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.shutdown()
+
+
+if __name__ == '__main__':
+    main()
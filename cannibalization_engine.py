@@ -0,0 +1,3237 @@
+"""
+Keyword Cannibalization Finder — analysis engine.
+
+Everything the Streamlit app does that isn't UI: reading GSC exports,
+template filtering, cannibalization aggregation, the query summary and the
+CSV / Excel / Word exporters. Kept free of Streamlit so benchmarks and other
+tools can import it directly.
+"""
+
+import re
+import os
+import gzip
+import socket
+import asyncio
+import ipaddress
+import http.client
+import json
+import hashlib
+import sqlite3
+import time
+import uuid
+import zipfile
+import threading
+import tracemalloc
+import weakref
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from io import BytesIO
+from pathlib import Path
+from typing import IO, Callable, Iterator
+from urllib.parse import urljoin, urlsplit
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# TEMPLATE RULES — templatized page series, loaded from template_rules.json
+# ══════════════════════════════════════════════════════════════════════════════
+
+RULES_PATH = Path(os.environ.get(
+    'KCF_RULES', Path(__file__).resolve().with_name('template_rules.json')))
+
+
+class RuleError(ValueError):
+    """The template rules file is missing, malformed or has a bad pattern or segment."""
+
+
+class SiteRules:
+    """One site's template patterns, compiled into a single matcher.
+
+    Every pattern becomes a named group of one alternation, so a slug is
+    tested in a single regex pass and ``m.lastgroup`` says which rule hit.
+    Slugs matching an exception pattern are never treated as templates.
+    """
+
+    def __init__(self, name: str, templates: list[tuple[str, str]],
+                 exceptions: list[str], lists: dict[str, list[str]]):
+        self.name   = name
+        self.labels = [label for _, label in templates]
+        self.lists  = lists
+        self._matcher = re.compile(
+            '|'.join(f'(?P<r{i}>{rx})' for i, (rx, _) in enumerate(templates)) or r'(?!)', re.I)
+        self._exceptions = re.compile('|'.join(f'(?:{rx})' for rx in exceptions) or r'(?!)', re.I)
+
+    def match(self, slug: str) -> str | None:
+        """Label of the first template rule `slug` matches, or None."""
+        m = self._matcher.search(slug)
+        if m is None or self._exceptions.search(slug):
+            return None
+        return self.labels[int(m.lastgroup[1:])]
+
+    def is_template(self, slug: str) -> bool:
+        return self.match(slug) is not None
+
+
+# Queries and segment terms are compared word by word, split the same way
+_WORD_SPLIT = re.compile(r'[\W_]+')
+
+
+def _words(text: str) -> list[str]:
+    return [w for w in _WORD_SPLIT.split(text.lower()) if w]
+
+
+class QuerySegmenter:
+    """Segment dictionary compiled into one Aho-Corasick automaton over words.
+
+    Each segmentation (Brand, Intent, ...) maps segment labels to terms.
+    All terms of all segmentations go into a single trie keyed by whole
+    words, with failure links, so a query is classified in one left-to-
+    right pass over its words whatever the number of terms — and terms
+    only ever match whole words ('ai' doesn't hit 'training'). Per
+    segmentation the longest matching term wins; on equal length, the
+    segment listed first. Queries matching nothing get the default.
+    """
+
+    def __init__(self, dims: dict[str, tuple[str, dict[str, list[str]]]]):
+        # dims: segmentation label → (default label, {segment label: [terms]})
+        self.labels     = list(dims)
+        self.categories = [[*segs, default] for default, segs in dims.values()]
+        self.n_terms    = 0
+        goto: list[dict[str, int]] = [{}]
+        outputs: list[list[tuple[int, tuple[int, int]]]] = [[]]
+        for d, (_, segs) in enumerate(dims.values()):
+            for s, terms in enumerate(segs.values()):
+                for term in terms:
+                    state = 0
+                    for w in _words(term):
+                        if w not in goto[state]:
+                            goto[state][w] = len(goto)
+                            goto.append({})
+                            outputs.append([])
+                        state = goto[state][w]
+                    # Lower ranks win: longer terms first, then listing order
+                    outputs[state].append((d, (-len(_words(term)), s)))
+                    self.n_terms += 1
+
+        # Failure links, breadth first; each state inherits its fallback's outputs
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())   # one word deep: fall back to the root
+        for state in queue:
+            for w, nxt in goto[state].items():
+                f = fail[state]
+                while f and w not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(w, 0)
+                outputs[nxt] = outputs[nxt] + outputs[fail[nxt]]
+                queue.append(nxt)
+        self._goto, self._fail = goto, fail
+        # Per state, the best (rank, segment) per segmentation it reports
+        self._out = []
+        for out in outputs:
+            best: dict[int, tuple[int, int]] = {}
+            for d, rank in out:
+                if d not in best or rank < best[d]:
+                    best[d] = rank
+            self._out.append(tuple(best.items()))
+
+    def __bool__(self) -> bool:
+        return bool(self.labels)
+
+    def classify(self, text: str) -> list[int]:
+        """Segment index per segmentation for one query (len(segments) = the default)."""
+        goto, fail, out = self._goto, self._fail, self._out
+        best = [None] * len(self.labels)
+        state = 0
+        # Empty pieces (leading/trailing punctuation) just fall back to the root
+        for w in _WORD_SPLIT.split(text.lower()):
+            while state and w not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(w, 0)
+            for d, rank in out[state]:
+                if best[d] is None or rank < best[d]:
+                    best[d] = rank
+        return [len(cats) - 1 if b is None else b[1] for b, cats in zip(best, self.categories)]
+
+    def segment(self, queries: pd.Series) -> pd.DataFrame:
+        """One categorical column per segmentation, aligned to `queries`.
+
+        Each distinct query is classified once.
+        """
+        codes, uniques = pd.factorize(queries)
+        seg = (np.array([self.classify(q) for q in uniques.tolist()], dtype=np.int16)
+                 .reshape(-1, len(self.labels)))
+        return pd.DataFrame({
+            label: pd.Categorical.from_codes(seg[codes, d], categories=cats)
+            for d, (label, cats) in enumerate(zip(self.labels, self.categories))
+        }, index=queries.index)
+
+
+class RuleRegistry:
+    """Compiled rules for every site in a rules file, plus the query segments.
+
+    ``version`` combines the file's declared version with a hash of its
+    contents, so anything cached against one set of rules can tell when
+    they change.
+    """
+
+    def __init__(self, sites: dict[str, SiteRules], version: str, path: Path | None = None,
+                 segments: QuerySegmenter | None = None):
+        self.sites    = sites
+        self.version  = version
+        self.path     = path
+        self.segments = segments or QuerySegmenter({})
+
+    def for_host(self, host: str | None) -> SiteRules:
+        """Rules for `host` (www. optional, parent domains tried), else the default site."""
+        host = (host or '').lower().removeprefix('www.')
+        while host:
+            for name in (host, 'www.' + host):
+                if name in self.sites:
+                    return self.sites[name]
+            host = host.partition('.')[2] if '.' in host.partition('.')[2] else ''
+        return self.sites['default']
+
+    def template_mask(self, pages: pd.Series) -> np.ndarray:
+        """True for every page URL whose slug matches its site's template rules.
+
+        Each distinct page is matched once, against the rules of its own host.
+        """
+        codes, uniques = pd.factorize(pages.astype(str))
+        hits = np.zeros(len(uniques), dtype=bool)
+        hosts = pd.Series(uniques).str.extract(r'^https?://([^/]+)', expand=False)
+        for host, idx in pd.Series(range(len(uniques))).groupby(hosts.fillna('')).groups.items():
+            site = self.for_host(host)
+            hits[idx] = [site.is_template(get_base_slug(u)) for u in uniques[idx]]
+        return hits[codes] if len(codes) else np.zeros(0, dtype=bool)
+
+
+_PLACEHOLDER = re.compile(r'\{([a-z_][a-z0-9_]*)\}')
+
+
+def compile_rules(config: dict, source: str = 'rules') -> RuleRegistry:
+    """Validate a parsed rules file and compile every site's matcher.
+
+    Layout: ``{"version", "lists": {name: [values]}, "sites": {site: {"templates":
+    [{"regex", "label"}], "exceptions": [regex], "lists": {...}}}}``. A
+    ``{name}`` in a regex expands to an alternation of that list; a site's
+    own lists override the shared ones. A "default" site is required.
+
+    Optional ``"segments": {segmentation: {"default": label, "segments":
+    {label: [terms]}}}`` classifies queries (see QuerySegmenter); a
+    ``{name}`` in a term stands for each value of a shared list.
+    """
+    def fail(msg):
+        raise RuleError(f"{source}: {msg}")
+
+    def check_lists(lists, where):
+        if not isinstance(lists, dict):
+            fail(f"{where}: 'lists' must be an object of name → [values]")
+        for name, values in lists.items():
+            if (not isinstance(values, list) or not values
+                    or not all(isinstance(v, str) and v for v in values)):
+                fail(f"{where}: list '{name}' must be a non-empty list of strings")
+        return lists
+
+    if not isinstance(config, dict) or not isinstance(config.get('sites'), dict):
+        fail("expected an object with a 'sites' object")
+    if 'default' not in config['sites']:
+        fail("a 'default' site is required")
+    shared = check_lists(config.get('lists', {}), 'lists')
+
+    sites = {}
+    for name, site in config['sites'].items():
+        if not isinstance(site, dict):
+            fail(f"site '{name}' must be an object")
+        lists = {**shared, **check_lists(site.get('lists', {}), f"site '{name}'")}
+
+        def expand(rx, where):
+            if not isinstance(rx, str) or not rx:
+                fail(f"{where}: regex must be a non-empty string")
+            missing = set(_PLACEHOLDER.findall(rx)) - lists.keys()
+            if missing:
+                fail(f"{where}: unknown list {', '.join(sorted(missing))}")
+            rx = _PLACEHOLDER.sub(lambda m: '(?:' + '|'.join(map(re.escape, lists[m[1]])) + ')', rx)
+            try:
+                re.compile(rx)
+            except re.error as e:
+                fail(f"{where}: {e}")
+            return rx
+
+        templates = []
+        for i, rule in enumerate(site.get('templates', [])):
+            where = f"site '{name}' template {i + 1}"
+            if not isinstance(rule, dict) or not isinstance(rule.get('label'), str):
+                fail(f"{where}: needs 'regex' and 'label'")
+            templates.append((expand(rule.get('regex'), where), rule['label']))
+        exceptions = [expand(rx, f"site '{name}' exception {i + 1}")
+                      for i, rx in enumerate(site.get('exceptions', []))]
+        sites[name] = SiteRules(name, templates, exceptions, lists)
+
+    segments = config.get('segments', {})
+    if not isinstance(segments, dict):
+        fail("'segments' must be an object of segmentation → {default, segments}")
+    dims = {}
+    for label, dim in segments.items():
+        where = f"segmentation '{label}'"
+        if label in DISPLAY_COLS.values() or label.lower() in DISPLAY_COLS:
+            fail(f"{where}: clashes with a report column")
+        if (not isinstance(dim, dict) or not isinstance(dim.get('default'), str)
+                or not isinstance(dim.get('segments'), dict) or not dim['segments']):
+            fail(f"{where}: needs a 'default' label and a non-empty 'segments' object")
+        segs = {}
+        for seg, terms in dim['segments'].items():
+            if (seg == dim['default'] or not isinstance(terms, list) or not terms
+                    or not all(isinstance(t, str) and _words(t) for t in terms)):
+                fail(f"{where}: segment '{seg}' needs a non-empty list of terms "
+                     f"and a label other than the default")
+            expanded = []
+            for term in terms:
+                names = _PLACEHOLDER.findall(term)
+                if set(names) - shared.keys():
+                    fail(f"{where}: unknown list {', '.join(sorted(set(names) - shared.keys()))}")
+                if len(names) > 1:
+                    fail(f"{where}: term '{term}' may use one list at most")
+                expanded += ([term.replace(f'{{{names[0]}}}', v) for v in shared[names[0]]]
+                             if names else [term])
+            segs[seg] = expanded
+        dims[label] = (dim['default'], segs)
+
+    digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:8]
+    return RuleRegistry(sites, version=f"{config.get('version', 0)}-{digest}",
+                        segments=QuerySegmenter(dims))
+
+
+_rules_lock  = threading.Lock()
+_rules_cache: dict = {'stamp': None, 'registry': None, 'error': None}
+
+
+def load_rules(path: Path | None = None) -> RuleRegistry:
+    """The compiled rule registry, reloaded whenever the rules file changes.
+
+    Compiled once per process and shared by every session. The file is
+    stat'ed on each call and recompiled only when its mtime or size moves.
+    If an edited file fails validation the last good rules stay in force and
+    rules_error() reports why; with no good rules yet, RuleError is raised.
+    """
+    path = Path(path or RULES_PATH)
+    with _rules_lock:
+        try:
+            info  = path.stat()
+            stamp = (str(path), info.st_mtime_ns, info.st_size)
+        except OSError as e:
+            stamp, err = None, RuleError(f"{path}: {e.strerror}")
+        else:
+            if stamp == _rules_cache['stamp']:
+                return _rules_cache['registry']
+            try:
+                registry = compile_rules(json.loads(path.read_text(encoding='utf-8')), str(path))
+                registry.path = path
+            except (OSError, ValueError) as e:
+                err = e if isinstance(e, RuleError) else RuleError(f"{path}: {e}")
+            else:
+                _rules_cache.update(stamp=stamp, registry=registry, error=None)
+                return registry
+        _rules_cache['error'] = err
+        if _rules_cache['registry'] is None:
+            raise err
+        return _rules_cache['registry']
+
+
+def rules_error() -> RuleError | None:
+    """Why the last reload of the rules file failed, if it did."""
+    return _rules_cache['error']
+
+
+def is_template(slug: str) -> bool:
+    """Whether a bare slug matches the default site's template rules.
+
+    Loads (or stat-checks) the rules on every call; for many slugs, take
+    load_rules().sites['default'] once or use RuleRegistry.template_mask.
+    """
+    return load_rules().sites['default'].is_template(slug)
+
+
+def get_base_slug(url: str) -> str:
+    """Extract the slug portion from a full URL or bare slug."""
+    # Remove protocol + domain if present
+    url = re.sub(r'^https?://[^/]+/', '', str(url))
+    # Remove trailing slashes
+    url = url.rstrip('/')
+    # Take only the last path segment
+    return url.split('/')[-1] if '/' in url else url
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# INSTRUMENTATION
+# ══════════════════════════════════════════════════════════════════════════════
+
+# Structured per-stage trace records are appended here (one JSON object per line)
+PERF_LOG_PATH = Path(os.environ.get(
+    'KCF_PERF_LOG', Path(__file__).resolve().parent / 'logs' / 'perf_trace.jsonl'))
+
+
+def _proc_status_kb(field: str) -> int | None:
+    with open('/proc/self/status') as fh:
+        for line in fh:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return None
+
+
+def _reset_peak_rss() -> int | None:
+    """Reset the kernel's peak-RSS mark and return current RSS in KB.
+
+    Linux only (returns None elsewhere). Unlike tracemalloc this adds no
+    per-allocation overhead, so stage timings stay honest.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+        return _proc_status_kb('VmRSS:')
+    except OSError:
+        return None
+
+
+# Peak RSS and tracemalloc are both process-wide, so a stage's peak only means
+# something if no other stage — in any thread or trace — started while it ran.
+# Stages nested inside another on the same thread are part of it, not rivals:
+# only a thread's outermost stage is counted here, and only it touches the peak.
+_stages_lock    = threading.Lock()
+_stages_running = 0
+_stages_started = 0
+_stage_depth    = threading.local()
+
+
+class PipelineTrace:
+    """Wall time, CPU time, peak memory and row counts for each pipeline stage.
+
+    Peak memory is the rise in peak RSS over the stage, falling back to
+    tracemalloc where /proc isn't available. It is None for stages that
+    overlapped another stage anywhere in the process, whose peaks can't be
+    told apart. Stages opened inside another on the same thread record their
+    nesting ``depth`` (0 for outermost) and no peak of their own — theirs is
+    part of the enclosing stage's, as is their wall time.
+
+    Use as ``with trace.stage('aggregate', rows_in=len(df)) as rec: ...`` and set
+    ``rec['rows_out']`` inside the block. Every finished record is kept in
+    ``records`` and, when ``log_path`` is set, appended to it as a JSON line
+    tagged with the trace's run ID.
+
+    ``on_event(kind, rec)`` is called with kind 'start' / 'end' around each
+    stage and 'progress' from long loops. Background jobs use it to report
+    progress, and raise from it to cancel.
+    """
+
+    def __init__(self, label: str, log_path: Path | None = PERF_LOG_PATH,
+                 memory: bool = True, on_event: Callable[[str, dict], None] | None = None,
+                 run_id: str | None = None):
+        self.run_id   = run_id or uuid.uuid4().hex[:12]
+        self.label    = label
+        self.log_path = log_path
+        self.memory   = memory
+        self.on_event = on_event
+        self.records: list[dict] = []
+        self._lock    = threading.Lock()
+
+    def child(self, label: str) -> 'PipelineTrace':
+        """A separate record list under the same run ID, log and listener."""
+        return PipelineTrace(label, log_path=self.log_path, memory=self.memory,
+                             on_event=self.on_event, run_id=self.run_id)
+
+    def progress(self, done: int, total: int) -> None:
+        """Report progress inside the current stage (e.g. queries summarized)."""
+        if self.on_event is not None:
+            self.on_event('progress', {'done': done, 'total': total})
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int | None = None, concurrent: bool = False):
+        """Time one stage. Concurrent stages (pool workers) report thread CPU
+        time and skip memory, since memory peaks are process-wide."""
+        global _stages_running, _stages_started
+        depth = getattr(_stage_depth, 'n', 0)
+        rec = {'stage': name, 'rows_in': rows_in, 'rows_out': None, 'depth': depth}
+        if self.on_event is not None:
+            self.on_event('start', rec)
+        rss_base, use_tracemalloc, started = None, False, None
+        if depth == 0:
+            with _stages_lock:
+                # Only the sole running stage may reset the (shared) peak mark
+                measure = self.memory and not concurrent and _stages_running == 0
+                _stages_running += 1
+                _stages_started += 1
+                started = _stages_started
+                if measure:
+                    rss_base = _reset_peak_rss()
+                    if rss_base is None and not tracemalloc.is_tracing():
+                        tracemalloc.start()
+                        use_tracemalloc = True
+        _stage_depth.n = depth + 1
+        cpu = time.thread_time if concurrent else time.process_time
+        t0, c0 = time.perf_counter(), cpu()
+        try:
+            yield rec
+        finally:
+            rec['wall_s'] = round(time.perf_counter() - t0, 4)
+            rec['cpu_s']  = round(cpu() - c0, 4)
+            rec['peak_mb'] = None
+            _stage_depth.n = depth
+            if started is not None:
+                with _stages_lock:
+                    _stages_running -= 1
+                    alone = _stages_started == started
+                    if rss_base is not None and alone:
+                        rec['peak_mb'] = round(max(_proc_status_kb('VmHWM:') - rss_base, 0) / 1024, 2)
+                    elif use_tracemalloc:
+                        if alone:
+                            rec['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+                        tracemalloc.stop()
+            self._record(rec)
+            if self.on_event is not None:
+                self.on_event('end', rec)
+
+    def _record(self, rec: dict) -> None:
+        with self._lock:
+            self.records.append(rec)
+            if self.log_path is None:
+                return
+            line = {'ts': time.time(), 'run_id': self.run_id, 'trace': self.label, **rec}
+            try:
+                self.log_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.log_path, 'a', encoding='utf-8') as fh:
+                    fh.write(json.dumps(line) + '\n')
+            except OSError:
+                # Tracing must never break an analysis — a read-only disk just loses the log
+                self.log_path = None
+
+    def to_frame(self) -> pd.DataFrame:
+        """Records as a display table. 'Depth' > 0 marks stages already counted
+        in the stage that encloses them, so totals should skip those rows."""
+        return pd.DataFrame(self.records, columns=[
+            'stage', 'wall_s', 'cpu_s', 'peak_mb', 'rows_in', 'rows_out', 'depth']).rename(columns={
+            'stage': 'Stage', 'wall_s': 'Wall (s)', 'cpu_s': 'CPU (s)',
+            'peak_mb': 'Peak MB', 'rows_in': 'Rows in', 'rows_out': 'Rows out', 'depth': 'Depth'})
+
+
+class _NullTrace:
+    """Stand-in when no trace is passed — stages run untimed."""
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int | None = None, concurrent: bool = False):
+        yield {}
+
+    def child(self, label: str) -> '_NullTrace':
+        return self
+
+    def progress(self, done: int, total: int) -> None:
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# BACKGROUND JOBS
+# ══════════════════════════════════════════════════════════════════════════════
+
+class JobCancelled(Exception):
+    """Raised inside a job's worker thread once the job has been cancelled."""
+
+
+class PipelineJob:
+    """A pipeline function running on an executor, with live progress and cancellation.
+
+    ``fn`` must accept a ``trace`` keyword. The job hands it a PipelineTrace
+    wired to its own listener, which lets the job follow every stage and
+    raise JobCancelled at the next stage boundary or progress tick after
+    cancel(). The finished trace stays on ``job.trace`` for the Performance
+    panel.
+    """
+
+    def __init__(self, label: str, fn: Callable, executor, key=None, **kwargs):
+        self.label    = label
+        self.key      = key
+        self.trace    = PipelineTrace(label, on_event=self._on_event)
+        self.current  = None          # stage running right now
+        self.progress = None          # (done, total) within the current stage
+        self.finished: list[dict] = []  # completed stage records, in order
+        self._cancel  = threading.Event()
+        self.future   = executor.submit(fn, trace=self.trace, **kwargs)
+
+    def _on_event(self, kind: str, rec: dict) -> None:
+        if kind == 'end':
+            self.finished.append(rec)
+            self.current, self.progress = None, None
+            return
+        if self._cancel.is_set():
+            raise JobCancelled(f"{self.label} cancelled")
+        if kind == 'start':
+            self.current, self.progress = rec['stage'], None
+        else:
+            self.progress = (rec['done'], rec['total'])
+
+    def cancel(self) -> None:
+        """Stop the job — immediately if still queued, else at its next checkpoint."""
+        self._cancel.set()
+        self.future.cancel()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self):
+        """The function's return value. Re-raises its error, or JobCancelled."""
+        if self.future.cancelled():
+            raise JobCancelled(f"{self.label} cancelled")
+        return self.future.result()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# DATA PROCESSING
+# ══════════════════════════════════════════════════════════════════════════════
+
+# Column-name mapping table — every GSC / third-party export label we accept,
+# mapped to the internal column name used throughout the pipeline
+GSC_COLUMN_MAP = {
+    # Query
+    'Query': 'query', 'Top queries': 'query', 'Queries': 'query',
+    # Page / Landing Page
+    'Landing Page': 'page', 'Page': 'page', 'Top pages': 'page',
+    'Pages': 'page', 'URL': 'page',
+    # Clicks
+    'Url Clicks': 'clicks', 'Clicks': 'clicks',
+    # Impressions
+    'Impressions': 'impressions',
+    # CTR
+    'URL CTR': 'ctr', 'CTR': 'ctr', 'CTR (%)': 'ctr',
+    'Click Through Rate': 'ctr',
+    # Position
+    'Average Position': 'position', 'Average position': 'position',
+    'Avg Position': 'position', 'Avg. position': 'position',
+    'Position': 'position',
+    # Competing pages (optional)
+    'Competing Pages': 'competing_pages_raw',
+    # Dimensions (optional) — API / Looker Studio exports split rows by these
+    'Country': 'country', 'Device': 'device', 'Date': 'date',
+    'Search Appearance': 'appearance', 'Search appearance': 'appearance',
+    'searchAppearance': 'appearance',
+}
+
+# Optional GSC dimensions; exports that carry them can be drilled into
+GSC_DIMENSIONS = ('country', 'device', 'appearance', 'date')
+DIMENSION_NOT_SET = '(not set)'
+
+# Internal columns the pipeline actually reads — anything else is ignored
+GSC_INTERNAL_COLS = ('query', 'page', 'clicks', 'impressions', 'ctr', 'position',
+                     'competing_pages_raw', *GSC_DIMENSIONS)
+
+
+def read_gsc_data(df: pd.DataFrame, ctr_percent: bool | None = None) -> pd.DataFrame:
+    """Standardise column names from various GSC export formats.
+    
+    Primary format (Edstellar GSC export):
+        Query | Landing Page | Url Clicks | Impressions | URL CTR | Average Position
+
+    CTR is divided by 100 when `ctr_percent` is set, or — when it is None —
+    when any value in this frame is above 1. Chunked readers pass it
+    explicitly so every chunk is scaled the same way.
+    """
+    df = df.rename(columns=GSC_COLUMN_MAP)
+    df.columns = df.columns.str.strip()
+
+    # Normalise to lowercase for internal processing
+    col_lower = {c: c.lower() for c in df.columns}
+    df = df.rename(columns=col_lower)
+
+    required = ['query', 'page', 'clicks', 'impressions', 'position']
+    missing  = [c for c in required if c not in df.columns]
+    if missing:
+        raise ValueError(
+            f"Missing required columns: {', '.join(missing)}. "
+            f"Expected: Query, Landing Page, Url Clicks, Impressions, URL CTR, Average Position"
+        )
+
+    df['clicks']      = pd.to_numeric(df['clicks'],      errors='coerce').fillna(0).astype(int)
+    df['impressions'] = pd.to_numeric(df['impressions'], errors='coerce').fillna(0).astype(int)
+    df['position']    = pd.to_numeric(df['position'],    errors='coerce').fillna(0)
+
+    if 'ctr' in df.columns:
+        # Any non-numeric dtype ("5.2%" strings read as object or as pandas' str dtype)
+        if not pd.api.types.is_numeric_dtype(df['ctr']):
+            df['ctr'] = df['ctr'].astype(str).str.rstrip('%')
+            df['ctr'] = pd.to_numeric(df['ctr'], errors='coerce').fillna(0)
+        else:
+            df['ctr'] = pd.to_numeric(df['ctr'], errors='coerce').fillna(0)
+        if df['ctr'].max() > 1 if ctr_percent is None else ctr_percent:
+            df['ctr'] = df['ctr'] / 100
+    else:
+        df['ctr'] = 0.0
+
+    for dim in dimension_columns(df):
+        if dim == 'date':
+            values = pd.to_datetime(df[dim], errors='coerce').dt.strftime('%Y-%m-%d')
+        else:
+            values = df[dim].where(df[dim].notna()).astype(str).str.strip()
+        df[dim] = values.replace('', np.nan).fillna(DIMENSION_NOT_SET)
+
+    return df
+
+
+def dimension_columns(df: pd.DataFrame) -> list[str]:
+    """The GSC_DIMENSIONS present in `df`, in GSC_DIMENSIONS order."""
+    return [d for d in GSC_DIMENSIONS if d in df.columns]
+
+
+def _xlsx_header_map(row: tuple) -> dict[int, str]:
+    """Map cell index → internal column name for the cells of a header row we understand."""
+    out = {}
+    for i, cell in enumerate(row):
+        if cell is None:
+            continue
+        label = str(cell).strip()
+        name  = GSC_COLUMN_MAP.get(label, label).lower()
+        if name in GSC_INTERNAL_COLS and name not in out.values():
+            out[i] = name
+    return out
+
+
+def _typed_chunk(cols: dict[str, list]) -> pd.DataFrame:
+    """Turn one chunk of raw cell values into typed columns."""
+    chunk = {}
+    for name, values in cols.items():
+        if name in ('clicks', 'impressions', 'position'):
+            chunk[name] = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce')
+        elif name == 'ctr':
+            # Left mixed — read_gsc_data resolves "5.2%" strings vs 0.052 floats
+            chunk[name] = pd.Series(values, dtype=object)
+        else:
+            chunk[name] = pd.Series(values, dtype=object).astype(str)
+    return pd.DataFrame(chunk)
+
+
+def read_gsc_xlsx(fh: IO[bytes], chunk_rows: int = 100_000) -> pd.DataFrame:
+    """Stream a GSC .xlsx export into a raw frame, ready for read_gsc_data.
+
+    The workbook is opened read-only so rows are yielded as plain value
+    tuples instead of cell objects. Only columns found in GSC_COLUMN_MAP are
+    kept, and values are converted to typed columns every `chunk_rows` rows.
+    Every sheet with a Query and a Landing Page header is read. Other sheets,
+    such as the "Filters" tab in GSC UI exports, are skipped.
+    """
+    frames = list(iter_gsc_xlsx(fh, chunk_rows))
+    if not frames:
+        raise ValueError("no sheet has Query and Landing Page columns")
+    return pd.concat(frames, ignore_index=True)
+
+
+def iter_gsc_xlsx(fh: IO[bytes], chunk_rows: int = 100_000) -> Iterator[pd.DataFrame]:
+    """read_gsc_xlsx, one typed chunk of at most `chunk_rows` rows at a time."""
+    wb = openpyxl.load_workbook(fh, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            rows = ws.iter_rows(values_only=True)
+            header = {}
+            # Some exports carry a title row or two above the real header
+            for _, row in zip(range(10), rows):
+                header = _xlsx_header_map(row)
+                if {'query', 'page'} <= set(header.values()):
+                    break
+            else:
+                continue
+
+            cols = {name: [] for name in header.values()}
+            for row in rows:
+                if not any(row):
+                    continue
+                for i, name in header.items():
+                    cols[name].append(row[i] if i < len(row) else None)
+                if len(cols['query']) >= chunk_rows:
+                    yield _typed_chunk(cols)
+                    cols = {name: [] for name in header.values()}
+            if cols['query']:
+                yield _typed_chunk(cols)
+    finally:
+        wb.close()
+
+
+# Upload types accepted by the file uploader — plain CSV, gzipped CSV, Excel, or
+# a .zip bundle of those (GSC caps each UI export, so one property = many files)
+UPLOAD_TYPES = ['csv', 'gz', 'xlsx', 'zip']
+
+
+def expand_upload(name: str, data: bytes | Path) -> list[tuple[str, Callable[[], IO[bytes]]]]:
+    """Split one uploaded file into (label, opener) pairs — one per CSV/XLSX inside it.
+
+    Openers return a binary stream that decompresses on the fly, so a zipped
+    or gzipped export is never inflated into memory before parsing. `data`
+    may also be the path of a file on disk, which is then read as it's parsed.
+    """
+    lower = name.lower()
+    on_disk = isinstance(data, Path)
+    if lower.endswith('.zip'):
+        with zipfile.ZipFile(data if on_disk else BytesIO(data)) as zf:
+            members = [m for m in zf.namelist()
+                       if m.lower().endswith(('.csv', '.csv.gz', '.xlsx'))
+                       and not m.startswith('__MACOSX/')]
+        if not members:
+            raise ValueError(f"{name}: zip archive contains no CSV or XLSX files")
+
+        def _member_opener(member):
+            def _open():
+                stream = zipfile.ZipFile(data if on_disk else BytesIO(data)).open(member)
+                if member.lower().endswith('.gz'):
+                    return gzip.GzipFile(fileobj=stream)
+                return stream
+            return _open
+
+        return [(f"{name}/{m}", _member_opener(m)) for m in members]
+
+    if lower.endswith('.gz'):
+        if on_disk:
+            return [(name, lambda: gzip.open(data))]
+        return [(name, lambda: gzip.GzipFile(fileobj=BytesIO(data)))]
+
+    if on_disk:
+        return [(name, lambda: open(data, 'rb'))]
+    return [(name, lambda: BytesIO(data))]
+
+
+def _parse_gsc_source(label: str, opener: Callable[[], IO[bytes]],
+                      trace=NULL_TRACE) -> pd.DataFrame:
+    """Parse and normalise a single CSV/XLSX stream; errors name the offending file."""
+    try:
+        with trace.stage(f"parse: {label}", concurrent=True) as rec:
+            with opener() as fh:
+                if label.lower().endswith('.xlsx'):
+                    df = read_gsc_xlsx(fh)
+                else:
+                    df = pd.read_csv(fh, dtype=str)
+            rec['rows_out'] = len(df)
+        with trace.stage(f"normalize: {label}", rows_in=len(df), concurrent=True) as rec:
+            df = read_gsc_data(df)
+            rec['rows_out'] = len(df)
+        return df
+    except JobCancelled:
+        raise
+    except Exception as e:
+        raise ValueError(f"{label}: {e}") from e
+
+
+def iter_gsc_chunks(label: str, opener: Callable[[], IO[bytes]], chunk_rows: int = 500_000,
+                    ctr_percent: bool | None = None) -> Iterator[pd.DataFrame]:
+    """Normalised chunks of one CSV/XLSX source, for passes that never hold the whole file."""
+    try:
+        with opener() as fh:
+            if label.lower().endswith('.xlsx'):
+                chunks = iter_gsc_xlsx(fh, chunk_rows)
+            else:
+                chunks = pd.read_csv(fh, dtype=str, chunksize=chunk_rows)
+            for chunk in chunks:
+                yield read_gsc_data(chunk, ctr_percent=ctr_percent)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        raise ValueError(f"{label}: {e}") from e
+
+
+def dedupe_overlapping_rows(frames: list[pd.DataFrame]) -> tuple[pd.DataFrame, int]:
+    """Concatenate per-file frames, dropping (query, page) rows already seen in an earlier file.
+
+    Each row is keyed by a 64-bit hash of (query, page), plus any dimension
+    columns every file carries — the same pair in two countries is two rows,
+    not an overlap. The key is joined against the first file it appeared
+    in, and rows from any later file are dropped. Duplicates *within* one
+    file are kept — they are summed later.
+    """
+    if len(frames) == 1:
+        return frames[0], 0
+
+    df = pd.concat(frames, ignore_index=True)
+    dims = [d for d in GSC_DIMENSIONS if all(d in f.columns for f in frames)]
+    file_idx = np.repeat(np.arange(len(frames)), [len(f) for f in frames])
+    key = pd.util.hash_pandas_object(df[['query', 'page', *dims]], index=False).to_numpy()
+    first_file = pd.Series(file_idx).groupby(key).transform('min').to_numpy()
+    keep = file_idx == first_file
+    return df[keep].reset_index(drop=True), int((~keep).sum())
+
+
+def load_gsc_uploads(uploads: list[tuple[str, bytes]],
+                     trace=NULL_TRACE) -> tuple[pd.DataFrame, dict]:
+    """Parse every uploaded file concurrently and merge them into one frame.
+
+    Returns the combined df plus a load log: per-file row counts, the
+    number of overlapping rows de-duplicated across files, and the uploads'
+    fingerprint (see fingerprint_uploads).
+    """
+    sources = [src for name, data in uploads for src in expand_upload(name, data)]
+    workers = max(1, min(8, os.cpu_count() or 1, len(sources)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        frames = list(pool.map(lambda s: _parse_gsc_source(*s, trace=trace), sources))
+
+    with trace.stage('dedupe', rows_in=sum(len(f) for f in frames)) as rec:
+        df, dupes = dedupe_overlapping_rows(frames)
+        rec['rows_out'] = len(df)
+    load_log = {
+        'files':              [(label, len(f)) for (label, _), f in zip(sources, frames)],
+        'rows_read':          sum(len(f) for f in frames),
+        'duplicates_removed': dupes,
+        'fingerprint':        fingerprint_uploads(uploads),
+    }
+    return df, load_log
+
+
+# Parsed uploads kept in memory across sessions, in MB (KCF_DATASET_CACHE_MB)
+DATASET_CACHE_BYTES = int(os.environ.get('KCF_DATASET_CACHE_MB', 4096)) * 2**20
+
+
+class DatasetLease:
+    """One holder's reference to a DatasetCache entry.
+
+    `df` is shared with every other holder of the same upload — treat it as
+    read-only (copy-on-write means a modified copy never touches it). The
+    reference is released when the lease is garbage-collected, e.g. when a
+    Streamlit session ends, or explicitly with release().
+    """
+
+    def __init__(self, cache: 'DatasetCache', key: str, df: pd.DataFrame, load_log: dict,
+                 shared_with: int):
+        self.key         = key
+        self.df          = df
+        self.load_log    = load_log
+        self.shared_with = shared_with  # other holders when this lease was taken
+        self._finalizer  = weakref.finalize(self, cache._release, key)
+
+    def release(self) -> None:
+        self._finalizer()
+
+
+class DatasetCache:
+    """Process-wide parsed uploads, keyed by content fingerprint.
+
+    Identical bytes uploaded by any number of sessions are parsed once (a
+    concurrent upload of the same bytes waits for the first parse) and held
+    once. Each holder has a DatasetLease; entries nobody holds stay cached
+    for the next upload of the same export until the total size passes
+    `max_bytes`, then the least recently used of them are dropped. Held
+    entries are never dropped — their memory is in use anyway.
+    """
+
+    def __init__(self, max_bytes: int = DATASET_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._loading: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def load(self, uploads: list[tuple[str, bytes]], trace=NULL_TRACE) -> DatasetLease:
+        """A lease on the parsed `uploads`, parsing them only if no one has yet."""
+        key = fingerprint_uploads(uploads)
+        while True:
+            with self._lock:
+                lease = self._acquire(key, uploads)
+                if lease is None:
+                    fut = self._loading.get(key)
+                    owner = fut is None
+                    if owner:
+                        fut = self._loading[key] = Future()
+            if lease is not None:
+                with trace.stage('dataset cache: hit') as rec:
+                    rec['rows_out'] = len(lease.df)
+                return lease
+
+            if not owner:
+                with trace.stage('dataset cache: wait for parse'):
+                    while True:
+                        try:
+                            fut.result(timeout=0.25)
+                        except FutureTimeout:
+                            trace.progress(0, 1)  # raises JobCancelled if *this* job was cancelled
+                            continue
+                        except JobCancelled:
+                            pass  # the owner's job was cancelled, not ours
+                        break
+                continue  # normally a hit now; taken over if the owner was cancelled or it was evicted
+
+            try:
+                df, load_log = load_gsc_uploads(uploads, trace=trace)
+            except BaseException as e:
+                with self._lock:
+                    del self._loading[key]
+                fut.set_exception(e)
+                raise
+            with self._lock:
+                del self._loading[key]
+                self._entries[key] = {'df': df, 'load_log': load_log, 'refs': 0,
+                                      'nbytes': int(df.memory_usage(index=True, deep=True).sum())}
+                lease = self._acquire(key, uploads)
+                self._evict()
+            fut.set_result(None)
+            return lease
+
+    def _acquire(self, key: str, uploads: list[tuple[str, bytes]]) -> DatasetLease | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        entry['refs'] += 1
+        load_log = entry['load_log']
+        # Same bytes under this holder's file names, when files map one-to-one
+        if len(load_log['files']) == len(uploads):
+            load_log = {**load_log, 'files': [(name, rows) for (name, _), (_, rows)
+                                              in zip(uploads, load_log['files'])]}
+        return DatasetLease(self, key, entry['df'], load_log, shared_with=entry['refs'] - 1)
+
+    def _release(self, key: str) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['refs'] -= 1
+                self._evict()
+
+    def _evict(self) -> None:
+        total = sum(e['nbytes'] for e in self._entries.values())
+        for key in [k for k, e in self._entries.items() if e['refs'] == 0]:
+            if total <= self.max_bytes:
+                break
+            total -= self._entries.pop(key)['nbytes']
+
+    def stats(self) -> dict:
+        """datasets, bytes, held (datasets with a holder) and leases (holders in total)."""
+        with self._lock:
+            entries = list(self._entries.values())
+        return {'datasets': len(entries), 'bytes': sum(e['nbytes'] for e in entries),
+                'held': sum(e['refs'] > 0 for e in entries), 'leases': sum(e['refs'] for e in entries)}
+
+
+# Display column name mapping — internal name → Edstellar export label
+DISPLAY_COLS = {
+    'query':            'Query',
+    'slug':             'Landing Page',
+    'page':             'Landing Page',
+    'clicks':           'Url Clicks',
+    'impressions':      'Impressions',
+    'ctr':              'URL CTR (%)',
+    'position':         'Average Position',
+    'competing_pages':  'Competing Pages',
+    'severity':         'Severity',
+}
+
+def rename_for_display(df: pd.DataFrame) -> pd.DataFrame:
+    """Rename internal column names to Edstellar GSC export labels."""
+    return df.rename(columns=DISPLAY_COLS)
+
+
+# ── Template-series discovery ─────────────────────────────────────────────────
+
+# The varying part of a discovered series spans 1–2 slug tokens (uk, south-africa)
+TEMPLATE_VAR_TOKENS = 2
+_TEMPLATE_VAR_RX    = r'[a-z0-9]+' + r'(?:-[a-z0-9]+)?' * (TEMPLATE_VAR_TOKENS - 1)
+
+
+def _series_slugs(slugs: pd.Series) -> pd.Series:
+    """Slugs as template series see them: lowercased, anchor and query string
+    dropped — those variants are the same page."""
+    return slugs.str.lower().str.replace(r'[#?].*$', '', regex=True)
+
+
+def template_series_regex(skeletons: list[str]) -> re.Pattern:
+    """One regex matching any slug of the given '<x>' skeletons, e.g. 'corporate-training-in-<x>'."""
+    alts = [_TEMPLATE_VAR_RX.join(re.escape(part) for part in sk.split('<x>')) for sk in skeletons]
+    return re.compile('(?:' + '|'.join(alts) + ')', re.I)
+
+
+def discover_template_series(df: pd.DataFrame, min_members: int = 5, min_fixed_tokens: int = 2,
+                             trace=NULL_TRACE) -> pd.DataFrame:
+    """Find slug families that differ in one position, like corporate-training-in-<x>.
+
+    Every unique slug is split on '-' and contributes one skeleton per
+    position it could vary at (1 to TEMPLATE_VAR_TOKENS tokens wide) — the
+    prefix path / suffix path pair a prefix and suffix trie would give for
+    that position. Skeletons with at least `min_members` distinct fillers
+    become families. A family whose pages almost all sit in families with
+    more fixed tokens is dropped as a looser view of the same series.
+
+    Returns one row per family: the skeleton, page count, how many queries
+    have two or more of its pages competing, impressions, example fillers,
+    and whether the template rules file already catches it. Busiest
+    conflicts come first.
+    """
+    with trace.stage('discover templates', rows_in=len(df)) as rec:
+        pages = pd.Series(df['page'].astype(str).unique())
+        slug_of_page = pd.Series(_series_slugs(pages.map(get_base_slug)).to_numpy(), index=pages)
+
+        families: dict[str, dict[str, str]] = {}
+        for slug in slug_of_page.unique():
+            tokens = slug.split('-')
+            n = len(tokens)
+            for width in range(1, TEMPLATE_VAR_TOKENS + 1):
+                if n - width < min_fixed_tokens:
+                    break
+                for i in range(n - width + 1):
+                    skeleton = '-'.join(tokens[:i] + ['<x>'] + tokens[i + width:])
+                    families.setdefault(skeleton, {})['-'.join(tokens[i:i + width])] = slug
+
+        # Tightest skeletons first; looser ones that mostly repeat them are dropped
+        candidates = sorted(
+            ((sk, fillers) for sk, fillers in families.items() if len(fillers) >= min_members),
+            key=lambda item: (-item[0].count('-'), -len(item[1])))
+        kept, covered = [], set()
+        for sk, fillers in candidates:
+            members = set(fillers.values())
+            if len(members & covered) >= 0.9 * len(members):
+                continue
+            covered |= members
+            kept.append((sk, fillers, members))
+
+        membership = pd.DataFrame(
+            [(fid, s) for fid, (_, _, members) in enumerate(kept) for s in members],
+            columns=['family', 'slug'])
+        rows = pd.DataFrame({
+            'query': df['query'].to_numpy(),
+            'slug': slug_of_page.reindex(df['page'].astype(str)).to_numpy(),
+            'impressions': df['impressions'].to_numpy(),
+        }).merge(membership, on='slug')
+        per_query = rows.groupby(['family', 'query'])['slug'].nunique()
+        shared    = (per_query >= 2).groupby(level='family').sum()
+        impr      = rows.groupby('family')['impressions'].sum()
+        # Rules looked up once; each distinct slug matched once, however many families hold it
+        site      = load_rules().sites['default']
+        slugs     = membership['slug'].unique()
+        matched   = pd.Series([site.is_template(s) for s in slugs], index=slugs, dtype=bool)
+        builtin   = matched.reindex(membership['slug']).groupby(membership['family'].to_numpy()).mean()
+
+        out = pd.DataFrame({
+            'Template':       [sk for sk, _, _ in kept],
+            'Pages':          [len(members) for _, _, members in kept],
+            'Shared Queries': shared.reindex(range(len(kept)), fill_value=0).to_numpy(),
+            'Impressions':    impr.reindex(range(len(kept)), fill_value=0).to_numpy(),
+            'Examples':       [', '.join(sorted(fillers)[:5]) for _, fillers, _ in kept],
+            'Built-in':       builtin.reindex(range(len(kept)), fill_value=0).to_numpy() >= 0.5,
+        })
+        out = out.sort_values(['Shared Queries', 'Pages'], ascending=False, kind='stable')
+        rec['rows_out'] = len(out)
+    return out.reset_index(drop=True)
+
+
+def apply_filters(df: pd.DataFrame,
+                  pos_min: float, pos_max: float,
+                  min_impressions: int, min_clicks: int,
+                  filter_anchors: bool, filter_templates: bool,
+                  extra_templates: list[str] = (),
+                  trace=NULL_TRACE) -> tuple[pd.DataFrame, dict]:
+    """Apply all configured filters and return filtered df + audit log.
+
+    `extra_templates` are discovered '<x>' skeletons (see
+    discover_template_series), removed on top of the built-in patterns.
+    """
+    audit = {}
+    audit['before'] = len(df)
+
+    # Anchor filter
+    if filter_anchors:
+        before = len(df)
+        with trace.stage('filter: anchors', rows_in=before) as rec:
+            df = df[~df['page'].astype(str).str.contains('#', na=False)]
+            rec['rows_out'] = len(df)
+        audit['anchors_removed'] = before - len(df)
+    else:
+        audit['anchors_removed'] = 0
+
+    # Templatized page filter
+    if filter_templates or extra_templates:
+        before = len(df)
+        with trace.stage('filter: templates', rows_in=before) as rec:
+            slugs = df['page'].astype(str).apply(get_base_slug)
+            drop  = np.zeros(len(df), dtype=bool)
+            if filter_templates:
+                df['_slug'] = slugs
+                drop |= load_rules().template_mask(df['page'])
+            if extra_templates:
+                # Matched the way discovery saw the slugs, so '?utm=' and '#top' variants go too
+                drop |= (_series_slugs(slugs).str.fullmatch(template_series_regex(extra_templates))
+                         .to_numpy(dtype=bool))
+            df = df[~drop]
+            rec['rows_out'] = len(df)
+        audit['templates_removed'] = before - len(df)
+    else:
+        audit['templates_removed'] = 0
+
+    # Position filter
+    with trace.stage('filter: position', rows_in=len(df)) as rec:
+        df = df[(df['position'] >= pos_min) & (df['position'] <= pos_max)]
+        rec['rows_out'] = len(df)
+
+    # Impression / click filters
+    with trace.stage('filter: volume', rows_in=len(df)) as rec:
+        df = df[(df['impressions'] >= min_impressions) & (df['clicks'] >= min_clicks)]
+        rec['rows_out'] = len(df)
+
+    audit['after'] = len(df)
+    return df, audit
+
+
+def find_cannibalization(df: pd.DataFrame, min_pages: int,
+                         trace=NULL_TRACE) -> pd.DataFrame:
+    """Identify queries where multiple pages compete."""
+    with trace.stage('aggregate', rows_in=len(df)) as rec:
+        cannibs = _find_cannibalization(df, min_pages)
+        rec['rows_out'] = len(cannibs)
+    return cannibs
+
+
+def _find_cannibalization(df: pd.DataFrame, min_pages: int) -> pd.DataFrame:
+    if df.empty:
+        return pd.DataFrame()
+
+    slug_col = '_slug' if '_slug' in df.columns else 'page'
+    agg = _pair_sums(df, ['query', slug_col]).reset_index().rename(columns={slug_col: 'slug'})
+    return _finish_cannibalization(agg, min_pages)
+
+
+# Bumped whenever _pair_sums / _finish_cannibalization change what a metric
+# means, so saved runs and watch-folder parts from before aren't reused
+AGGREGATION_VERSION = 2
+
+
+def _pair_sums(df: pd.DataFrame, keys: list[str]) -> pd.DataFrame:
+    """Per-group accumulators that merge by plain addition.
+
+    Every metric is derived from sums, so partial results over any split of
+    the rows — chunks, files, days, dimension values — combine exactly by
+    adding them up, in any order:
+
+      clicks, impressions  summed; CTR is clicks / impressions
+      position_wsum        Σ position × impressions — GSC's average position
+                           is impression-weighted, so ours is too
+      position_sum, rows   plain sum and count, for the position of a group
+                           with no impressions at all
+
+    They are only divided out in _finish_cannibalization.
+    """
+    return df.assign(_wpos=df['position'] * df['impressions']).groupby(keys, observed=True).agg(
+        clicks=('clicks', 'sum'),
+        impressions=('impressions', 'sum'),
+        position_wsum=('_wpos', 'sum'),
+        position_sum=('position', 'sum'),
+        rows=('position', 'size'),
+    )
+
+
+def _finish_cannibalization(agg: pd.DataFrame, min_pages: int) -> pd.DataFrame:
+    """(query, slug) sums from _pair_sums → the find_cannibalization result."""
+    if agg.empty:
+        return pd.DataFrame()
+
+    rows            = agg.pop('rows')
+    impr            = agg['impressions'].where(agg['impressions'] > 0)
+    agg['ctr']      = (agg['clicks'] / impr * 100).fillna(0).round(2)
+    agg['position'] = ((agg.pop('position_wsum') / impr)
+                       .fillna(agg.pop('position_sum') / rows).round(1))
+    agg             = agg[['query', 'slug', 'clicks', 'impressions', 'ctr', 'position']]
+
+    pages_per_query           = agg.groupby('query')['slug'].transform('count')
+    agg['competing_pages']    = pages_per_query
+    cannibs                   = agg[agg['competing_pages'] >= min_pages].copy()
+
+    # One column per segmentation in the rules file (Brand, Intent, ...)
+    segmenter = load_rules().segments
+    if segmenter and not cannibs.empty:
+        cannibs = cannibs.join(segmenter.segment(cannibs['query']))
+
+    return cannibs.sort_values(['competing_pages', 'impressions'], ascending=[False, False])
+
+
+# ── Slug similarity ───────────────────────────────────────────────────────────
+
+SIMILARITY_NGRAM = 3
+# Max pairwise similarity at or above which a group is labelled this conflict type
+CONFLICT_TYPES = ((0.6, 'Near-duplicate'), (0.3, 'Overlapping'), (0.0, 'Different intent'))
+# Pages per query compared pairwise — the ones with the most impressions. A query
+# ranking thousands of pages would otherwise cost millions of pairs (n²/2)
+SIMILARITY_MAX_PAGES = 200
+_SIM_BATCH = 4_000_000   # expanded (pair, n-gram) entries per dot-product batch
+_SIM_PAIR_BATCH = 1_000_000   # (i < j) pairs generated at a time
+
+
+def _slug_text(slugs: pd.Series) -> pd.Series:
+    """Slug (or URL) as lowercase words: 'blog/what-is-sql' → ' blog what is sql '."""
+    words = (slugs.astype(str).str.lower()
+                  .str.replace(r'^https?://[^/]+/', '', regex=True)
+                  .str.replace(r'[\W_]+', ' ', regex=True)
+                  .str.strip())
+    return ' ' + words + ' '
+
+
+def tfidf_ngram_vectors(texts: pd.Series, n: int = SIMILARITY_NGRAM
+                        ) -> tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """L2-normalized character n-gram TF-IDF vectors, as sparse COO arrays.
+
+    Returns (keys, weights, doc_start, n_terms): keys = doc * n_terms + term, sorted,
+    so doc d's entries are keys[doc_start[d]:doc_start[d + 1]] and any
+    (doc, term) entry can be found with one searchsorted. Built entirely
+    with array ops — the only per-text work is the string join.
+    """
+    texts = texts.fillna('').astype(str)
+    n_docs = len(texts)
+    lens = texts.str.len().to_numpy(dtype=np.int64)
+    # Code points < 2**21, so n ≤ 3 of them pack into one uint64 per n-gram
+    codes = np.frombuffer(''.join(texts.tolist()).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    per_doc = np.maximum(lens - n + 1, 0)
+    doc = np.repeat(np.arange(n_docs), per_doc)
+    pos = (np.repeat(np.cumsum(lens) - lens, per_doc)
+           + np.arange(len(doc)) - np.repeat(np.cumsum(per_doc) - per_doc, per_doc))
+    gram = np.zeros(len(doc), dtype=np.uint64)
+    for k in range(n):
+        gram = (gram << np.uint64(21)) | codes[pos + k]
+
+    terms, term = np.unique(gram, return_inverse=True)
+    n_terms = max(len(terms), 1)
+    keys, tf = np.unique(doc * n_terms + term, return_counts=True)
+    doc, term = keys // n_terms, keys % n_terms
+    df = np.bincount(term, minlength=n_terms)
+    w = tf * (np.log((1 + n_docs) / (1 + df)) + 1)[term]
+    w /= np.sqrt(np.bincount(doc, weights=w * w, minlength=n_docs))[doc]
+    doc_start = np.searchsorted(doc, np.arange(n_docs + 1))
+    return keys, w, doc_start, n_terms
+
+
+def _pair_cosine(a: np.ndarray, b: np.ndarray, keys: np.ndarray, w: np.ndarray,
+                 doc_start: np.ndarray, n_terms: int) -> np.ndarray:
+    """Cosine similarity of documents a[i] and b[i] from tfidf_ngram_vectors output."""
+    # Walk a's entries and look each term up in b's vector
+    sims = np.zeros(len(a))
+    if not len(keys):
+        return sims
+    nnz = np.diff(doc_start)[a]
+    cum = np.cumsum(nnz)
+    start = 0
+    while start < len(a):
+        stop = max(int(np.searchsorted(cum, (cum[start - 1] if start else 0) + _SIM_BATCH)), start + 1)
+        stop = min(stop, len(a))
+        k = nnz[start:stop]
+        pair = np.repeat(np.arange(start, stop), k)
+        entry = (np.repeat(doc_start[a[start:stop]], k)
+                 + np.arange(len(pair)) - np.repeat(np.cumsum(k) - k, k))
+        want = b[pair] * n_terms + keys[entry] % n_terms
+        hit = np.minimum(np.searchsorted(keys, want), len(keys) - 1)
+        prod = np.where(keys[hit] == want, w[entry] * w[hit], 0.0)
+        sims[start:stop] = np.bincount(pair - start, weights=prod, minlength=stop - start)
+        start = stop
+    return sims
+
+
+def group_similarity(cannibs: pd.DataFrame, titles: pd.Series | None = None,
+                     max_pages: int | None = SIMILARITY_MAX_PAGES, trace=NULL_TRACE) -> pd.Series:
+    """Max pairwise cosine similarity of the competing pages, per query.
+
+    Pages are compared on character trigram TF-IDF vectors of their slugs —
+    plus their titles, when `titles` (slug → title) is given. Near-identical
+    landing pages score close to 1; a blog post and a course page sharing
+    one keyword score low. Only each query's `max_pages` pages with the most
+    impressions are compared (None: all), and pairs are generated and scored
+    in fixed-size batches, so memory stays flat however big a group is.
+    """
+    with trace.stage('similarity', rows_in=len(cannibs)) as rec:
+        if cannibs.empty:
+            rec['rows_out'] = 0
+            return pd.Series(dtype=np.float64, name='similarity')
+        slug_codes, slugs = pd.factorize(cannibs['slug'])
+        q_codes, queries = pd.factorize(cannibs['query'])
+        texts = _slug_text(pd.Series(slugs))
+        if titles is not None:
+            texts = texts + pd.Series(slugs).map(titles).fillna('').astype(str).str.lower() + ' '
+        keys, w, doc_start, n_terms = tfidf_ngram_vectors(texts)
+
+        # Rows grouped by query, busiest page first; groups cut to max_pages
+        order = np.lexsort((-cannibs['impressions'].to_numpy(dtype=np.float64), q_codes))
+        q_sorted = q_codes[order]
+        bounds = np.flatnonzero(np.r_[True, q_sorted[1:] != q_sorted[:-1], True])
+        if max_pages is not None:
+            rank = np.arange(len(order)) - np.repeat(bounds[:-1], np.diff(bounds))
+            order, q_sorted = order[rank < max_pages], q_sorted[rank < max_pages]
+            bounds = np.flatnonzero(np.r_[True, q_sorted[1:] != q_sorted[:-1], True])
+        # Row i pairs with every later row of its group: (i, i+1) … (i, group end - 1)
+        group_end = np.repeat(bounds[1:], np.diff(bounds))
+        later = group_end - np.arange(len(order)) - 1
+        pair_end = np.cumsum(later)
+
+        best = np.zeros(len(queries))
+        lo = 0
+        while lo < len(order):
+            # Rows whose pairs add up to ~_SIM_PAIR_BATCH (always at least one row)
+            done = pair_end[lo - 1] if lo else 0
+            hi = max(int(np.searchsorted(pair_end, done + _SIM_PAIR_BATCH, side='right')), lo + 1)
+            k = later[lo:hi]
+            first = np.repeat(np.arange(lo, hi), k)
+            second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(k) - k, k)
+            sims = _pair_cosine(slug_codes[order[first]], slug_codes[order[second]],
+                                keys, w, doc_start, n_terms)
+            np.maximum.at(best, q_sorted[first], np.clip(sims, 0, 1))
+            lo = hi
+            trace.progress(lo, len(order))
+        rec['rows_out'] = int(pair_end[-1]) if len(pair_end) else 0
+    return pd.Series(best, index=pd.Index(queries, name='query'), name='similarity')
+
+
+def add_similarity(query_sum: pd.DataFrame, cannibs: pd.DataFrame,
+                   titles: pd.Series | None = None, trace=NULL_TRACE) -> pd.DataFrame:
+    """query_sum with Slug Similarity (0–1) and Conflict Type, set or replaced."""
+    if query_sum.empty:
+        return query_sum
+    sim = group_similarity(cannibs, titles, trace=trace)
+    out = query_sum.drop(columns=['Slug Similarity', 'Conflict Type'], errors='ignore')
+    at = out.columns.get_loc('Position Spread') + 1
+    score = out['Query'].map(sim).fillna(0.0).round(2)
+    out.insert(at, 'Slug Similarity', score)
+    out.insert(at + 1, 'Conflict Type', np.select(
+        [score >= t for t, _ in CONFLICT_TYPES], [label for _, label in CONFLICT_TYPES],
+        default=CONFLICT_TYPES[-1][1]))
+    return out
+
+
+def build_query_summary(df: pd.DataFrame, trace=NULL_TRACE, similarity: bool = True) -> pd.DataFrame:
+    """One-row-per-query grouped view — uses Edstellar GSC column labels.
+
+    similarity=False leaves out Slug Similarity / Conflict Type, for callers
+    that add them over a larger set of pages (the IDF depends on it).
+    """
+    with trace.stage('summary', rows_in=len(df)) as rec:
+        out = _build_query_summary(df)
+        rec['rows_out'] = len(out)
+    return add_similarity(out, df, trace=trace) if similarity else out
+
+
+def _build_query_summary(df: pd.DataFrame) -> pd.DataFrame:
+    if df.empty:
+        return pd.DataFrame()
+
+    # Pick the canonical "best" page by traffic authority:
+    # Score = impressions + (clicks * 10) so clicks break ties on equal impressions.
+    # This ensures we always recommend consolidating INTO the page with real traffic,
+    # not the one that merely has the lowest position number.
+    q_codes, queries = pd.factorize(df['query'], sort=True)
+    clicks = df['clicks'].to_numpy(dtype=np.int64)
+    impr   = df['impressions'].to_numpy(dtype=np.int64)
+    pos    = df['position'].to_numpy(dtype=np.float64)
+
+    # Rows grouped by query, best page first (stable, so equal scores keep row order)
+    order  = np.lexsort((-(impr + clicks * 10), q_codes))
+    starts = np.flatnonzero(np.r_[True, q_codes[order][1:] != q_codes[order][:-1]])
+    bounds = np.r_[starts, len(order)].tolist()
+    slugs  = df['slug'].to_numpy(dtype=object)[order].tolist()
+
+    q_clicks = np.add.reduceat(clicks[order], starts)
+    q_impr   = np.add.reduceat(impr[order], starts)
+    best_pos = np.minimum.reduceat(pos[order], starts)
+    worst    = np.maximum.reduceat(pos[order], starts)
+    # Query CTR from the summed clicks and impressions, not a mean of page CTRs
+    ctr = np.divide(q_clicks * 100, q_impr, out=np.zeros(len(q_impr)), where=q_impr > 0)
+
+    out = pd.DataFrame({
+        'Query':                   queries,
+        'Competing Pages':         np.diff(bounds),
+        'Url Clicks':              q_clicks,
+        'Impressions':             q_impr,
+        'URL CTR (%)':             ctr.round(2),
+        'Best Average Position':   best_pos.round(1),
+        'Worst Average Position':  worst.round(1),
+        'Position Spread':         (worst - best_pos).round(1),
+        'Best Landing Page':       [slugs[a] for a in bounds[:-1]],
+        'All Landing Pages':       [' | '.join(slugs[a:b]) for a, b in zip(bounds[:-1], bounds[1:])],
+    })
+    # Query segments are the same on every row of a query
+    for col in segment_columns(df):
+        out[col] = df[col].array.take(order[starts])
+    return out.sort_values('Impressions', ascending=False, kind='stable')
+
+
+def segment_columns(df: pd.DataFrame) -> list[str]:
+    """The query-segment columns of a cannibs or query_sum frame: the rules
+    file's segmentations that the frame carries, in the rules file's order.
+    Other categorical columns (GSC dimensions, say) aren't segments."""
+    return [c for c in load_rules().segments.labels if c in df.columns]
+
+
+def severity(pos: float, impressions: int) -> str:
+    if pos <= 10 and impressions >= 1000: return 'High'
+    if pos <= 20 and impressions >= 200:  return 'Medium'
+    return 'Low'
+
+
+def severity_labels(pos: pd.Series, impressions: pd.Series) -> np.ndarray:
+    """Column-wise severity() — same thresholds, one pass instead of a row-wise apply."""
+    return np.select(
+        [(pos <= 10) & (impressions >= 1000), (pos <= 20) & (impressions >= 200)],
+        ['High', 'Medium'], default='Low',
+    )
+
+
+# ── Click opportunity ─────────────────────────────────────────────────────────
+
+# CTR ≈ a · position^-b. Roughly the published organic CTR curve (~30% at #1);
+# only used when the data has too few positions with clicks to fit its own
+DEFAULT_CTR_CURVE = (0.30, 1.0)
+
+
+def fit_ctr_curve(df: pd.DataFrame, min_impressions: int = 100) -> tuple[float, float]:
+    """(a, b) of CTR ≈ a · position^-b, fit on this dataset's own clicks and impressions.
+
+    analyze() fits it on every filtered row, not just the conflicting ones:
+    queries with a single page are most of the clicks, and the best
+    evidence of what one page per query earns. Rows are bucketed by rounded position. The fit is an impression-weighted
+    least squares line in log-log space over buckets with at least
+    `min_impressions` impressions and one click, so sparse tail positions
+    don't bend the curve. b is floored at 0 — CTR never rises with position.
+    """
+    pos = np.clip(np.rint(df['position'].to_numpy(dtype=np.float64)), 1, 100).astype(np.int64)
+    impr   = np.bincount(pos, weights=df['impressions'].to_numpy(dtype=np.float64), minlength=101)
+    clicks = np.bincount(pos, weights=df['clicks'].to_numpy(dtype=np.float64), minlength=101)
+    ok = (impr >= min_impressions) & (clicks > 0)
+    if ok.sum() < 2:
+        return DEFAULT_CTR_CURVE
+    ctr = clicks[ok] / impr[ok]
+    slope, intercept = np.polyfit(np.log(np.flatnonzero(ok)), np.log(ctr), 1, w=np.sqrt(impr[ok]))
+    if slope >= 0:
+        return float(np.average(ctr, weights=impr[ok])), 0.0
+    return float(min(np.exp(intercept), 1.0)), float(-slope)
+
+
+def expected_ctr(position, curve: tuple[float, float]) -> np.ndarray:
+    a, b = curve
+    return np.minimum(a * np.maximum(np.asarray(position, dtype=np.float64), 1.0) ** -b, 1.0)
+
+
+def click_opportunity(query_sum: pd.DataFrame, cannibs: pd.DataFrame,
+                      curve: tuple[float, float] | None = None) -> pd.DataFrame:
+    """Expected CTR and recoverable clicks per query, as two columns aligned to query_sum.
+
+    Consolidated, a query's demand — its largest single-page impression
+    count, since competing pages are shown for the same searches — lands
+    on one page at the best position any of them holds now. Recoverable
+    clicks are what that page would earn on the fitted CTR curve minus
+    what all the pages earn today, floored at 0. One columnar pass.
+
+    Pass analyze()'s `ctr_curve`; without one the curve is fitted on
+    `cannibs` alone.
+    """
+    curve  = curve or fit_ctr_curve(cannibs)
+    demand = query_sum['Query'].map(
+        cannibs.groupby('query', observed=True, sort=False)['impressions'].max()).to_numpy(dtype=np.float64)
+    ctr = expected_ctr(query_sum['Best Average Position'].to_numpy(), curve)
+    recoverable = np.maximum(demand * ctr - query_sum['Url Clicks'].to_numpy(dtype=np.float64), 0)
+    return pd.DataFrame({
+        'Expected CTR (%)':   np.round(ctr * 100, 2),
+        'Recoverable Clicks': np.rint(recoverable).astype(np.int64),
+    }, index=query_sum.index)
+
+
+def priority_matrix(query_sum: pd.DataFrame, opp: pd.DataFrame, k: int = 50) -> pd.DataFrame:
+    """The k queries with the most recoverable clicks, with a recommended action each.
+
+    `opp` is click_opportunity() for query_sum. The top k are picked with
+    argpartition — only those k rows get sorted. Conflict Type (from slug
+    similarity) steers different-intent conflicts to differentiation
+    rather than a merge; saved runs from before it simply lack the column.
+    """
+    score = opp['Recoverable Clicks'].to_numpy()
+    top = np.argpartition(-score, k - 1)[:k] if len(score) > k else np.arange(len(score))
+    impr = query_sum['Impressions'].to_numpy()
+    top = top[np.lexsort((-impr[top], -score[top]))]
+
+    cols = ['Query', 'Competing Pages', 'Impressions', 'Url Clicks', 'Best Average Position',
+            *(['Conflict Type'] if 'Conflict Type' in query_sum.columns else []), '_sev']
+    out = pd.concat([query_sum[cols].iloc[top], opp.iloc[top]], axis=1).rename(columns={'_sev': 'Severity'})
+    sev = out['Severity']
+    different = out.get('Conflict Type', pd.Series('', index=out.index)) == 'Different intent'
+    # Pages with clearly different slugs usually serve different intents — merging them loses one
+    out['Recommended Action'] = np.select(
+        [sev == 'Low', different, sev == 'High'],
+        ['Monitor / internal linking', 'Differentiate titles / intent', 'Consolidate / 301 redirect'],
+        default='Add canonicals / differentiate')
+    return out.reset_index(drop=True)
+
+
+# ── Site-wide redirect map ────────────────────────────────────────────────────
+
+REDIRECT_MAP_COLS = ['Redirect From', 'Redirect To', 'Lost To', 'Queries', 'Score']
+
+
+def build_redirect_map(cannibs: pd.DataFrame, trace=NULL_TRACE) -> tuple[pd.DataFrame, dict]:
+    """One redirect target per slug, consistent across every query.
+
+    Per query the page with the highest impressions + clicks*10 score wins,
+    as on the High Severity tab. Taken query by query, though, the same slug
+    can be told to redirect to different winners, and the suggestions can
+    chain (A→B, B→C) or loop (A→B on one query, B→A on another). Here:
+
+    - each losing slug points at the winner it lost the most score to,
+      summed over the queries they share — unless the slug wins at least
+      that much score on queries of its own, in which case it stays. A
+      winner always scores more than what was lost to it, so a pointed-at
+      slug that moves on has lost even more elsewhere: every hop raises the
+      score, and pointers can't loop;
+    - pointers are linked heaviest first with union-find, and each slug
+      redirects straight to the root of its tree, so the map has no chains.
+      'Lost To' keeps the direct winner where that differs.
+
+    Returns the map (one row per redirected slug, biggest consolidations
+    first) and counts for the UI.
+    """
+    stats = {'redirects': 0, 'targets': 0, 'split': 0, 'kept': 0, 'chains_collapsed': 0}
+    with trace.stage('redirect map', rows_in=len(cannibs)) as rec:
+        rec['rows_out'] = 0
+        if cannibs.empty:
+            return pd.DataFrame(columns=REDIRECT_MAP_COLS), stats
+
+        # Sorted factorize, so lower codes are alphabetically first (the tie-break)
+        slug_codes, slugs = pd.factorize(cannibs['slug'], sort=True)
+        q_codes, queries  = pd.factorize(cannibs['query'])
+        score = (cannibs['impressions'].to_numpy(dtype=np.float64)
+                 + cannibs['clicks'].to_numpy(dtype=np.float64) * 10)
+        n = len(slugs)
+
+        order = np.lexsort((slug_codes, -score, q_codes))
+        first = np.r_[True, q_codes[order][1:] != q_codes[order][:-1]]
+        winner_of = np.empty(len(queries), dtype=np.int64)
+        winner_of[q_codes[order][first]] = slug_codes[order][first]
+        winner = winner_of[q_codes]
+        lost = slug_codes != winner
+        win_score = np.bincount(slug_codes[~lost], weights=score[~lost], minlength=n)
+
+        # Loser → winner edges, summed over the queries they share
+        edges = (pd.DataFrame({'src': slug_codes[lost], 'dst': winner[lost], 'score': score[lost]})
+                   .groupby(['src', 'dst'], sort=False)
+                   .agg(score=('score', 'sum'), queries=('score', 'size'))
+                   .reset_index())
+        stats['split'] = int((edges['src'].value_counts() > 1).sum())
+        best = (edges.sort_values(['src', 'score', 'dst'], ascending=[True, False, True])
+                     .drop_duplicates('src'))
+        keep = win_score[best['src'].to_numpy()] >= best['score'].to_numpy()
+        stats['kept'] = int(keep.sum())
+        best = best[~keep].sort_values(['score', 'src'], ascending=[False, True])
+
+        parent = list(range(n))
+
+        def find(x: int) -> int:
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        linked = np.zeros(len(best), dtype=bool)
+        for i, (src, dst) in enumerate(zip(best['src'].tolist(), best['dst'].tolist())):
+            # src is still a root here: each slug has at most one pointer.
+            # Loops are ruled out above; this only guards float ties.
+            if find(dst) == src:
+                continue
+            parent[src] = dst
+            linked[i] = True
+
+        root = np.asarray(parent, dtype=np.int64)
+        while True:
+            nxt = root[root]
+            if (nxt == root).all():
+                break
+            root = nxt
+
+        best  = best[linked]
+        src   = best['src'].to_numpy()
+        names = np.asarray(slugs, dtype=object)
+        out = pd.DataFrame({
+            'Redirect From': names[src],
+            'Redirect To':   names[root[src]],
+            'Lost To':       names[best['dst'].to_numpy()],
+            'Queries':       best['queries'].to_numpy(dtype=np.int64),
+            'Score':         best['score'].round().to_numpy(dtype=np.int64),
+        })
+        target_score = out.groupby('Redirect To')['Score'].transform('sum')
+        out = (out.assign(_t=target_score)
+                  .sort_values(['_t', 'Redirect To', 'Score', 'Redirect From'],
+                               ascending=[False, True, False, True])
+                  .drop(columns='_t')
+                  .reset_index(drop=True))
+        stats.update(redirects=len(out), targets=int(out['Redirect To'].nunique()),
+                     chains_collapsed=int((out['Lost To'] != out['Redirect To']).sum()))
+        rec['rows_out'] = len(out)
+    return out, stats
+
+
+def query_redirects(slugs: list, redirect_to: dict) -> dict:
+    """What the site-wide redirect map does with one query's pages.
+
+    `slugs` are the query's pages, best-scoring first; `redirect_to` maps
+    'Redirect From' to 'Redirect To' from build_redirect_map. Returns
+    'into' — (target, [slugs redirected into it]) pairs in slug order —
+    'kept', the pages that lose this query but stay because they win more
+    on other queries, and 'winner', the query's top page if it stays too.
+    """
+    into: dict[str, list] = {}
+    kept = []
+    for i, slug in enumerate(slugs):
+        target = redirect_to.get(slug)
+        if target is not None:
+            into.setdefault(target, []).append(slug)
+        elif i:
+            kept.append(slug)
+    winner = slugs[0] if slugs and slugs[0] not in redirect_to else None
+    return {'into': list(into.items()), 'kept': kept, 'winner': winner}
+
+
+# ── Result search ─────────────────────────────────────────────────────────────
+
+def _text_tokens(texts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """(doc id, token) pairs: each text lowercased and split on non-alphanumerics."""
+    tok = (pd.Series(texts, dtype=object).astype(str).str.lower()
+             .str.replace(_WORD_SPLIT.pattern, ' ', regex=True).str.split().explode())
+    tok = tok[tok.notna()]
+    return tok.index.to_numpy(dtype=np.int64), tok.to_numpy(dtype=object)
+
+
+class SearchIndex:
+    """In-memory inverted index over one analysis result.
+
+    Every word of a query and of its competing slugs points at the query
+    group, so typing a page's slug words finds the groups it competes in.
+    The vocabulary is sorted and each token's postings (query ids) are
+    stored contiguously in token order, so a prefix is a vocabulary range
+    found with two binary searches and its postings are one slice. A search
+    is every term as a prefix, ANDed: 'pow bi train' matches
+    'power bi training companies'.
+    """
+
+    def __init__(self, cannibs: pd.DataFrame, trace=NULL_TRACE):
+        with trace.stage('search index', rows_in=len(cannibs)) as rec:
+            q_codes, queries = pd.factorize(cannibs['query'])
+            s_codes, slugs   = pd.factorize(cannibs['slug'])
+            n_q = len(queries)
+            q_doc, q_tok = _text_tokens(np.asarray(queries, dtype=object))
+            s_doc, s_tok = _text_tokens(np.asarray(slugs, dtype=object))
+
+            # Hash the tokens, then sort only the (small) vocabulary
+            codes, vocab = pd.factorize(np.concatenate([q_tok, s_tok]))
+            order = np.argsort(np.asarray(vocab, dtype=object))
+            rank  = np.empty(len(order), dtype=np.int64)
+            rank[order] = np.arange(len(order))
+            vocab = np.asarray(vocab, dtype=object)[order]
+            q_tid, s_tid = rank[codes[:len(q_tok)]], rank[codes[len(q_tok):]]
+
+            # Slug tokens reach every query the slug competes in (slug → rows CSR)
+            by_slug = np.argsort(s_codes, kind='stable')
+            s_start = np.searchsorted(s_codes[by_slug], np.arange(len(slugs) + 1))
+            cnt  = (s_start[1:] - s_start[:-1])[s_doc]
+            base = np.repeat(s_start[s_doc] - (np.cumsum(cnt) - cnt), cnt)
+            rows = by_slug[base + np.arange(cnt.sum())]
+
+            keys = np.concatenate([q_tid * n_q + q_doc, np.repeat(s_tid, cnt) * n_q + q_codes[rows]])
+            keys.sort()
+            keys = keys[np.diff(keys, prepend=-1) != 0]
+            self.vocab    = vocab
+            self.postings = (keys % n_q).astype(np.int32) if n_q else keys.astype(np.int32)
+            self.offsets  = np.searchsorted(keys // max(n_q, 1), np.arange(len(vocab) + 1))
+
+            # Result rows grouped by query, each group biggest page first.
+            # Columns are kept as numpy (strings as codes into their
+            # uniques): taking rows from Arrow-backed strings costs ~10 ms
+            # a column even for an empty result
+            by_query = np.lexsort((-cannibs['impressions'].to_numpy(), q_codes))
+            self.rows     = by_query
+            self.columns  = {}
+            for col in cannibs.columns:
+                if col in ('query', 'slug'):
+                    codes, uniq = (q_codes, queries) if col == 'query' else (s_codes, slugs)
+                    self.columns[col] = (codes, np.asarray(uniq, dtype=object))
+                elif pd.api.types.is_numeric_dtype(cannibs[col]):
+                    self.columns[col] = (cannibs[col].to_numpy(), None)
+                else:
+                    codes, uniq = pd.factorize(cannibs[col])
+                    self.columns[col] = (codes, np.asarray(uniq, dtype=object))
+            self.q_start  = np.searchsorted(q_codes[by_query], np.arange(n_q + 1))
+            self.q_impr   = np.bincount(q_codes, weights=cannibs['impressions'].to_numpy(np.float64),
+                                        minlength=n_q)
+            rec['rows_out'] = len(self.postings)
+
+    def __len__(self) -> int:
+        return len(self.q_impr)
+
+    def match(self, text: str) -> np.ndarray:
+        """Ids of the query groups matching every term of `text` as a prefix."""
+        terms = set(_words(text))
+        if not terms:
+            return np.arange(0)
+        hits = None
+        for term in terms:
+            lo, hi = np.searchsorted(self.vocab, [term, term + '\U0010ffff'])
+            ids = self.postings[self.offsets[lo]:self.offsets[hi]]
+            # A prefix spans several tokens whose postings overlap: union
+            # them on a mask over query ids, which needs no sort
+            mask = np.zeros(len(self), dtype=bool)
+            mask[ids] = True
+            hits = mask if hits is None else hits & mask
+        return np.flatnonzero(hits)
+
+    def search(self, text: str, limit: int = 50) -> tuple[pd.DataFrame, int]:
+        """Competing pages of the matching query groups, biggest groups first.
+
+        Returns the rows for the top `limit` groups by impressions and the
+        number of groups that matched in total.
+        """
+        hits = self.match(text)
+        n_hits = len(hits)
+        if n_hits > limit:
+            hits = hits[np.argpartition(-self.q_impr[hits], limit - 1)[:limit]]
+        hits = hits[np.argsort(-self.q_impr[hits], kind='stable')]
+        cnt  = self.q_start[hits + 1] - self.q_start[hits]
+        pos  = np.repeat(self.q_start[hits] - (np.cumsum(cnt) - cnt), cnt) + np.arange(cnt.sum())
+        rows = self.rows[pos]
+        out = pd.DataFrame({col: vals[rows] if uniq is None else uniq[vals[rows]]
+                            for col, (vals, uniq) in self.columns.items()})
+        return out, n_hits
+
+
+# ── Two-pass mode for huge inputs ─────────────────────────────────────────────
+
+class SlugSetSketch:
+    """Which queries reach `k` distinct slugs, in bounded memory.
+
+    Holds at most k slug hashes per query key as two flat uint64 arrays.
+    Keys start out as full 64-bit query hashes, so counts are exact. If the
+    table grows past `max_entries`, keys are cut down to their top bits and
+    queries start sharing buckets. A shared bucket can only gain slugs, so
+    every query with k distinct slugs is still reported. The extra
+    candidates that collisions let through are dropped by the exact pass.
+    """
+
+    def __init__(self, k: int, max_entries: int = 8_000_000):
+        self.k           = k
+        self.max_entries = max_entries
+        self.key_bits    = 64
+        self._keys       = np.empty(0, dtype=np.uint64)
+        self._slugs      = np.empty(0, dtype=np.uint64)
+        self._pending: list[tuple[np.ndarray, np.ndarray]] = []
+        self._pending_n  = 0
+
+    def _key(self, query_hashes: np.ndarray) -> np.ndarray:
+        return query_hashes >> np.uint64(64 - self.key_bits)
+
+    def update(self, query_hashes: np.ndarray, slug_hashes: np.ndarray) -> None:
+        """Add one chunk of (query, slug) hash pairs."""
+        self._pending.append((self._key(query_hashes), slug_hashes))
+        self._pending_n += len(query_hashes)
+        # Compacting only once the backlog matches the table keeps merges amortised
+        if self._pending_n >= max(len(self._keys), 1_000_000):
+            self._compact()
+
+    def _compact(self) -> None:
+        pairs = pd.DataFrame({
+            'key':  np.concatenate([self._keys] + [k for k, _ in self._pending]),
+            'slug': np.concatenate([self._slugs] + [s for _, s in self._pending]),
+        })
+        self._pending, self._pending_n = [], 0
+        while True:
+            pairs = pairs.drop_duplicates()
+            pairs = pairs[pairs.groupby('key').cumcount() < self.k]
+            if len(pairs) <= self.max_entries or self.key_bits <= 1:
+                break
+            # Keep enough bits for about half the budget in distinct keys
+            self.key_bits = min(self.key_bits - 1,
+                                max(1, int(np.log2(self.max_entries / (2 * self.k)))))
+            pairs['key'] = pairs['key'].to_numpy() >> np.uint64(64 - self.key_bits)
+        self._keys  = pairs['key'].to_numpy()
+        self._slugs = pairs['slug'].to_numpy()
+
+    def candidates(self) -> np.ndarray:
+        """Sorted keys holding at least k distinct slugs."""
+        self._compact()
+        keys, counts = np.unique(self._keys, return_counts=True)
+        return keys[counts >= self.k]
+
+    def contains(self, candidate_keys: np.ndarray, query_hashes: np.ndarray) -> np.ndarray:
+        """Mask of the queries whose key is among `candidate_keys`."""
+        keys = self._key(query_hashes)
+        pos  = np.searchsorted(candidate_keys, keys).clip(max=max(len(candidate_keys) - 1, 0))
+        return (candidate_keys[pos] == keys) if len(candidate_keys) else np.zeros(len(keys), bool)
+
+
+def _hash_column(s: pd.Series) -> np.ndarray:
+    return pd.util.hash_pandas_object(s, index=False).to_numpy()
+
+
+def find_cannibalization_two_pass(sources: list[tuple[str, Callable[[], IO[bytes]]]], *,
+                                  min_pages: int, pos_min: float, pos_max: float,
+                                  min_impressions: int, min_clicks: int,
+                                  filter_anchors: bool, filter_templates: bool,
+                                  extra_templates: list[str] = (),
+                                  chunk_rows: int = 500_000,
+                                  max_sketch_entries: int = 8_000_000,
+                                  trace=NULL_TRACE) -> tuple[pd.DataFrame, dict]:
+    """find_cannibalization over files too big to load, reading them twice.
+
+    `sources` are (label, opener) pairs as returned by expand_upload. Pass 1
+    streams every source in chunks, applies the row filters and feeds a
+    SlugSetSketch with the surviving (query, slug) pairs. Pass 2 streams the
+    sources again and keeps only rows of candidate queries. Those rows are
+    de-duplicated across files, filtered and aggregated exactly, so the
+    result matches the in-memory path. Memory is the sketch plus the
+    candidate rows, not the whole export.
+
+    The returned audit counts come from pass 1, before cross-file
+    de-duplication. It also holds rows_read, candidate_queries and rows_kept.
+    """
+    filters = dict(pos_min=pos_min, pos_max=pos_max, min_impressions=min_impressions,
+                   min_clicks=min_clicks, filter_anchors=filter_anchors,
+                   filter_templates=filter_templates, extra_templates=extra_templates)
+    sketch = SlugSetSketch(min_pages, max_entries=max_sketch_entries)
+    audit  = {'before': 0, 'anchors_removed': 0, 'templates_removed': 0, 'after': 0}
+    # Pass 1 reads CTR unscaled; pass 2 scales each file the way read_gsc_data would
+    ctr_max = {label: 0.0 for label, _ in sources}
+
+    with trace.stage('two-pass: sketch') as rec:
+        for i, (label, opener) in enumerate(sources):
+            for chunk in iter_gsc_chunks(label, opener, chunk_rows, ctr_percent=False):
+                ctr_max[label] = max(ctr_max[label], float(chunk['ctr'].max()) if len(chunk) else 0.0)
+                kept, chunk_audit = apply_filters(chunk, **filters)
+                for k in audit:
+                    audit[k] += chunk_audit[k]
+                slug_col = '_slug' if '_slug' in kept.columns else 'page'
+                sketch.update(_hash_column(kept['query']), _hash_column(kept[slug_col]))
+            trace.progress(i + 1, len(sources))
+        candidates = sketch.candidates()
+        rec['rows_in'], rec['rows_out'] = audit['before'], len(candidates)
+
+    with trace.stage('two-pass: collect', rows_in=audit['before']) as rec:
+        frames = []
+        for label, opener in sources:
+            parts = [chunk[sketch.contains(candidates, _hash_column(chunk['query']))]
+                     for chunk in iter_gsc_chunks(label, opener, chunk_rows,
+                                                  ctr_percent=ctr_max[label] > 1)]
+            if parts:
+                frames.append(pd.concat(parts, ignore_index=True))
+        pruned, _ = dedupe_overlapping_rows(frames) if frames else (pd.DataFrame(), 0)
+        rec['rows_out'] = len(pruned)
+
+    audit.update(rows_read=audit['before'], candidate_queries=len(candidates),
+                 rows_kept=len(pruned))
+    if pruned.empty:
+        return pd.DataFrame(), audit
+    filtered, _ = apply_filters(pruned, **filters, trace=trace)
+    return find_cannibalization(filtered, min_pages, trace=trace), audit
+
+
+# ── Incremental re-analysis ───────────────────────────────────────────────────
+
+def _splice(keep: pd.DataFrame, fresh: pd.DataFrame) -> pd.DataFrame:
+    if keep.empty or fresh.empty:
+        return fresh if keep.empty else keep
+    return pd.concat([keep, fresh], ignore_index=True)
+
+
+class IncrementalCannibalization:
+    """find_cannibalization and build_query_summary, kept current as inputs come and go.
+
+    Each input (a file, say) contributes its part_sums — additive sums of
+    its already-filtered rows per (dimensions, query, page) — under a key.
+    Adding, replacing or removing a part marks the part's queries as
+    touched. refresh() re-combines the parts for the touched queries only,
+    recomputes their cannibs and query_sum rows and splices them into the
+    previous results; every other query's rows are left as they were (only
+    the slug similarity, whose IDF spans all pages, is rescored — it's
+    vectorized and cheap). Totals are re-summed rather than patched by
+    subtraction, so they match a full recompute exactly.
+
+    Parts overlap the way uploads do — rolling date windows, re-exports —
+    and are combined like dedupe_overlapping_rows: a (query, page) row, per
+    value of the dimensions every part carries, counts once, from the first
+    part in key order that has it. Disjoint parts (one day or one property
+    each) simply add up.
+    """
+
+    PART_VERSION = 2  # bump when part_sums' layout changes, to invalidate stored parts
+
+    def __init__(self, min_pages: int):
+        self.min_pages = min_pages
+        self.parts: dict[str, pd.DataFrame] = {}
+        self.cannibs   = pd.DataFrame()
+        self.query_sum = pd.DataFrame()
+        self.touched: set[str] = set()
+
+    @staticmethod
+    def part_sums(filtered: pd.DataFrame, raw: pd.DataFrame | None = None) -> pd.DataFrame:
+        """One input's contribution, from apply_filters output.
+
+        Uploads are de-duplicated before they are filtered, so a row the
+        filters drop still hides a later file's copy of it. Pass the
+        unfiltered `raw` rows to keep that: their keys are added as empty
+        rows (rows == 0) that win overlaps but add nothing.
+        """
+        slug_col = '_slug' if '_slug' in filtered.columns else 'page'
+        keys = [*dimension_columns(filtered), 'query', 'page']
+        if slug_col == 'page':
+            sums = _pair_sums(filtered, keys)
+            sums = sums.set_index(sums.index.get_level_values('page').rename('slug'), append=True)
+        else:
+            sums = _pair_sums(filtered, [*keys, slug_col])
+            sums.index = sums.index.set_names('slug', level=slug_col)
+        if raw is None:
+            return sums
+        dropped = pd.MultiIndex.from_frame(raw[keys]).unique().difference(sums.index.droplevel('slug'))
+        if dropped.empty:
+            return sums
+        claims = pd.DataFrame(0, index=dropped, columns=sums.columns)
+        claims = claims.set_index(claims.index.get_level_values('page').rename('slug'), append=True)
+        return pd.concat([sums, claims])
+
+    def dims(self) -> list[str]:
+        """The GSC dimensions every part carries — what overlaps are keyed on."""
+        if not self.parts:
+            return []
+        return [d for d in GSC_DIMENSIONS if all(d in p.index.names for p in self.parts.values())]
+
+    def add(self, key: str, sums: pd.DataFrame) -> None:
+        """Add (or replace) the part stored under `key`."""
+        if key in self.parts:
+            self.remove(key)
+        dims = self.dims()
+        self.parts[key] = sums
+        self.touched.update(sums.index.get_level_values('query'))
+        self._check_dims(dims)
+
+    def remove(self, key: str) -> None:
+        dims = self.dims()
+        self.touched.update(self.parts.pop(key).index.get_level_values('query'))
+        self._check_dims(dims)
+
+    def _check_dims(self, before: list[str]) -> None:
+        # Changing the shared dimensions changes every query's de-duplication
+        if self.dims() != before:
+            for part in self.parts.values():
+                self.touched.update(part.index.get_level_values('query'))
+
+    def _combine(self, touched: pd.Index, dims: list[str]) -> pd.DataFrame:
+        """(query, slug) sums for the touched queries, overlaps counted once."""
+        pieces = []
+        for key in sorted(self.parts):
+            part = self.parts[key]
+            part = part[part.index.get_level_values('query').isin(touched)]
+            if part.empty:
+                continue
+            if len(part.index.names) > len(dims) + 3:
+                # Summing the extra dimensions away keeps a key with no kept rows a claim
+                part = part.groupby(level=[*dims, 'query', 'page', 'slug'], sort=False).sum()
+            pieces.append(part)
+        if not pieces:
+            return pd.DataFrame()
+        rows = pd.concat(pieces)
+        if len(pieces) > 1:
+            # Each part has a row once per key, so any repeat is a later part's overlap
+            rows = rows[~rows.index.droplevel('slug').duplicated(keep='first')]
+        rows = rows[rows['rows'] > 0]
+        return rows.groupby(level=['query', 'slug']).sum()
+
+    def refresh(self, trace=NULL_TRACE) -> int:
+        """Recompute results for the touched queries; returns how many there were."""
+        if not self.touched:
+            return 0
+        touched = pd.Index(sorted(self.touched))
+        with trace.stage('incremental: aggregate', rows_in=sum(map(len, self.parts.values()))) as rec:
+            sums  = self._combine(touched, self.dims())
+            fresh = (_finish_cannibalization(sums.reset_index(), self.min_pages)
+                     if not sums.empty else pd.DataFrame())
+            keep = (self.cannibs[~self.cannibs['query'].isin(touched)]
+                    if not self.cannibs.empty else self.cannibs)
+            cannibs = _splice(keep, fresh)
+            if not cannibs.empty:
+                # Tie-breaks reproduce find_cannibalization's (query, slug) order
+                cannibs = cannibs.sort_values(['competing_pages', 'impressions', 'query', 'slug'],
+                                              ascending=[False, False, True, True])
+            self.cannibs = cannibs
+            rec['rows_out'] = len(fresh)
+
+        fresh_qs = (build_query_summary(fresh, trace=trace, similarity=False)
+                    if not fresh.empty else pd.DataFrame())
+        if not fresh_qs.empty:
+            fresh_qs['_sev'] = severity_labels(fresh_qs['Best Average Position'], fresh_qs['Impressions'])
+        keep_qs = (self.query_sum[~self.query_sum['Query'].isin(touched)]
+                   if not self.query_sum.empty else self.query_sum)
+        query_sum = _splice(keep_qs, fresh_qs)
+        if not query_sum.empty:
+            query_sum = query_sum.sort_values(['Impressions', 'Query'], ascending=[False, True],
+                                              ignore_index=True)
+            # TF-IDF weights depend on every slug in the results, so this one is global
+            query_sum = add_similarity(query_sum, self.cannibs, trace=trace)
+        self.query_sum = query_sum
+        self.touched.clear()
+        return len(touched)
+
+
+# ── Period-over-period comparison ─────────────────────────────────────────────
+
+_PAIR_COLS = ['query', 'slug', 'clicks', 'impressions', 'position']
+
+
+def _period_frame(cannibs: pd.DataFrame, q_codes: np.ndarray, s_codes: np.ndarray,
+                  n_slugs: int) -> pd.DataFrame:
+    """One period's pairs keyed by a single int64 (query, slug) code."""
+    return pd.DataFrame({
+        'key':         q_codes.astype(np.int64) * n_slugs + s_codes,
+        'q':           q_codes,
+        'clicks':      cannibs['clicks'].to_numpy(),
+        'impressions': cannibs['impressions'].to_numpy(),
+        'position':    cannibs['position'].to_numpy(),
+    })
+
+
+def diff_cannibalization(prev: pd.DataFrame, curr: pd.DataFrame,
+                         trace=NULL_TRACE) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Compare two find_cannibalization results (previous vs current period).
+
+    Queries and slugs from both periods are factorized into shared integer
+    codes. Each (query, slug) pair becomes one int64 key, so both joins below
+    are hash joins on integers rather than on strings.
+
+    Returns (query_diff, pair_diff):
+      query_diff — one row per query: Status (New / Resolved / Persisting),
+                   Trend for persisting queries (Worsening / Improving /
+                   Unchanged, by competing-page count), and before/after/delta
+                   for competing pages, impressions, clicks and best position.
+      pair_diff  — one row per (query, slug): Change (Added / Removed / Kept)
+                   with before/after impressions and position.
+    """
+    prev = prev if not prev.empty else pd.DataFrame(columns=_PAIR_COLS)
+    curr = curr if not curr.empty else pd.DataFrame(columns=_PAIR_COLS)
+
+    with trace.stage('diff', rows_in=len(prev) + len(curr)) as rec:
+        q_codes, q_uniques = pd.factorize(pd.concat([prev['query'], curr['query']], ignore_index=True))
+        s_codes, s_uniques = pd.factorize(pd.concat([prev['slug'], curr['slug']], ignore_index=True))
+        n_prev, n_slugs = len(prev), max(len(s_uniques), 1)
+        left  = _period_frame(prev, q_codes[:n_prev], s_codes[:n_prev], n_slugs)
+        right = _period_frame(curr, q_codes[n_prev:], s_codes[n_prev:], n_slugs)
+
+        # ── Pair level ──
+        pairs = left.merge(right, on='key', how='outer', suffixes=('_prev', '_curr'),
+                           indicator=True, sort=False)
+        change = pairs['_merge'].map({'left_only': 'Removed', 'right_only': 'Added', 'both': 'Kept'})
+        q = pairs['q_prev'].fillna(pairs['q_curr']).to_numpy(dtype=np.int64)
+        pair_diff = pd.DataFrame({
+            'Query':                  q_uniques[q],
+            'Landing Page':           s_uniques[(pairs['key'] % n_slugs).to_numpy()],
+            'Change':                 change.astype(str).to_numpy(),
+            'Impressions (prev)':     pairs['impressions_prev'].fillna(0).astype(np.int64).to_numpy(),
+            'Impressions':            pairs['impressions_curr'].fillna(0).astype(np.int64).to_numpy(),
+            'Average Position (prev)': pairs['position_prev'].to_numpy(),
+            'Average Position':       pairs['position_curr'].to_numpy(),
+        })
+
+        # ── Query level ──
+        def per_query(side: pd.DataFrame) -> pd.DataFrame:
+            return side.groupby('q', sort=False).agg(
+                pages=('key', 'size'), impressions=('impressions', 'sum'),
+                clicks=('clicks', 'sum'), best_pos=('position', 'min'))
+
+        qd = per_query(left).join(per_query(right), how='outer', lsuffix='_prev', rsuffix='_curr')
+        moved = pd.DataFrame({'q': q, 'added': change.eq('Added').to_numpy(),
+                              'removed': change.eq('Removed').to_numpy()}).groupby('q').sum()
+        qd = qd.join(moved)
+
+        in_prev, in_curr = qd['pages_prev'].notna(), qd['pages_curr'].notna()
+        for c in ('pages', 'impressions', 'clicks'):
+            qd[f'{c}_prev'] = qd[f'{c}_prev'].fillna(0).astype(np.int64)
+            qd[f'{c}_curr'] = qd[f'{c}_curr'].fillna(0).astype(np.int64)
+        d_pages = qd['pages_curr'] - qd['pages_prev']
+        status  = np.select([in_prev & in_curr, in_curr], ['Persisting', 'New'], default='Resolved')
+        trend   = np.where(status != 'Persisting', '',
+                  np.select([d_pages > 0, d_pages < 0], ['Worsening', 'Improving'], default='Unchanged'))
+
+        query_diff = pd.DataFrame({
+            'Query':                    q_uniques[qd.index.to_numpy()],
+            'Status':                   status,
+            'Trend':                    trend,
+            'Competing Pages (prev)':   qd['pages_prev'].to_numpy(),
+            'Competing Pages':          qd['pages_curr'].to_numpy(),
+            'Δ Competing Pages':        d_pages.to_numpy(),
+            'Pages Added':              qd['added'].to_numpy(),
+            'Pages Removed':            qd['removed'].to_numpy(),
+            'Impressions (prev)':       qd['impressions_prev'].to_numpy(),
+            'Impressions':              qd['impressions_curr'].to_numpy(),
+            'Δ Impressions':            (qd['impressions_curr'] - qd['impressions_prev']).to_numpy(),
+            'Url Clicks (prev)':        qd['clicks_prev'].to_numpy(),
+            'Url Clicks':               qd['clicks_curr'].to_numpy(),
+            'Best Average Position (prev)': qd['best_pos_prev'].to_numpy(),
+            'Best Average Position':    qd['best_pos_curr'].to_numpy(),
+            'Δ Position':               (qd['best_pos_curr'] - qd['best_pos_prev']).round(1).to_numpy(),
+        })
+        # New and worsening conflicts first, resolved last; biggest first within each
+        rank = np.select([query_diff['Status'] == 'New', query_diff['Trend'] == 'Worsening',
+                          query_diff['Status'] == 'Persisting'], [0, 1, 2], default=3)
+        order = np.lexsort((-np.maximum(query_diff['Impressions'], query_diff['Impressions (prev)']), rank))
+        query_diff = query_diff.iloc[order].reset_index(drop=True)
+        rec['rows_out'] = len(query_diff)
+
+    return query_diff, pair_diff
+
+
+# ── Dimension drill-down ──────────────────────────────────────────────────────
+
+class CannibalizationCube:
+    """(query, slug) sums at combinations of the frame's GSC dimensions.
+
+    Built once per analysis from the filtered rows. Each rollup is indexed by
+    (*dims, query, slug) for one subset of the dimensions present and holds
+    the _pair_sums columns. Because sums add up, any selection of countries,
+    devices, etc. is answered from the rollup over exactly the selected
+    dimensions — one index lookup for single values, a mask and a regroup
+    for several — instead of re-filtering and re-grouping the raw rows.
+
+    Only the finest rollup (every dimension) is built up front; coarser ones
+    are summed from the smallest rollup already built that covers them, the
+    first time a selection needs them, and kept.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.dims = tuple(dimension_columns(df))
+        slug_col  = '_slug' if '_slug' in df.columns else 'page'
+        finest    = _pair_sums(df, [*self.dims, 'query', slug_col])
+        finest.index = finest.index.set_names('slug', level=slug_col)
+        self.rollups: dict[tuple[str, ...], pd.DataFrame] = {self.dims: finest.sort_index()}
+        self._lock = threading.Lock()
+
+        # Each dimension's values, biggest first — the drill-down choices
+        self.values = {
+            d: finest.groupby(level=d)['impressions'].sum()
+                     .sort_values(ascending=False, kind='stable').index.tolist()
+            for d in self.dims
+        }
+
+    def rollup(self, dims: tuple[str, ...]) -> pd.DataFrame:
+        """The rollup over `dims` (in cube order), summed on first use."""
+        with self._lock:
+            if dims not in self.rollups:
+                source = min((r for d, r in self.rollups.items() if set(dims) <= set(d)), key=len)
+                self.rollups[dims] = source.groupby(level=[*dims, 'query', 'slug']).sum().sort_index()
+            return self.rollups[dims]
+
+    def slice(self, selection: dict[str, list[str]], min_pages: int) -> pd.DataFrame:
+        """find_cannibalization restricted to the selected dimension values.
+
+        `selection` maps dimension → values to keep; missing or empty lists
+        mean "all". Equal to running find_cannibalization on the filtered rows
+        that match the selection.
+        """
+        sel  = {d: list(selection[d]) for d in self.dims if selection.get(d)}
+        dims = tuple(sel)
+        roll = self.rollup(dims)
+        if not dims:
+            base = roll
+        elif all(len(v) == 1 for v in sel.values()):
+            key = tuple(v[0] for v in sel.values())
+            try:
+                base = roll.xs(key if len(dims) > 1 else key[0],
+                               level=list(dims) if len(dims) > 1 else dims[0])
+            except KeyError:
+                return pd.DataFrame()
+        else:
+            mask = np.ones(len(roll), dtype=bool)
+            for d, values in sel.items():
+                mask &= roll.index.get_level_values(d).isin(values)
+            base = roll[mask].groupby(level=['query', 'slug']).sum()
+        return _finish_cannibalization(base.reset_index(), min_pages)
+
+
+def build_cube(df: pd.DataFrame, trace=NULL_TRACE) -> CannibalizationCube | None:
+    """CannibalizationCube over filtered rows, or None when they carry no dimensions."""
+    if df.empty or not dimension_columns(df):
+        return None
+    with trace.stage('cube', rows_in=len(df)) as rec:
+        cube = CannibalizationCube(df)
+        rec['rows_out'] = len(cube.rollups[cube.dims])
+    return cube
+
+
+def analyze(raw_df: pd.DataFrame, *, pos_min: float, pos_max: float,
+            min_impressions: int, min_clicks: int, min_pages: int,
+            filter_anchors: bool, filter_templates: bool, extra_templates: list[str] = (),
+            prev_raw_df: pd.DataFrame | None = None, cube: bool = False,
+            trace=NULL_TRACE) -> dict:
+    """The full analysis the Find button runs, for one set of sidebar settings.
+
+    Returns a dict with audit, cannibs, query_sum (with a '_sev' column),
+    rules_version, the template rules the filters ran with, ctr_curve
+    (fit_ctr_curve over every filtered row), and cube — with
+    `cube`, a CannibalizationCube for drilling into country/device/etc.
+    slices (sliced with the same min_pages, also returned); None otherwise
+    or when the export has no dimension columns.
+    When prev_raw_df is given it also holds compare ({query_diff, pair_diff})
+    and prev_trace, the previous period's stage records — even when no rows
+    survive the filters (audit['after'] is 0 and cannibs is empty), since
+    then every previous conflict counts as resolved.
+    """
+    # Shallow copies: apply_filters adds columns, and copy-on-write keeps the
+    # (possibly shared, see DatasetCache) input's data untouched
+    filtered_df, audit = apply_filters(
+        raw_df.copy(deep=False),
+        pos_min=pos_min, pos_max=pos_max,
+        min_impressions=min_impressions, min_clicks=min_clicks,
+        filter_anchors=filter_anchors, filter_templates=filter_templates,
+        extra_templates=extra_templates, trace=trace,
+    )
+    result = {'audit': audit, 'cannibs': pd.DataFrame(), 'query_sum': pd.DataFrame(),
+              'compare': None, 'prev_trace': None, 'rules_version': load_rules().version,
+              'cube': None, 'min_pages': min_pages, 'ctr_curve': DEFAULT_CTR_CURVE}
+    cannibs = result['cannibs']
+    if not filtered_df.empty:
+        cannibs = find_cannibalization(filtered_df, min_pages, trace=trace)
+        result['cannibs']   = cannibs
+        result['ctr_curve'] = fit_ctr_curve(filtered_df)
+        result['cube']    = build_cube(filtered_df, trace=trace) if cube else None
+        if not cannibs.empty:
+            query_sum = build_query_summary(cannibs, trace=trace)
+            query_sum['_sev'] = severity_labels(query_sum['Best Average Position'],
+                                                query_sum['Impressions'])
+            result['query_sum'] = query_sum
+
+    if prev_raw_df is not None:
+        prev_trace = trace.child(f"{getattr(trace, 'label', 'analysis')}: previous period")
+        prev_filtered, _ = apply_filters(
+            prev_raw_df.copy(deep=False),
+            pos_min=pos_min, pos_max=pos_max,
+            min_impressions=min_impressions, min_clicks=min_clicks,
+            filter_anchors=filter_anchors, filter_templates=filter_templates,
+            extra_templates=extra_templates, trace=prev_trace,
+        )
+        prev_cannibs = find_cannibalization(prev_filtered, min_pages, trace=prev_trace)
+        query_diff, pair_diff = diff_cannibalization(prev_cannibs, cannibs, trace=trace)
+        result['compare']    = {'query_diff': query_diff, 'pair_diff': pair_diff}
+        result['prev_trace'] = prev_trace
+
+    return result
+
+
+# ── Quick preview on a sample ─────────────────────────────────────────────────
+
+PREVIEW_SAMPLE_QUERIES = 10_000
+
+
+def stratified_query_sample(df: pd.DataFrame, max_queries: int = PREVIEW_SAMPLE_QUERIES,
+                            head_share: float = 0.5, strata: int = 10,
+                            seed: int = 0) -> tuple[pd.DataFrame, pd.Series]:
+    """Rows of a sample of whole queries, plus the weight of each sampled query.
+
+    Queries are ranked by total impressions. The top `head_share` of the budget
+    is taken outright with weight 1, so high-traffic queries are always in.
+    The rest of the budget is spread over `strata` equal-sized impression
+    bands of the remaining queries. Each band is sampled at the same rate,
+    and each query drawn from it stands for band size / draws queries.
+    Frames with no more than `max_queries` queries come back whole.
+    """
+    impr = (df.groupby('query', sort=False)['impressions'].sum()
+              .sort_values(ascending=False, kind='stable'))
+    if len(impr) <= max_queries:
+        return df, pd.Series(1.0, index=impr.index)
+
+    n_head = int(max_queries * head_share)
+    n_tail = len(impr) - n_head
+    budget = max_queries - n_head
+    band   = np.arange(n_tail) * strata // n_tail
+    rng    = np.random.default_rng(seed)
+    picks, weights = [np.arange(n_head)], [np.ones(n_head)]
+    for b in range(strata):
+        members = np.flatnonzero(band == b)
+        take    = min(len(members), max(1, round(budget * len(members) / n_tail)))
+        picks.append(n_head + rng.choice(members, take, replace=False))
+        weights.append(np.full(take, len(members) / take))
+
+    weights = pd.Series(np.concatenate(weights), index=impr.index[np.concatenate(picks)])
+    return df[df['query'].isin(weights.index)], weights
+
+
+def cannibalization_kpis(cannibs: pd.DataFrame, query_sum: pd.DataFrame,
+                         weights: pd.Series | None = None) -> dict:
+    """Headline numbers for the KPI cards.
+
+    With per-query `weights` from stratified_query_sample, counts and totals
+    are scaled up to estimates for the whole file. max_pages stays the
+    sample's own maximum. segments holds, per segmentation, queries, high
+    severity, impressions and clicks for each segment present, in the
+    rules file's order.
+    """
+    q_w = 1.0 if weights is None else query_sum['Query'].map(weights).to_numpy()
+    r_w = 1.0 if weights is None else cannibs['query'].map(weights).to_numpy()
+    sev = query_sum['_sev'].to_numpy()
+    q_w = np.broadcast_to(q_w, len(query_sum))
+    segments = {}
+    for col in segment_columns(query_sum):
+        by_seg = (pd.DataFrame({'segment': query_sum[col], 'queries': q_w,
+                                'high': q_w * (sev == 'High'),
+                                'impressions': query_sum['Impressions'].to_numpy() * q_w,
+                                'clicks': query_sum['Url Clicks'].to_numpy() * q_w})
+                    .groupby('segment', observed=True, sort=True).sum())
+        segments[col] = [{'segment': str(seg), **{k: float(v) for k, v in row.items()}}
+                         for seg, row in by_seg.iterrows()]
+    return {
+        'queries':     float(q_w.sum()),
+        'high':        float(q_w[sev == 'High'].sum()),
+        'medium':      float(q_w[sev == 'Medium'].sum()),
+        'low':         float(q_w[sev == 'Low'].sum()),
+        'impressions': float((cannibs['impressions'].to_numpy() * r_w).sum()),
+        'clicks':      float((cannibs['clicks'].to_numpy() * r_w).sum()),
+        'avg_pages':   round(float(np.average(query_sum['Competing Pages'], weights=q_w)), 1),
+        'max_pages':   int(cannibs['competing_pages'].max()),
+        'segments':    segments,
+    }
+
+
+def analyze_preview(raw_df: pd.DataFrame, *, sample_queries: int = PREVIEW_SAMPLE_QUERIES,
+                    seed: int = 0, trace=NULL_TRACE, **params) -> dict:
+    """analyze() on a stratified query sample, for a first look at a huge file.
+
+    Takes analyze()'s keyword arguments (the previous period is left for the
+    exact run). Returns analyze()'s dict, with audit, cannibs and query_sum
+    covering only the sample. It adds estimate (cannibalization_kpis scaled
+    to the whole file, or None) and sample ({queries, of_queries, rows,
+    of_rows}).
+    """
+    params.pop('prev_raw_df', None)
+    params['cube'] = False  # drill-down waits for the exact run
+    with trace.stage('sample', rows_in=len(raw_df)) as rec:
+        sample, weights = stratified_query_sample(raw_df, sample_queries, seed=seed)
+        rec['rows_out'] = len(sample)
+    result = analyze(sample, trace=trace, **params)
+    result['estimate'] = (None if result['query_sum'].empty else
+                          cannibalization_kpis(result['cannibs'], result['query_sum'], weights))
+    result['sample'] = {'queries': len(weights), 'of_queries': int(round(weights.sum())),
+                        'rows': len(sample), 'of_rows': len(raw_df)}
+    return result
+
+
+# ── Analysis snapshots ────────────────────────────────────────────────────────
+
+# Finished analyses are kept here so a run ID can be reopened without the uploads
+SNAPSHOT_PATH = Path(os.environ.get(
+    'KCF_SNAPSHOTS', Path(__file__).resolve().parent / 'logs' / 'snapshots.sqlite'))
+
+_SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id        TEXT PRIMARY KEY,
+    created       REAL NOT NULL,
+    last_used     REAL NOT NULL,
+    fingerprint   TEXT NOT NULL,
+    settings_key  TEXT NOT NULL,
+    rules_version TEXT,
+    settings      TEXT NOT NULL,
+    audit         TEXT NOT NULL,
+    queries       INTEGER NOT NULL,
+    bytes         INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_inputs ON runs (fingerprint, settings_key);
+CREATE TABLE IF NOT EXISTS frames (
+    run_id TEXT NOT NULL,
+    name   TEXT NOT NULL,
+    data   BLOB NOT NULL,
+    PRIMARY KEY (run_id, name)
+);
+"""
+
+
+# The analyze() settings a saved run is matched on (descriptive extras like file names aren't)
+ANALYSIS_PARAMS = ('pos_min', 'pos_max', 'min_impressions', 'min_clicks', 'min_pages',
+                   'filter_anchors', 'filter_templates', 'extra_templates')
+
+
+class SnapshotError(RuntimeError):
+    """The snapshot store couldn't be read or written."""
+
+
+def fingerprint_uploads(uploads: list[tuple[str, bytes]]) -> str:
+    """SHA-256 of the uploaded bytes, in upload order (file names don't count)."""
+    h = hashlib.sha256()
+    for _, data in uploads:
+        h.update(len(data).to_bytes(8, 'little'))
+        h.update(data)
+    return h.hexdigest()
+
+
+class SnapshotStore:
+    """Finished analyses in one SQLite file, keyed by run ID.
+
+    A run holds its inputs' fingerprint, the filter settings, the audit
+    counts and the result frames (cannibs, query_sum and any period
+    comparison), each stored as a Parquet blob. Saving the same inputs with
+    the same ANALYSIS_PARAMS and rules returns the existing run instead of
+    a copy.
+
+    Every save enforces the retention limits — runs unused for
+    `max_age_days`, then the least recently used beyond `max_runs` or
+    `max_bytes` — and hands the freed pages back to the filesystem with an
+    incremental vacuum, so the file stays bounded.
+    """
+
+    def __init__(self, path: Path | str = SNAPSHOT_PATH, max_runs: int = 200,
+                 max_bytes: int = 1 << 30, max_age_days: float = 90):
+        self.path         = Path(path)
+        self.max_runs     = max_runs
+        self.max_bytes    = max_bytes
+        self.max_age_days = max_age_days
+
+    @contextmanager
+    def _connect(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            con = sqlite3.connect(self.path, timeout=30)
+        except (OSError, sqlite3.Error) as e:
+            raise SnapshotError(f"can't open {self.path}: {e}") from e
+        try:
+            # auto_vacuum only takes effect on a file that has no tables yet
+            con.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            con.executescript(_SNAPSHOT_SCHEMA)
+            with con:
+                yield con
+        except sqlite3.Error as e:
+            raise SnapshotError(str(e)) from e
+        finally:
+            con.close()
+
+    @staticmethod
+    def settings_key(settings: dict, rules_version: str | None) -> str:
+        params = {k: settings.get(k) for k in ANALYSIS_PARAMS}
+        blob = json.dumps({'settings': params, 'rules': rules_version,
+                           'aggregation': AGGREGATION_VERSION}, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode()).hexdigest()[:16]
+
+    def find(self, fingerprint: str, settings: dict, rules_version: str | None) -> str | None:
+        """Run ID of a saved analysis of these inputs with these settings, if there is one."""
+        with self._connect() as con:
+            row = con.execute('SELECT run_id FROM runs WHERE fingerprint = ? AND settings_key = ?',
+                              (fingerprint, self.settings_key(settings, rules_version))).fetchone()
+        return row[0] if row else None
+
+    def save(self, result: dict, *, fingerprint: str, settings: dict,
+             run_id: str | None = None, trace=NULL_TRACE) -> str:
+        """Persist an analyze() result and return its run ID."""
+        key = self.settings_key(settings, result.get('rules_version'))
+        with trace.stage('snapshot: save', rows_in=len(result['cannibs'])) as rec, \
+                self._connect() as con:
+            row = con.execute('SELECT run_id FROM runs WHERE fingerprint = ? AND settings_key = ?',
+                              (fingerprint, key)).fetchone()
+            if row is not None:
+                con.execute('UPDATE runs SET last_used = ? WHERE run_id = ?', (time.time(), row[0]))
+                return row[0]
+
+            frames = {'cannibs': result['cannibs'], 'query_sum': result['query_sum']}
+            if result.get('ctr_curve') is not None:
+                frames['ctr_curve'] = pd.DataFrame([result['ctr_curve']], columns=['a', 'b'])
+            if result.get('compare') is not None:
+                frames.update({f'compare.{k}': v for k, v in result['compare'].items()})
+            try:
+                blobs = {name: df.to_parquet(compression='zstd') for name, df in frames.items()}
+            except ImportError as e:
+                raise SnapshotError(f"Parquet support unavailable: {e}") from e
+
+            run_id = run_id or uuid.uuid4().hex[:12]
+            now    = time.time()
+            con.execute(
+                'INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (run_id, now, now, fingerprint, key, result.get('rules_version'),
+                 json.dumps(settings, default=str),
+                 json.dumps(result['audit'], default=lambda o: o.item()),
+                 len(result['query_sum']), sum(len(b) for b in blobs.values())))
+            con.executemany('INSERT INTO frames VALUES (?, ?, ?)',
+                            [(run_id, name, blob) for name, blob in blobs.items()])
+            self._enforce_retention(con, keep=run_id)
+            rec['rows_out'] = len(result['cannibs'])
+        self._compact()
+        return run_id
+
+    def load(self, run_id: str, trace=NULL_TRACE) -> dict | None:
+        """The saved run as an analyze()-shaped result, or None if it's unknown or expired.
+
+        The dimension cube isn't saved, so `cube` is None; so is `ctr_curve`
+        for runs saved without one. The result also carries `snapshot`:
+        run_id, created, fingerprint and settings.
+        """
+        with trace.stage('snapshot: load') as rec, self._connect() as con:
+            meta = con.execute(
+                'SELECT created, fingerprint, rules_version, settings, audit FROM runs WHERE run_id = ?',
+                (run_id,)).fetchone()
+            if meta is None:
+                return None
+            con.execute('UPDATE runs SET last_used = ? WHERE run_id = ?', (time.time(), run_id))
+            frames = {name: pd.read_parquet(BytesIO(blob)) for name, blob in
+                      con.execute('SELECT name, data FROM frames WHERE run_id = ?', (run_id,))}
+            rec['rows_out'] = len(frames['cannibs'])
+
+        created, fingerprint, rules_version, settings, audit = meta
+        settings = json.loads(settings)
+        compare  = {name.split('.', 1)[1]: df for name, df in frames.items() if name.startswith('compare.')}
+        return {
+            'audit':         json.loads(audit),
+            'cannibs':       frames['cannibs'],
+            'query_sum':     frames['query_sum'],
+            'compare':       compare or None,
+            'prev_trace':    None,
+            'rules_version': rules_version,
+            'cube':          None,
+            'min_pages':     settings.get('min_pages'),
+            'ctr_curve':     (tuple(map(float, frames['ctr_curve'].iloc[0]))
+                              if 'ctr_curve' in frames else None),
+            'snapshot':      {'run_id': run_id, 'created': created,
+                              'fingerprint': fingerprint, 'settings': settings},
+        }
+
+    def runs(self, limit: int = 20) -> pd.DataFrame:
+        """The most recently used runs: run_id, created, last_used, queries, settings."""
+        with self._connect() as con:
+            rows = con.execute('SELECT run_id, created, last_used, queries, settings FROM runs '
+                               'ORDER BY last_used DESC LIMIT ?', (limit,)).fetchall()
+        out = pd.DataFrame(rows, columns=['run_id', 'created', 'last_used', 'queries', 'settings'])
+        out['settings'] = out['settings'].map(json.loads)
+        return out
+
+    def _enforce_retention(self, con: sqlite3.Connection, keep: str) -> None:
+        """Delete expired and least-recently-used runs, never `keep`."""
+        rows = con.execute('SELECT run_id, last_used, bytes FROM runs '
+                           'ORDER BY run_id = ? DESC, last_used DESC', (keep,)).fetchall()
+        cutoff = time.time() - self.max_age_days * 86400
+        total, drop = 0, []
+        for i, (run_id, last_used, size) in enumerate(rows):
+            total += size
+            if i and (i >= self.max_runs or total > self.max_bytes or last_used < cutoff):
+                drop.append((run_id,))
+        con.executemany('DELETE FROM frames WHERE run_id = ?', drop)
+        con.executemany('DELETE FROM runs WHERE run_id = ?', drop)
+
+    def _compact(self) -> None:
+        """Return free pages to the filesystem once they're a quarter of the file."""
+        with self._connect() as con:
+            free, pages = (con.execute(f'PRAGMA {p}').fetchone()[0] for p in ('freelist_count', 'page_count'))
+            if free and free * 4 >= pages:
+                # executescript steps the pragma to completion; execute() frees one page
+                con.executescript('PRAGMA incremental_vacuum;')
+
+
+def analyze_and_save(*, store: SnapshotStore, fingerprint: str, settings: dict,
+                     trace=NULL_TRACE, **params) -> dict:
+    """analyze(), then save the result as a snapshot under the trace's run ID.
+
+    The result also carries `settings`. A failed save doesn't fail the
+    analysis — the result just has no run_id and carries snapshot_error
+    instead.
+    """
+    result = analyze(trace=trace, **params)
+    result['settings'] = settings
+    try:
+        result['run_id'] = store.save(result, fingerprint=fingerprint, settings=settings,
+                                      run_id=getattr(trace, 'run_id', None), trace=trace)
+    except SnapshotError as e:
+        result['run_id'], result['snapshot_error'] = None, str(e)
+    return result
+
+
+# ── Page metadata enrichment ──────────────────────────────────────────────────
+
+# Fetched titles / H1s / canonicals, so re-opening a run doesn't re-crawl the site
+PAGE_META_PATH = Path(os.environ.get(
+    'KCF_PAGE_META', Path(__file__).resolve().parent / 'logs' / 'page_meta.sqlite'))
+PAGE_META_USER_AGENT = 'KeywordCannibalizationFinder/1.0 (+page metadata check)'
+# URLs come from uploaded data, so loopback / private / link-local hosts are refused
+# unless KCF_FETCH_PRIVATE=1 (e.g. auditing a staging site on the intranet)
+PAGE_META_ALLOW_PRIVATE = os.environ.get('KCF_FETCH_PRIVATE', '') not in ('', '0')
+_FETCH_SCHEMES = ('http', 'https')
+
+_PAGE_META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    url       TEXT PRIMARY KEY,
+    fetched   REAL NOT NULL,
+    status    INTEGER,
+    title     TEXT,
+    h1        TEXT,
+    canonical TEXT,
+    error     TEXT
+);
+"""
+_PAGE_META_FIELDS = ('status', 'title', 'h1', 'canonical', 'error')
+
+
+class _PageMetaParser(HTMLParser):
+    """<title>, the first <h1> and <link rel="canonical"> of one HTML page."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = self.h1 = self.canonical = None
+        self._open, self._text = None, []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('title', 'h1') and self._open is None and getattr(self, tag) is None:
+            self._open, self._text = tag, []
+        elif tag == 'link' and self.canonical is None:
+            a = dict(attrs)
+            if 'canonical' in (a.get('rel') or '').lower().split():
+                self.canonical = a.get('href')
+
+    def handle_endtag(self, tag):
+        if tag == self._open:
+            setattr(self, tag, ' '.join(''.join(self._text).split()))
+            self._open = None
+
+    def handle_data(self, data):
+        if self._open is not None:
+            self._text.append(data)
+
+
+def _is_public_address(ip: str) -> bool:
+    """Globally routable unicast — not loopback, link-local, private or reserved."""
+    addr = ipaddress.ip_address(ip)
+    if addr.version == 6 and addr.ipv4_mapped:
+        addr = addr.ipv4_mapped
+    return addr.is_global and not addr.is_multicast
+
+
+def _public_connection(address, timeout, source_address=None) -> socket.socket:
+    """socket.create_connection that only dials public addresses.
+
+    The check applies to the address actually connected to, so a host name
+    can't pass it and then re-resolve to 127.0.0.1, and every redirect hop
+    is covered too.
+    """
+    host, port = address
+    err = None
+    for family, type_, proto, _, sockaddr in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        if not _is_public_address(sockaddr[0]):
+            err = OSError(f"blocked: {host} resolves to non-public address {sockaddr[0]}")
+            continue
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            sock.close()
+            err = e
+    raise err or OSError(f"no address for {host}")
+
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _public_connection
+
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _public_connection
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req, context=self._context)
+
+
+def _page_meta_opener(allow_private: bool) -> urllib.request.OpenerDirector:
+    """An http(s)-only opener: no file:, ftp: or data: handlers and no proxies."""
+    opener = urllib.request.OpenerDirector()
+    handlers = ((urllib.request.HTTPHandler, urllib.request.HTTPSHandler) if allow_private
+                else (_PublicHTTPHandler, _PublicHTTPSHandler))
+    for handler in (*handlers, urllib.request.HTTPRedirectHandler, urllib.request.UnknownHandler,
+                    urllib.request.HTTPDefaultErrorHandler, urllib.request.HTTPErrorProcessor):
+        opener.add_handler(handler())
+    return opener
+
+
+def _fetch_page_meta(url: str, timeout_s: float, max_bytes: int,
+                     allow_private: bool = False) -> dict:
+    """GET one page (following redirects) and parse its metadata. Never raises.
+
+    The timeout is per socket operation and for the whole body read, so a
+    server trickling bytes can't hold the worker past ~2× timeout_s. Only
+    http(s) URLs on public addresses are fetched unless `allow_private`.
+    """
+    scheme = urlsplit(url).scheme.lower()
+    if scheme not in _FETCH_SCHEMES:
+        return {'status': None, 'error': f"unsupported URL scheme: {scheme or '(none)'}"}
+    deadline = time.monotonic() + timeout_s
+    req = urllib.request.Request(url, headers={'User-Agent': PAGE_META_USER_AGENT,
+                                               'Accept': 'text/html,application/xhtml+xml'})
+    try:
+        with _page_meta_opener(allow_private).open(req, timeout=timeout_s) as resp:
+            status  = resp.status
+            ctype   = resp.headers.get_content_type()
+            charset = resp.headers.get_content_charset() or 'utf-8'
+            final   = resp.url
+            chunks, size = [], 0
+            while size < max_bytes:
+                if time.monotonic() > deadline:
+                    raise TimeoutError('timed out')
+                chunk = resp.read1(min(65536, max_bytes - size))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+    except urllib.error.HTTPError as e:
+        return {'status': e.code, 'error': f"HTTP {e.code}"}
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        return {'status': None, 'error': str(getattr(e, 'reason', e))}
+    if ctype not in ('text/html', 'application/xhtml+xml'):
+        return {'status': status, 'error': f"not HTML ({ctype})"}
+    try:
+        html = b''.join(chunks).decode(charset, errors='replace')
+    except LookupError:
+        html = b''.join(chunks).decode('utf-8', errors='replace')
+    parser = _PageMetaParser()
+    parser.feed(html)
+    parser.close()
+    return {'status': status, 'title': parser.title, 'h1': parser.h1, 'error': None,
+            'canonical': urljoin(final, parser.canonical) if parser.canonical else None}
+
+
+class PageMetaFetcher:
+    """Title, H1 and canonical tag of many pages, fetched concurrently and cached on disk.
+
+    Fetches run on an asyncio loop, each blocking urllib request in a worker
+    thread: at most `per_host` requests to one host at a time and
+    `max_concurrent` overall. Results — failures included — are cached in
+    SQLite for `ttl_s` (`error_ttl_s` for failures), so only new or expired
+    URLs go to the network. Loopback, private and link-local hosts are
+    refused unless `allow_private` (default: KCF_FETCH_PRIVATE).
+    """
+
+    def __init__(self, path: Path | str = PAGE_META_PATH, ttl_s: float = 7 * 86400,
+                 error_ttl_s: float = 3600, per_host: int = 4, max_concurrent: int = 32,
+                 timeout_s: float = 10, max_bytes: int = 1 << 20,
+                 allow_private: bool | None = None):
+        self.path           = Path(path)
+        self.ttl_s          = ttl_s
+        self.error_ttl_s    = error_ttl_s
+        self.per_host       = per_host
+        self.max_concurrent = max_concurrent
+        self.timeout_s      = timeout_s
+        self.max_bytes      = max_bytes
+        self.allow_private  = PAGE_META_ALLOW_PRIVATE if allow_private is None else allow_private
+
+    @contextmanager
+    def _connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            con.executescript(_PAGE_META_SCHEMA)
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def fetch(self, urls: list[str], trace=NULL_TRACE) -> pd.DataFrame:
+        """One row per distinct URL: url, status, title, h1, canonical, error, cached."""
+        urls = list(dict.fromkeys(urls))
+        with trace.stage('page meta: cache', rows_in=len(urls)) as rec:
+            cached = self._cached(urls)
+            rec['rows_out'] = len(cached)
+        todo = [u for u in urls if u not in cached]
+        with trace.stage('page meta: fetch', rows_in=len(todo)) as rec:
+            fresh = asyncio.run(self._fetch_all(todo, trace)) if todo else {}
+            self._store(fresh)
+            rec['rows_out'] = sum(r['error'] is None for r in fresh.values())
+        rows = [{'url': u, **dict.fromkeys(_PAGE_META_FIELDS), **cached.get(u, fresh.get(u, {})),
+                 'cached': u in cached} for u in urls]
+        out = pd.DataFrame(rows, columns=['url', *_PAGE_META_FIELDS, 'cached'])
+        out['status'] = out['status'].astype('Int64')
+        return out
+
+    async def _fetch_all(self, urls: list[str], trace) -> dict[str, dict]:
+        loop = asyncio.get_running_loop()
+        # asyncio.run shuts this pool down on exit; the default one is sized by CPU count
+        loop.set_default_executor(ThreadPoolExecutor(self.max_concurrent,
+                                                     thread_name_prefix='kcf-fetch'))
+        overall = asyncio.Semaphore(self.max_concurrent)
+        hosts: dict[str, asyncio.Semaphore] = {}
+        done = 0
+
+        async def one(url: str) -> tuple[str, dict]:
+            nonlocal done
+            host = hosts.setdefault(urlsplit(url).netloc.lower(), asyncio.Semaphore(self.per_host))
+            async with overall, host:
+                result = await asyncio.to_thread(_fetch_page_meta, url, self.timeout_s,
+                                                 self.max_bytes, self.allow_private)
+            done += 1
+            trace.progress(done, len(urls))
+            return url, result
+
+        return dict(await asyncio.gather(*(one(u) for u in urls)))
+
+    def _cached(self, urls: list[str]) -> dict[str, dict]:
+        now, out = time.time(), {}
+        with self._connect() as con:
+            for i in range(0, len(urls), 500):
+                batch = urls[i:i + 500]
+                rows = con.execute(
+                    f"SELECT url, fetched, {', '.join(_PAGE_META_FIELDS)} FROM pages "
+                    f"WHERE url IN ({', '.join('?' * len(batch))})", batch).fetchall()
+                for url, fetched, *fields in rows:
+                    entry = dict(zip(_PAGE_META_FIELDS, fields))
+                    ttl = self.ttl_s if entry['error'] is None else self.error_ttl_s
+                    if now - fetched < ttl:
+                        out[url] = entry
+        return out
+
+    def _store(self, results: dict[str, dict]) -> None:
+        now = time.time()
+        with self._connect() as con:
+            con.executemany(
+                f"INSERT OR REPLACE INTO pages (url, fetched, {', '.join(_PAGE_META_FIELDS)}) "
+                f"VALUES (?, ?, {', '.join('?' * len(_PAGE_META_FIELDS))})",
+                [(u, now, *(r.get(f) for f in _PAGE_META_FIELDS)) for u, r in results.items()])
+            con.execute('DELETE FROM pages WHERE fetched < ?', (now - max(self.ttl_s, self.error_ttl_s),))
+
+
+def landing_page_urls(slugs, raw_df: pd.DataFrame | None = None,
+                      site_root: str | None = None) -> dict[str, str]:
+    """A fetchable URL for each cannibs slug.
+
+    Slugs that are already URLs (template filtering off) are used as they
+    are. Otherwise the slug's first page URL in the raw data is used, and
+    failing that site_root + slug. Slugs with none of these, or whose URL
+    isn't http(s), are left out.
+    """
+    slugs = pd.Index(pd.unique(pd.Series(slugs, dtype=object)))
+    urls = {}
+    if raw_df is not None and not raw_df.empty:
+        pages = pd.Series(pd.unique(raw_df['page'].unique().astype(str)))
+        pages = pd.Series(pd.unique(pages.str.split('#').str[0]))
+        by_slug = pd.Series(pages.to_numpy(), index=pages.map(get_base_slug))
+        by_slug = by_slug[~by_slug.index.duplicated()]
+        urls.update(by_slug[by_slug.index.isin(slugs)].to_dict())
+    for slug in slugs:
+        if slug in urls:
+            continue
+        if re.match(r'https?://', slug):
+            urls[slug] = slug.split('#')[0]
+        elif site_root:
+            urls[slug] = urljoin(site_root.rstrip('/') + '/', slug)
+    return {s: u for s, u in urls.items() if urlsplit(u).scheme.lower() in _FETCH_SCHEMES}
+
+
+def fetch_page_meta(cannibs: pd.DataFrame, fetcher: PageMetaFetcher,
+                    raw_df: pd.DataFrame | None = None, site_root: str | None = None,
+                    limit: int | None = None, trace=NULL_TRACE) -> pd.DataFrame:
+    """Title / H1 / canonical per cannibs slug, keyed by slug (PipelineJob target).
+
+    URLs come from landing_page_urls(). With `limit`, only that many slugs
+    are fetched — those with the most impressions across their competing
+    queries.
+    """
+    with trace.stage('page meta: urls', rows_in=None if raw_df is None else len(raw_df)) as rec:
+        urls = landing_page_urls(cannibs['slug'], raw_df, site_root)
+        rec['rows_out'] = len(urls)
+    by_impr = cannibs.groupby('slug', observed=True, sort=False)['impressions'].sum()
+    slugs = [s for s in by_impr.sort_values(ascending=False, kind='stable').index if s in urls]
+    slugs = slugs[:limit]
+    fetched = fetcher.fetch([urls[s] for s in slugs], trace=trace).set_index('url')
+    meta = fetched.reindex([urls[s] for s in slugs])
+    meta.index = pd.Index(slugs, name='slug')
+    return meta.reset_index()
+
+
+def with_page_meta(detail: pd.DataFrame, meta: pd.DataFrame, slug_col: str = 'Landing Page') -> pd.DataFrame:
+    """Detail rows plus Title, H1, Canonical and Page Status columns from fetch_page_meta."""
+    m = meta.set_index('slug')
+    status = m['error'].where(m['error'].notna(), m['status'].astype(str))
+    slugs = detail[slug_col]
+    return detail.assign(**{
+        'Title':       slugs.map(m['title']),
+        'H1':          slugs.map(m['h1']),
+        'Canonical':   slugs.map(m['canonical']),
+        'Page Status': slugs.map(status),
+    })
+
+
+def export_tables(cannibs: pd.DataFrame, query_sum: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    """The report's two sheets, with export labels: Query Summary and Detail View (with Severity)."""
+    detail = rename_for_display(cannibs)
+    if not detail.empty:
+        detail.insert(2, 'Severity', severity_labels(detail['Average Position'], detail['Impressions']))
+    return {'Query Summary': query_sum.drop(columns=['_sev'], errors='ignore'), 'Detail View': detail}
+
+
+def to_excel(df_dict: dict) -> bytes:
+    """Export multiple DataFrames to a single xlsx."""
+    buf = BytesIO()
+    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
+        for sheet, df in df_dict.items():
+            df.to_excel(writer, sheet_name=sheet[:31], index=False)
+    return buf.getvalue()
+
+
+def to_csv(df: pd.DataFrame) -> bytes:
+    return df.to_csv(index=False, encoding='utf-8-sig').encode('utf-8-sig')
+
+
+def generate_high_severity_docx(cannibs: pd.DataFrame,
+                                 query_sum_df: pd.DataFrame,
+                                 redirects: pd.DataFrame | None = None) -> bytes:
+    """
+    Generate a Word .docx report matching the High Severity tab layout:
+    - Cover section with summary stats
+    - One section per query: position / impressions header, URL table, suggested action
+
+    Suggested actions follow the site-wide redirect map (`redirects`, built
+    from cannibs when not given), so a page is never told to merge into two
+    different winners.
+    """
+    import subprocess, json, tempfile, os
+
+    high_queries = query_sum_df[query_sum_df['_sev'] == 'High']['Query'].tolist()
+    if not high_queries:
+        return b""
+    if redirects is None:
+        redirects = build_redirect_map(cannibs)[0]
+    redirect_to = dict(zip(redirects['Redirect From'], redirects['Redirect To']))
+
+    # Build data structure to pass to JS
+    report_data = []
+    for q in high_queries:
+        qdata = cannibs[cannibs['query'] == q].copy()
+        qdata['_score'] = qdata['impressions'] + (qdata['clicks'] * 10)
+        qdata = qdata.sort_values('_score', ascending=False)
+        best_slug = qdata.iloc[0]['slug']
+        plan      = query_redirects(qdata['slug'].tolist(), redirect_to)
+        best_pos  = round(float(qdata['position'].min()), 1)
+        total_imp = int(qdata['impressions'].sum())
+        rows = []
+        for _, r in qdata.iterrows():
+            rows.append({
+                'slug':      str(r['slug']),
+                'clicks':    int(r['clicks']),
+                'impressions': int(r['impressions']),
+                'ctr':       round(float(r['ctr']), 2),
+                'position':  round(float(r['position']), 1),
+                'competing': int(r['competing_pages']),
+                'isBest':    str(r['slug']) == best_slug,
+            })
+        report_data.append({
+            'query':      q,
+            'into':       [{'target': t, 'slugs': f} for t, f in plan['into']],
+            'kept':       plan['kept'],
+            'winner':     plan['winner'],
+            'bestPos':    best_pos,
+            'totalImp':   total_imp,
+            'numPages':   len(qdata),
+            'rows':       rows,
+        })
+
+    # Summary stats
+    summary = {
+        'totalHigh':   len(high_queries),
+        'totalImp':    int(query_sum_df[query_sum_df['_sev']=='High']['Impressions'].sum()),
+        'totalClicks': int(query_sum_df[query_sum_df['_sev']=='High']['Url Clicks'].sum()),
+        'date':        pd.Timestamp.now().strftime('%B %d, %Y'),
+    }
+
+    payload = json.dumps({'summary': summary, 'queries': report_data})
+
+    # Write JS script
+    js_script = r"""
+const fs = require('fs');
+const {
+  Document, Packer, Paragraph, TextRun, Table, TableRow, TableCell,
+  AlignmentType, BorderStyle, WidthType, ShadingType, VerticalAlign,
+} = require('docx');
+
+const data    = JSON.parse(fs.readFileSync(process.argv[2], 'utf8'));
+const summary = data.summary;
+const queries = data.queries;
+
+const NAVY='0F2340', BLUE='1B4F8A', MID_BLUE='2E6DA4', ORANGE='E8651A';
+const WHITE='FFFFFF', BEST_BG='E8F5EE', TABLE_HD='1B4F8A';
+const thinBorder = { style: BorderStyle.SINGLE, size: 1, color: 'D4DFE9' };
+const cellBorder = { top: thinBorder, bottom: thinBorder, left: thinBorder, right: thinBorder };
+
+function spacer(pts) {
+  return new Paragraph({ children:[new TextRun('')], spacing:{before:pts*20,after:0} });
+}
+function sectionRule(color) {
+  return new Paragraph({
+    border:{ bottom:{style:BorderStyle.SINGLE, size:6, color:color||ORANGE, space:1} },
+    spacing:{before:0,after:120}, children:[],
+  });
+}
+function hdrCell(text, width) {
+  return new TableCell({
+    borders:cellBorder, width:{size:width,type:WidthType.DXA},
+    shading:{fill:TABLE_HD, type:ShadingType.CLEAR},
+    margins:{top:80,bottom:80,left:100,right:100},
+    children:[new Paragraph({children:[new TextRun({text,bold:true,color:WHITE,size:18,font:'Arial'})]})],
+  });
+}
+function dataCell(text, width, isBest, alignRight) {
+  return new TableCell({
+    borders:cellBorder, width:{size:width,type:WidthType.DXA},
+    shading:{fill:isBest?BEST_BG:WHITE, type:ShadingType.CLEAR},
+    margins:{top:60,bottom:60,left:100,right:100},
+    children:[new Paragraph({
+      alignment:alignRight?AlignmentType.RIGHT:AlignmentType.LEFT,
+      children:[new TextRun({text:String(text),size:18,font:'Arial',bold:isBest,color:isBest?'1A6B3A':'1A1A2E'})],
+    })],
+  });
+}
+function kpiCell(label, value, width) {
+  return new TableCell({
+    borders:cellBorder, width:{size:width,type:WidthType.DXA},
+    shading:{fill:'D6E8F5', type:ShadingType.CLEAR},
+    margins:{top:100,bottom:100,left:140,right:140},
+    children:[
+      new Paragraph({children:[new TextRun({text:String(value),bold:true,size:32,font:'Arial',color:NAVY})]}),
+      new Paragraph({children:[new TextRun({text:label,size:16,font:'Arial',color:'5A7FA0'})]}),
+    ],
+  });
+}
+
+const children = [];
+
+// Title block
+children.push(new Paragraph({
+  children:[new TextRun({text:'Edstellar  ·  Keyword Cannibalization Report',size:20,font:'Arial',bold:true,color:WHITE})],
+  shading:{fill:NAVY,type:ShadingType.CLEAR},
+  spacing:{before:0,after:0}, indent:{left:200},
+}));
+children.push(new Paragraph({
+  children:[new TextRun({text:'High Severity Issues — Urgent Fixes',size:48,bold:true,font:'Arial',color:WHITE})],
+  shading:{fill:NAVY,type:ShadingType.CLEAR},
+  spacing:{before:120,after:0}, indent:{left:200},
+}));
+children.push(new Paragraph({
+  children:[new TextRun({text:'Best position ≤10  ·  Impressions ≥1,000  ·  Generated: '+summary.date,size:20,font:'Arial',color:'FFB380'})],
+  shading:{fill:NAVY,type:ShadingType.CLEAR},
+  spacing:{before:80,after:280}, indent:{left:200},
+}));
+
+// KPI row
+const kpiW = Math.floor(9360/3);
+children.push(new Table({
+  width:{size:9360,type:WidthType.DXA}, columnWidths:[kpiW,kpiW,9360-kpiW*2],
+  rows:[new TableRow({children:[
+    kpiCell('High Severity Queries', summary.totalHigh, kpiW),
+    kpiCell('Total Impressions at Stake', summary.totalImp.toLocaleString(), kpiW),
+    kpiCell('Total Clicks at Stake', summary.totalClicks.toLocaleString(), 9360-kpiW*2),
+  ]})],
+}));
+children.push(spacer(10));
+children.push(new Paragraph({
+  children:[new TextRun({text:'🚨  These queries rank on page 1 but split click potential across multiple URLs. Consolidating them will have the most direct impact on organic traffic.',size:18,font:'Arial',color:'5A3000',italics:true})],
+  shading:{fill:'FDE8D8',type:ShadingType.CLEAR},
+  border:{left:{style:BorderStyle.SINGLE,size:16,color:ORANGE}},
+  indent:{left:200,right:200}, spacing:{before:100,after:100},
+}));
+children.push(spacer(14));
+children.push(sectionRule(ORANGE));
+
+// Per-query sections
+const COL_WIDTHS=[3200,900,1300,1000,1360,1600];
+const COL_HEADERS=['Landing Page','Url Clicks','Impressions','URL CTR (%)','Average Position','Competing Pages'];
+
+queries.forEach((q,qi)=>{
+  children.push(new Paragraph({
+    children:[
+      new TextRun({text:'🔴  ',size:24,font:'Arial'}),
+      new TextRun({text:q.query,size:26,bold:true,font:'Arial',color:NAVY}),
+      new TextRun({text:'  —  '+q.numPages+' pages · pos '+q.bestPos+' · '+q.totalImp.toLocaleString()+' impressions',size:20,font:'Arial',color:'5A7FA0'}),
+    ],
+    spacing:{before:180,after:80},
+  }));
+
+  const headerCells = COL_HEADERS.map((h,i)=>hdrCell(h,COL_WIDTHS[i]));
+  const dataRows = q.rows.map(row=>new TableRow({children:[
+    dataCell(row.slug,       COL_WIDTHS[0],row.isBest,false),
+    dataCell(row.clicks,     COL_WIDTHS[1],row.isBest,true),
+    dataCell(row.impressions,COL_WIDTHS[2],row.isBest,true),
+    dataCell(row.ctr,        COL_WIDTHS[3],row.isBest,true),
+    dataCell(row.position,   COL_WIDTHS[4],row.isBest,true),
+    dataCell(row.competing,  COL_WIDTHS[5],row.isBest,true),
+  ]}));
+
+  children.push(new Table({
+    width:{size:9360,type:WidthType.DXA}, columnWidths:COL_WIDTHS,
+    rows:[new TableRow({children:headerCells}),...dataRows],
+  }));
+
+  const actionBox = {
+    shading:{fill:'FFF8E1',type:ShadingType.CLEAR},
+    border:{left:{style:BorderStyle.SINGLE,size:14,color:'F0A500',space:1}},
+    indent:{left:160,right:160}, spacing:{before:80,after:0},
+  };
+  const plain = text=>new TextRun({text,size:18,font:'Arial',color:'5A3000'});
+  const slugRun = (text,color)=>new TextRun({text,bold:true,size:18,font:'Courier New',color:color||MID_BLUE});
+  const listed = slugs=>slugs.slice(0,2).join(', ')+(slugs.length>2?` +${slugs.length-2} more`:'');
+  const lines = [];
+  q.into.forEach(g=>lines.push([
+    plain('301 redirect '), slugRun(listed(g.slugs)), plain(' into '), slugRun(g.target,'1A6B3A'),
+    plain(q.rows.some(r=>r.slug===g.target) ? '.' : ' (the winner across all queries).'),
+  ]));
+  if(q.kept.length) lines.push([
+    plain('Keep '), slugRun(listed(q.kept)),
+    plain(q.kept.length>1 ? ': they win more on other queries · differentiate their titles / intent.'
+                          : ': it wins more on other queries · differentiate its title / intent.'),
+  ]);
+  if(q.winner) lines.push([plain('Strengthen internal links to '), slugRun(q.winner,'1A6B3A'), plain('.')]);
+  lines.forEach((runs,i)=>children.push(new Paragraph({
+    ...actionBox,
+    spacing:{before:i?0:80, after:i===lines.length-1?80:0},
+    children:i ? runs : [new TextRun({text:'Suggested action: ',bold:true,size:18,font:'Arial',color:NAVY}), ...runs],
+  })));
+
+  if(qi<queries.length-1){ children.push(spacer(6)); children.push(sectionRule('D4DFE9')); }
+});
+
+// Footer
+children.push(spacer(20));
+children.push(new Paragraph({
+  children:[new TextRun({text:'Generated by Edstellar Keyword Cannibalization Finder  ·  '+summary.date,size:16,font:'Arial',color:'8BA3BC',italics:true})],
+  alignment:AlignmentType.CENTER,
+  border:{top:{style:BorderStyle.SINGLE,size:2,color:'D4DFE9',space:4}},
+  spacing:{before:200,after:0},
+}));
+
+const doc = new Document({
+  styles:{ default:{ document:{ run:{ font:'Arial', size:20 } } } },
+  sections:[{
+    properties:{ page:{ size:{width:12240,height:15840}, margin:{top:720,right:900,bottom:900,left:900} } },
+    children,
+  }],
+});
+
+Packer.toBuffer(doc).then(buf=>{ fs.writeFileSync(process.argv[3],buf); console.log('OK '+buf.length+' bytes'); })
+  .catch(e=>{ console.error(e.message); process.exit(1); });
+"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_file = os.path.join(tmpdir, 'data.json')
+        out_file  = os.path.join(tmpdir, 'report.docx')
+        js_file   = os.path.join(tmpdir, 'gen.js')
+
+        with open(data_file, 'w') as f:
+            f.write(payload)
+        with open(js_file, 'w') as f:
+            f.write(js_script)
+
+        result = subprocess.run(
+            ['node', js_file, data_file, out_file],
+            capture_output=True, text=True, timeout=30,
+            env={**os.environ, 'NODE_PATH': '/home/claude/.npm-global/lib/node_modules'}
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Doc generation failed: {result.stderr}")
+
+        with open(out_file, 'rb') as f:
+            return f.read()
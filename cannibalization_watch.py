@@ -0,0 +1,371 @@
+"""
+Watch-folder mode for nightly GSC drops.
+
+Polls a directory for GSC exports (.csv, .csv.gz, .xlsx, .zip) and keeps the
+cannibalization report for everything in it up to date, without anyone
+uploading files by hand:
+
+- Files are tracked by SHA-256 of their content. A file is re-read only when
+  its size or mtime changes, and re-ingested only if its content did too.
+  Files still being written (modified in the last --settle seconds) wait for
+  the next poll.
+- Each ingested file is filtered with the given settings and reduced to its
+  (dimensions, query, page) sums, which are kept on disk next to the exports. A restart
+  picks up where it left off, and a changed file or filter setting only
+  redoes the files affected.
+- Only queries touched by a new, changed or removed file are re-aggregated
+  and re-summarized (see IncrementalCannibalization). The rest of the report
+  is reused.
+- After every change the summary CSV, detail CSV and Excel report are
+  rewritten in the output directory, and the run is saved to the snapshot
+  store, so the app can open it with ?run=<id>.
+
+Files may overlap — rolling 7-day windows, a re-export of last month. A
+(query, page) row is counted once per value of the dimensions every file
+carries (typically Date), from the first file by name that has it, exactly
+as when the files are uploaded together. Without a shared Date column, the
+same row in two files is one row counted once, so exports of different
+periods should be split by day rather than dropped as totals.
+
+With --two-pass, nothing is kept per file: every change re-runs the whole
+folder through find_cannibalization_two_pass, which streams each file from
+disk twice and only holds the rows of queries that can conflict. Slower per
+change, but memory stays flat for folders too big to load. Both modes
+report the same numbers.
+
+Usage:
+    python cannibalization_watch.py /data/gsc-drops                  # poll every 60s
+    python cannibalization_watch.py /data/gsc-drops --out /data/reports --interval 300
+    python cannibalization_watch.py /data/gsc-drops --once --pos-max 30 --no-templates
+    python cannibalization_watch.py /data/gsc-drops --once --two-pass                # huge folders
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from cannibalization_engine import (
+    UPLOAD_TYPES,
+    IncrementalCannibalization,
+    PipelineTrace,
+    RuleError,
+    SnapshotError,
+    SnapshotStore,
+    apply_filters,
+    build_query_summary,
+    expand_upload,
+    export_tables,
+    find_cannibalization_two_pass,
+    load_gsc_uploads,
+    load_rules,
+    severity_labels,
+    to_csv,
+    to_excel,
+)
+
+STATE_DIR       = '.kcf_watch'
+EXCEL_MAX_ROWS  = 1_048_575
+AUDIT_KEYS      = ('before', 'anchors_removed', 'templates_removed', 'after')
+# Our own exports, in case --out is the watched folder itself
+OUTPUT_NAMES    = {'cannibalization_query_summary.csv', 'cannibalization_detail.csv',
+                   'cannibalization_report.xlsx'}
+
+
+def _log(msg: str) -> None:
+    print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {msg}", flush=True)
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    """Replace `path` in one step, so readers never see a half-written export."""
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        while chunk := fh.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FolderWatcher:
+    """Incrementally maintained report for the GSC exports in `folder`.
+
+    State lives in `out_dir`/.kcf_watch: manifest.json (per file: stat,
+    content hash, audit counts), parts/<hash>.parquet (the file's
+    filtered part_sums) and the last results, so a restart
+    doesn't recompute anything that hasn't changed. Parts are only valid for the filter
+    settings and template rules they were built with; when either changes,
+    every file is ingested again.
+
+    With `two_pass`, no parts are kept: any change re-analyses the whole
+    folder with find_cannibalization_two_pass, streaming the files from disk.
+    """
+
+    def __init__(self, folder: Path, out_dir: Path, params: dict, settle_s: float = 10,
+                 store: SnapshotStore | None = None, two_pass: bool = False):
+        self.folder   = Path(folder)
+        self.out_dir  = Path(out_dir)
+        self.params   = params
+        self.settle_s = settle_s
+        self.store    = store
+        self.two_pass = two_pass
+        self.audit    = None  # two-pass only: the last run's audit counts
+        self.state    = self.out_dir / STATE_DIR
+        (self.state / 'parts').mkdir(parents=True, exist_ok=True)
+
+        self.settings_key = self._settings_key()
+        self.inc   = IncrementalCannibalization(params['min_pages'])
+        self.files = self._load_manifest()
+
+    def _settings_key(self) -> str:
+        # Two-pass state has no parts, so it's never mistaken for incremental state,
+        # and parts stored in an older layout are rebuilt
+        mode = 'two-pass' if self.two_pass else f"parts-v{IncrementalCannibalization.PART_VERSION}"
+        return f"{SnapshotStore.settings_key(self.params, load_rules().version)}-{mode}"
+
+    # ── State ──
+
+    def _load_manifest(self) -> dict[str, dict]:
+        path = self.state / 'manifest.json'
+        if not path.exists():
+            return {}
+        manifest = json.loads(path.read_text())
+        if manifest.get('settings_key') != self.settings_key:
+            _log("filter settings, template rules or aggregation changed — re-ingesting every file")
+            return {}
+        files = {}
+        self.audit = manifest.get('audit')
+        for name, entry in manifest['files'].items():
+            part = self.state / 'parts' / f"{entry['hash']}.parquet"
+            if self.two_pass:
+                files[name] = entry
+            elif entry.get('error') is None and part.exists():
+                self.inc.add(name, pd.read_parquet(part))
+                files[name] = entry
+            elif entry.get('error') is not None:
+                files[name] = entry
+        results = [self.state / f"{t}.parquet" for t in ('cannibs', 'query_sum')]
+        if all(p.exists() for p in results):
+            # Written before the manifest, so they already cover every part above
+            self.inc.cannibs, self.inc.query_sum = map(pd.read_parquet, results)
+            self.inc.touched.clear()
+        return files
+
+    def _save_manifest(self) -> None:
+        manifest = {'settings_key': self.settings_key, 'params': self.params, 'files': self.files,
+                    'audit': self.audit}
+        _write_atomic(self.state / 'manifest.json', json.dumps(manifest, indent=2).encode())
+        # Parts no file points at any more
+        live = {e['hash'] for e in self.files.values()}
+        for part in (self.state / 'parts').glob('*.parquet'):
+            if part.stem not in live:
+                part.unlink()
+
+    # ── Polling ──
+
+    def scan(self) -> dict[str, tuple[int, int]]:
+        """name → (size, mtime_ns) of every settled export in the folder."""
+        now, out = time.time(), {}
+        for path in sorted(self.folder.iterdir()):
+            if not path.is_file() or path.name.startswith('.') or path.name in OUTPUT_NAMES:
+                continue
+            if path.suffix.lstrip('.').lower() not in UPLOAD_TYPES:
+                continue
+            st = path.stat()
+            if now - st.st_mtime >= self.settle_s:
+                out[path.name] = (st.st_size, st.st_mtime_ns)
+        return out
+
+    def _ingest(self, name: str, data: bytes, digest: str, trace) -> dict:
+        """Filter one file and store its (query, slug) sums; returns its manifest entry."""
+        try:
+            raw_df, _ = load_gsc_uploads([(name, data)], trace=trace)
+        except Exception as e:
+            _log(f"  ✗ {name}: {e}")
+            return {'hash': digest, 'error': str(e)}
+        filtered, audit = apply_filters(raw_df, trace=trace, **{
+            k: self.params[k] for k in ('pos_min', 'pos_max', 'min_impressions', 'min_clicks',
+                                        'filter_anchors', 'filter_templates', 'extra_templates')})
+        sums = self.inc.part_sums(filtered, raw_df)
+        sums.to_parquet(self.state / 'parts' / f"{digest}.parquet", compression='zstd')
+        self.inc.add(name, sums)
+        _log(f"  + {name}: {len(raw_df):,} rows, {int((sums['rows'] > 0).sum()):,} (query, page) rows after filters")
+        return {'hash': digest, 'error': None, 'audit': {k: int(audit[k]) for k in AUDIT_KEYS}}
+
+    def _analyze_two_pass(self, trace) -> int | None:
+        """Re-analyse every readable file with find_cannibalization_two_pass.
+
+        A file that fails to parse is marked with its error and the run
+        retried without it. Returns the candidate query count, or None (the
+        last report is kept) when the failure can't be pinned on one file.
+        """
+        while True:
+            ok = sorted(n for n, e in self.files.items() if e.get('error') is None)
+            try:
+                sources = [s for name in ok for s in expand_upload(name, self.folder / name)]
+                cannibs, audit = find_cannibalization_two_pass(sources, trace=trace, **self.params)
+                break
+            except (ValueError, OSError) as e:
+                bad = next((n for n in ok if str(e).startswith((f"{n}:", f"{n}/"))), None)
+                _log(f"  ✗ {e}" + ('' if bad else " — report left as it was"))
+                if bad is None:
+                    return None
+                self.files[bad]['error'] = str(e)
+        query_sum = build_query_summary(cannibs, trace=trace) if not cannibs.empty else pd.DataFrame()
+        if not query_sum.empty:
+            query_sum['_sev'] = severity_labels(query_sum['Best Average Position'],
+                                                query_sum['Impressions'])
+        self.inc.cannibs, self.inc.query_sum = cannibs, query_sum
+        self.audit = {k: int(audit[k]) for k in AUDIT_KEYS}
+        _log(f"  two-pass: {audit['rows_read']:,} rows read, {audit['rows_kept']:,} kept "
+             f"for {audit['candidate_queries']:,} candidate queries")
+        return audit['candidate_queries']
+
+    def poll(self) -> bool:
+        """Bring the report up to date with the folder; True if anything changed."""
+        trace = PipelineTrace('watch')
+        settings_key = self._settings_key()
+        if settings_key != self.settings_key:
+            _log("template rules changed — re-ingesting every file")
+            self.settings_key = settings_key
+            self.inc   = IncrementalCannibalization(self.params['min_pages'])
+            self.files = {}
+        seen, changed = self.scan(), False
+
+        for name in sorted(set(self.files) - set(seen)):
+            if (self.folder / name).exists():
+                continue  # still settling after a rewrite
+            _log(f"  − {name}: removed")
+            if self.files.pop(name).get('error') is None and not self.two_pass:
+                self.inc.remove(name)
+            changed = True
+
+        for name, (size, mtime_ns) in seen.items():
+            entry = self.files.get(name)
+            if entry is not None and (entry['size'], entry['mtime_ns']) == (size, mtime_ns):
+                continue
+            if self.two_pass:
+                digest = _file_sha256(self.folder / name)
+                if entry is None or entry['hash'] != digest:
+                    _log(f"  + {name}")
+                    entry, changed = {'hash': digest, 'error': None}, True
+            else:
+                data = (self.folder / name).read_bytes()
+                digest = hashlib.sha256(data).hexdigest()
+                if entry is None or entry['hash'] != digest:
+                    if entry is not None and entry.get('error') is None:
+                        self.inc.remove(name)
+                    entry = self._ingest(name, data, digest, trace)
+                    changed = True
+            self.files[name] = {**entry, 'size': size, 'mtime_ns': mtime_ns}
+
+        if self.two_pass:
+            touched = self._analyze_two_pass(trace) if changed else 0
+            publish = changed and touched is not None
+        else:
+            touched = self.inc.refresh(trace=trace)
+            publish = changed or touched
+        if publish:
+            self._publish(touched, trace)
+        if changed or touched:
+            self._save_manifest()
+        return bool(changed or touched)
+
+    # ── Output ──
+
+    def _publish(self, touched: int, trace) -> None:
+        """Rewrite the exports (and save a snapshot) from the current results."""
+        cannibs, query_sum = self.inc.cannibs, self.inc.query_sum
+        tables = export_tables(cannibs, query_sum)
+        for name, frame in (('cannibs', cannibs), ('query_sum', query_sum)):
+            frame.to_parquet(self.state / f".{name}.tmp", compression='zstd')
+            os.replace(self.state / f".{name}.tmp", self.state / f"{name}.parquet")
+        with trace.stage('watch: exports', rows_in=len(cannibs)):
+            _write_atomic(self.out_dir / 'cannibalization_query_summary.csv', to_csv(tables['Query Summary']))
+            _write_atomic(self.out_dir / 'cannibalization_detail.csv', to_csv(tables['Detail View']))
+            if len(cannibs) <= EXCEL_MAX_ROWS:
+                _write_atomic(self.out_dir / 'cannibalization_report.xlsx', to_excel(tables))
+        msg = (f"  {touched:,} queries re-analysed · {len(query_sum):,} conflicting queries, "
+               f"{len(cannibs):,} pairs · exports written to {self.out_dir}")
+
+        if self.store is not None:
+            ok = {n: e for n, e in sorted(self.files.items()) if e.get('error') is None}
+            fingerprint = hashlib.sha256(''.join(e['hash'] for e in ok.values()).encode()).hexdigest()
+            audit = (self.audit if self.two_pass else
+                     {k: sum(e['audit'][k] for e in ok.values()) for k in AUDIT_KEYS})
+            result = {
+                'audit':         audit,
+                'cannibs':       cannibs,
+                'query_sum':     query_sum,
+                'compare':       None,
+                'rules_version': load_rules().version,
+            }
+            try:
+                run_id = self.store.save(result, fingerprint=fingerprint, trace=trace,
+                                         settings=dict(self.params, files=list(ok),
+                                                       rows=result['audit']['before']))
+                msg += f" · saved as run {run_id} (open the app with ?run={run_id})"
+            except SnapshotError as e:
+                msg += f" · not saved: {e}"
+        _log(msg)
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    ap.add_argument('folder', type=Path, help="directory the GSC exports are dropped into")
+    ap.add_argument('--out', type=Path, help="where exports and watch state go (default <folder>/reports)")
+    ap.add_argument('--interval', type=float, default=60, help="seconds between polls")
+    ap.add_argument('--settle', type=float, default=10,
+                    help="ignore files modified less than this many seconds ago")
+    ap.add_argument('--once', action='store_true', help="poll once and exit (for cron)")
+    ap.add_argument('--no-snapshot', action='store_true', help="don't save runs to the snapshot store")
+    ap.add_argument('--two-pass', action='store_true',
+                    help="re-analyse the whole folder in two streaming passes on every change "
+                         "instead of keeping per-file sums — for folders too big to load")
+    # Same filters and defaults as the app's sidebar
+    ap.add_argument('--pos-min', type=float, default=1)
+    ap.add_argument('--pos-max', type=float, default=20)
+    ap.add_argument('--min-impressions', type=int, default=0)
+    ap.add_argument('--min-clicks', type=int, default=0)
+    ap.add_argument('--min-pages', type=int, default=2)
+    ap.add_argument('--no-anchors', action='store_true', help="keep #anchor URL variants")
+    ap.add_argument('--no-templates', action='store_true', help="keep geo-templated pages")
+    ap.add_argument('--template', action='append', default=[], metavar='SKELETON',
+                    help="extra template series to drop, e.g. 'training-in-<x>' (repeatable)")
+    args = ap.parse_args()
+
+    if not args.folder.is_dir():
+        ap.error(f"{args.folder} is not a directory")
+    params = {'pos_min': args.pos_min, 'pos_max': args.pos_max,
+              'min_impressions': args.min_impressions, 'min_clicks': args.min_clicks,
+              'min_pages': args.min_pages, 'filter_anchors': not args.no_anchors,
+              'filter_templates': not args.no_templates, 'extra_templates': args.template}
+    try:
+        watcher = FolderWatcher(args.folder, args.out or args.folder / 'reports', params,
+                                settle_s=args.settle, two_pass=args.two_pass,
+                                store=None if args.no_snapshot else SnapshotStore())
+    except RuleError as e:
+        print(f"template rules could not be loaded: {e}", file=sys.stderr)
+        return 1
+
+    _log(f"watching {args.folder} ({len(watcher.files)} file(s) already ingested)")
+    while True:
+        if not watcher.poll() and args.once:
+            _log("no changes")
+        if args.once:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
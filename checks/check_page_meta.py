@@ -0,0 +1,201 @@
+"""
+End-to-end checks for the page metadata fetcher, against a local HTTP server.
+
+Starts a throwaway http.server on 127.0.0.1 that serves the awkward cases a
+real site throws at PageMetaFetcher, fetches them, and checks what comes back:
+
+- plain HTML pages (title, first H1, canonical resolved against the URL)
+- redirects, including a chain, a loop and a redirect to file://
+- 404s and 500s
+- non-HTML responses (JSON, images) and bodies over max_bytes
+- a server that trickles its body slower than the timeout
+- the per-host concurrency limit, with two host names on one server
+- the SQLite cache (second fetch served from it, failures included)
+- private-address blocking when allow_private is off
+
+Nothing touches the network or the real page-meta cache. Exits non-zero if
+any check fails.
+
+Usage:
+    python checks/check_page_meta.py
+    python checks/check_page_meta.py --per-host 2 -v
+"""
+
+import argparse
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from cannibalization_engine import PageMetaFetcher  # noqa: E402
+
+TIMEOUT_S = 1.0
+MAX_BYTES = 64 * 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Routes below; counts requests in flight per Host header for the limit checks."""
+
+    lock = threading.Lock()
+    in_flight: dict[str, int] = {}
+    peak: dict[str, int] = {}
+
+    def log_message(self, *args):
+        pass
+
+    def _html(self, body: str, status: int = 200, ctype: str = 'text/html; charset=utf-8'):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _redirect(self, location: str, status: int = 302):
+        self.send_response(status)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path.startswith('/page/'):
+            name = path.rsplit('/', 1)[-1]
+            self._html(f'<html><head><title> Page  {name} </title>'
+                       f'<link rel="canonical" href="/canonical/{name}"></head>'
+                       f'<body><h1>Heading <b>{name}</b></h1><h1>second</h1></body></html>')
+        elif path == '/redirect':
+            self._redirect('/page/target')
+        elif path == '/chain':
+            self._redirect('/redirect', 301)
+        elif path == '/loop':
+            self._redirect('/loop')
+        elif path == '/to-file':
+            self._redirect('file:///etc/passwd')
+        elif path == '/missing':
+            self._html('<title>Not found</title>', 404)
+        elif path == '/error':
+            self._html('<title>Oops</title>', 500)
+        elif path == '/json':
+            self._html('{"title": "no"}', ctype='application/json')
+        elif path == '/image':
+            self._html('GIF89a', ctype='image/gif')
+        elif path == '/big':
+            self._html('<title>Big</title>' + 'x' * (4 * MAX_BYTES))
+        elif path == '/slow':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.end_headers()
+            try:
+                for _ in range(int(4 * TIMEOUT_S / 0.1)):
+                    self.wfile.write(b'<!-- trickle -->')
+                    self.wfile.flush()
+                    time.sleep(0.1)
+                self.wfile.write(b'<title>Slow</title>')
+            except OSError:
+                pass  # the fetcher gave up, as it should
+        elif path.startswith('/busy/'):
+            host = self.headers.get('Host', '').split(':')[0]
+            with self.lock:
+                self.in_flight[host] = self.in_flight.get(host, 0) + 1
+                self.peak[host] = max(self.peak.get(host, 0), self.in_flight[host])
+            time.sleep(0.15)
+            with self.lock:
+                self.in_flight[host] -= 1
+            self._html(f'<title>{path}</title>')
+        else:
+            self._html('<title>?</title>', 404)
+
+
+def _checks(base: str, alt: str, per_host: int, cache_dir: Path) -> list[tuple[str, bool, str]]:
+    """(check, passed, detail) for every case."""
+    fetcher = PageMetaFetcher(cache_dir / 'page_meta.sqlite', per_host=per_host, max_concurrent=32,
+                              timeout_s=TIMEOUT_S, max_bytes=MAX_BYTES, allow_private=True)
+    out = []
+
+    def check(name: str, ok: bool, detail) -> None:
+        out.append((name, bool(ok), str(detail)))
+
+    cases = ['/page/a', '/redirect', '/chain', '/loop', '/to-file', '/missing', '/error',
+             '/json', '/image', '/big', '/slow']
+    t0 = time.perf_counter()
+    meta = fetcher.fetch([base + c for c in cases]).set_index('url')
+    took = time.perf_counter() - t0
+    row = {c: meta.loc[base + c] for c in cases}
+
+    r = row['/page/a']
+    check('html page', r['status'] == 200 and r['title'] == 'Page a' and r['h1'] == 'Heading a'
+          and r['canonical'] == base + '/canonical/a' and pd.isna(r['error']), r.to_dict())
+    for c in ('/redirect', '/chain'):
+        r = row[c]
+        check(f'redirect {c}', r['status'] == 200 and r['title'] == 'Page target'
+              and r['canonical'] == base + '/canonical/target', r.to_dict())
+    check('redirect loop', pd.notna(row['/loop']['error']), row['/loop']['error'])
+    check('redirect to file:// not followed', pd.isna(row['/to-file']['title'])
+          and pd.notna(row['/to-file']['error']), row['/to-file']['error'])
+    check('404', row['/missing']['status'] == 404 and row['/missing']['error'] == 'HTTP 404',
+          row['/missing'].to_dict())
+    check('500', row['/error']['status'] == 500, row['/error'].to_dict())
+    for c, ctype in (('/json', 'application/json'), ('/image', 'image/gif')):
+        check(f'non-HTML {ctype}', row[c]['error'] == f'not HTML ({ctype})' and pd.isna(row[c]['title']),
+              row[c].to_dict())
+    check('body over max_bytes', row['/big']['title'] == 'Big' and pd.isna(row['/big']['error']),
+          row['/big'].to_dict())
+    check('slow body times out', pd.notna(row['/slow']['error']) and pd.isna(row['/slow']['title']),
+          row['/slow']['error'])
+    check('slow body bounded', took < 3 * TIMEOUT_S + 1, f"whole batch took {took:.2f}s")
+
+    again = fetcher.fetch([base + c for c in cases])
+    check('second fetch cached', again['cached'].all(), f"{int(again['cached'].sum())}/{len(again)} cached")
+
+    # Two hosts (127.0.0.1 and localhost) on one server: each capped at per_host
+    n = per_host * 4
+    _Handler.peak.clear()
+    fetcher.fetch([f"{h}/busy/{i}" for h in (base, alt) for i in range(n)])
+    peaks = dict(_Handler.peak)
+    check('per-host limit', peaks and max(peaks.values()) <= per_host, peaks)
+    check('hosts fetched in parallel', len(peaks) == 2 and min(peaks.values()) == per_host, peaks)
+
+    blocked = PageMetaFetcher(cache_dir / 'blocked.sqlite', timeout_s=TIMEOUT_S, allow_private=False)
+    b = blocked.fetch([base + '/page/a', 'file:///etc/passwd']).set_index('url')
+    check('private address blocked', pd.isna(b.loc[base + '/page/a', 'title'])
+          and 'blocked' in str(b.loc[base + '/page/a', 'error']), b.loc[base + '/page/a', 'error'])
+    check('file:// refused', 'scheme' in str(b.loc['file:///etc/passwd', 'error']),
+          b.loc['file:///etc/passwd', 'error'])
+    return out
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    ap.add_argument('--per-host', type=int, default=4, help="PageMetaFetcher per_host limit to check")
+    ap.add_argument('-v', '--verbose', action='store_true', help="print each check's details")
+    args = ap.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            results = _checks(f"http://127.0.0.1:{port}", f"http://localhost:{port}",
+                              args.per_host, Path(tmp))
+    finally:
+        server.shutdown()
+
+    width = max(len(name) for name, _, _ in results)
+    for name, ok, detail in results:
+        line = f"{'ok  ' if ok else 'FAIL'}  {name:<{width}}" + (f"  {detail}" if args.verbose or not ok else '')
+        print(line.rstrip())
+    failed = sum(not ok for _, ok, _ in results)
+    print(f"\n{len(results) - failed}/{len(results)} checks passed")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,10 +8,51 @@ Run with:
     streamlit run keyword_cannibalization_app.py
 """
 
+import html
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
 import pandas as pd
-import re
-from io import BytesIO
+import numpy as np
+
+from cannibalization_engine import (
+    PERF_LOG_PATH,
+    PREVIEW_SAMPLE_QUERIES,
+    UPLOAD_TYPES,
+    DatasetCache,
+    JobCancelled,
+    PageMetaFetcher,
+    PipelineJob,
+    PipelineTrace,
+    RuleError,
+    SearchIndex,
+    SnapshotError,
+    SnapshotStore,
+    add_similarity,
+    analyze_and_save,
+    analyze_preview,
+    build_query_summary,
+    build_redirect_map,
+    click_opportunity,
+    cannibalization_kpis,
+    discover_template_series,
+    expected_ctr,
+    fetch_page_meta,
+    fit_ctr_curve,
+    generate_high_severity_docx,
+    load_rules,
+    priority_matrix,
+    query_redirects,
+    rename_for_display,
+    rules_error,
+    severity_labels,
+    to_csv,
+    to_excel,
+    with_page_meta,
+)
 
 # ── Page config ────────────────────────────────────────────────────────────────
 st.set_page_config(
@@ -278,484 +319,253 @@ html, body, [class*="css"] { font-family: 'DM Sans', sans-serif; }
 
 
 # ══════════════════════════════════════════════════════════════════════════════
-# CONSTANTS — Edstellar templatized page patterns
+# PAGED TABLES
 # ══════════════════════════════════════════════════════════════════════════════
 
-COUNTRIES = (
-    r'(singapore|australia|malaysia|canada|nigeria|ireland|philippines|south-africa|'
-    r'new-zealand|egypt|kenya|greece|india|uk|usa|germany|france|uae|saudi-arabia|'
-    r'italy|norway|sweden|belgium|south-korea|japan|china|brazil|austria|bahrain|'
-    r'botswana|cyprus|denmark|finland|dubai|spain|portugal|netherlands|poland|'
-    r'switzerland|turkey|thailand|indonesia|vietnam|qatar|kuwait|oman|jordan|'
-    r'pakistan|bangladesh|sri-lanka|nepal|myanmar|hong-kong|taiwan|mexico|argentina|'
-    r'colombia|chile|peru|ghana|tanzania|uganda|ethiopia|zimbabwe|zambia|morocco|'
-    r'algeria|tunisia|senegal|ivory-coast|cameroon|new-york|london|texas|california|florida)'
-)
+PAGE_SIZES = [50, 100, 250, 500]
 
-TEMPLATE_PATTERNS = [
-    (re.compile(r'corporate-training-companies-' + COUNTRIES, re.I),
-     "corporate-training-companies-<country>"),
-    (re.compile(r'skills-in-demand-in-' + COUNTRIES, re.I),
-     "skills-in-demand-in-<country>"),
-    (re.compile(r'skills-in-demand-' + COUNTRIES, re.I),
-     "skills-in-demand-<country>"),
-    (re.compile(r'^[a-z]+-work-culture$', re.I),
-     "<country>-work-culture"),
-    (re.compile(r'corporate-training-in-' + COUNTRIES, re.I),
-     "corporate-training-in-<country>"),
-    (re.compile(r'best-.*-training-companies-' + COUNTRIES, re.I),
-     "best-*-training-companies-<country>"),
-    (re.compile(r'top-.*-training-companies-' + COUNTRIES, re.I),
-     "top-*-training-companies-<country>"),
-]
 
+def _sort_order(df: pd.DataFrame, col: str) -> np.ndarray:
+    """Row positions of df in ascending `col` order (stable, NaNs last)."""
+    values = pd.Series(df[col].to_numpy())
+    return values.sort_values(kind='stable', na_position='last').index.to_numpy()
 
-def is_template(slug: str) -> bool:
-    return any(rx.search(slug) for rx, _ in TEMPLATE_PATTERNS)
 
+def paged_dataframe(df: pd.DataFrame, key: str, version) -> None:
+    """Render df one page at a time with server-side sort and filter.
 
-def get_base_slug(url: str) -> str:
-    """Extract the slug portion from a full URL or bare slug."""
-    # Remove protocol + domain if present
-    url = re.sub(r'^https?://[^/]+/', '', str(url))
-    # Remove trailing slashes
-    url = url.rstrip('/')
-    # Take only the last path segment
-    return url.split('/')[-1] if '/' in url else url
+    Only the visible slice is handed to st.dataframe, so the browser never
+    receives the full result. Sort orders are argsort indexes computed once
+    per column. Filtered orders are cached per filter value. Both caches are
+    kept in session state until `version` changes, so moving between pages
+    is a single slice.
+    """
+    cache = st.session_state.setdefault('_paged_tables', {})
+    tbl   = cache.get(key)
+    if tbl is None or tbl['version'] != version:
+        tbl = cache[key] = {'version': version, 'orders': {}, 'views': {}}
+
+    cols = list(df.columns)
+    c1, c2, c3, c4, c5 = st.columns([2, 1, 2, 2, 1])
+    sort_col  = c1.selectbox("Sort by", ['(default order)'] + cols, key=f"{key}_sort")
+    desc      = c2.toggle("Descending", value=True, key=f"{key}_desc")
+    filt_col  = c3.selectbox("Filter column", ['(none)'] + cols, key=f"{key}_fcol")
+    filt_val  = None
+    if filt_col != '(none)':
+        if pd.api.types.is_numeric_dtype(df[filt_col]):
+            filt_val = c4.number_input("Minimum value", value=0.0, key=f"{key}_fnum")
+        else:
+            filt_val = c4.text_input("Contains", key=f"{key}_ftxt").strip().lower() or None
+    page_size = c5.selectbox("Rows / page", PAGE_SIZES, index=1, key=f"{key}_size")
+
+    view_key = (sort_col, desc, filt_col, filt_val)
+    order = tbl['views'].get(view_key)
+    if order is None:
+        if sort_col == '(default order)':
+            order = np.arange(len(df))
+        else:
+            if sort_col not in tbl['orders']:
+                tbl['orders'][sort_col] = _sort_order(df, sort_col)
+            order = tbl['orders'][sort_col]
+            if desc:
+                order = order[::-1]
+        if filt_val is not None:
+            if isinstance(filt_val, str):
+                mask = df[filt_col].astype(str).str.lower().str.contains(filt_val, regex=False).to_numpy()
+            else:
+                mask = (df[filt_col] >= filt_val).to_numpy()
+            order = order[mask[order]]
+        tbl['views'][view_key] = order
+
+    n_rows  = len(order)
+    n_pages = max(1, -(-n_rows // page_size))
+    page_key = f"{key}_page"
+    if st.session_state.get(page_key, 1) > n_pages:
+        st.session_state[page_key] = n_pages
+
+    table_slot = st.container()
+    p1, p2 = st.columns([1, 4])
+    page  = p1.number_input(f"Page (of {n_pages:,})", min_value=1, max_value=n_pages,
+                            value=1, key=page_key)
+    start = (page - 1) * page_size
+    stop  = min(start + page_size, n_rows)
+    p2.caption(f"Rows {start + 1 if n_rows else 0:,}–{stop:,} of {n_rows:,}"
+               + (f" (filtered from {len(df):,})" if n_rows != len(df) else ""))
+
+    with table_slot:
+        st.dataframe(df.iloc[order[start:stop]], use_container_width=True, hide_index=True)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
-# DATA PROCESSING
+# BACKGROUND JOBS
 # ══════════════════════════════════════════════════════════════════════════════
 
-def read_gsc_data(df: pd.DataFrame) -> pd.DataFrame:
-    """Standardise column names from various GSC export formats.
-    
-    Primary format (Edstellar GSC export):
-        Query | Landing Page | Url Clicks | Impressions | URL CTR | Average Position
-    """
-    mapping = {
-        # Query
-        'Query': 'query', 'Top queries': 'query', 'Queries': 'query',
-        # Page / Landing Page
-        'Landing Page': 'page', 'Page': 'page', 'Top pages': 'page',
-        'Pages': 'page', 'URL': 'page',
-        # Clicks
-        'Url Clicks': 'clicks', 'Clicks': 'clicks',
-        # Impressions
-        'Impressions': 'impressions',
-        # CTR
-        'URL CTR': 'ctr', 'CTR': 'ctr', 'CTR (%)': 'ctr',
-        'Click Through Rate': 'ctr',
-        # Position
-        'Average Position': 'position', 'Average position': 'position',
-        'Avg Position': 'position', 'Avg. position': 'position',
-        'Position': 'position',
-        # Competing pages (optional)
-        'Competing Pages': 'competing_pages_raw',
-    }
-    df = df.rename(columns=mapping)
-    df.columns = df.columns.str.strip()
-
-    # Normalise to lowercase for internal processing
-    col_lower = {c: c.lower() for c in df.columns}
-    df = df.rename(columns=col_lower)
-
-    required = ['query', 'page', 'clicks', 'impressions', 'position']
-    missing  = [c for c in required if c not in df.columns]
-    if missing:
-        raise ValueError(
-            f"Missing required columns: {', '.join(missing)}. "
-            f"Expected: Query, Landing Page, Url Clicks, Impressions, URL CTR, Average Position"
-        )
-
-    df['clicks']      = pd.to_numeric(df['clicks'],      errors='coerce').fillna(0).astype(int)
-    df['impressions'] = pd.to_numeric(df['impressions'], errors='coerce').fillna(0).astype(int)
-    df['position']    = pd.to_numeric(df['position'],    errors='coerce').fillna(0)
-
-    if 'ctr' in df.columns:
-        if df['ctr'].dtype == object:
-            df['ctr'] = df['ctr'].astype(str).str.rstrip('%')
-            df['ctr'] = pd.to_numeric(df['ctr'], errors='coerce').fillna(0)
-            if df['ctr'].max() > 1:
-                df['ctr'] = df['ctr'] / 100
-        else:
-            df['ctr'] = pd.to_numeric(df['ctr'], errors='coerce').fillna(0)
-            if df['ctr'].max() > 1:
-                df['ctr'] = df['ctr'] / 100
+@st.cache_resource
+def job_executor() -> ThreadPoolExecutor:
+    """Process-wide pool for analysis and export jobs, shared by all sessions."""
+    return ThreadPoolExecutor(max_workers=max(2, min(4, os.cpu_count() or 1)),
+                              thread_name_prefix='kcf-job')
+
+
+def _job_status_lines(job: PipelineJob) -> list[str]:
+    lines = []
+    for rec in job.finished:
+        rows = f" — {rec['rows_out']:,} rows" if rec.get('rows_out') is not None else ""
+        lines.append(f"✓ {rec['stage']}{rows} ({rec['wall_s']:.2f}s)")
+    if job.current:
+        lines.append(f"▸ {job.current}…")
+    return lines
+
+
+@st.fragment(run_every=0.5)
+def _job_progress(slot: str, title: str) -> None:
+    """Live progress for the job in `slot`; reruns the whole app once it finishes."""
+    job = st.session_state['jobs'].get(slot)
+    if job is None or job.done():
+        st.rerun()
+    st.markdown(f"**{title}**")
+    if job.progress:
+        done, total = job.progress
+        st.progress(done / max(total, 1), text=f"{job.current}: {done:,} / {total:,}")
     else:
-        df['ctr'] = 0.0
-
-    return df
-
-
-# Display column name mapping — internal name → Edstellar export label
-DISPLAY_COLS = {
-    'query':            'Query',
-    'slug':             'Landing Page',
-    'page':             'Landing Page',
-    'clicks':           'Url Clicks',
-    'impressions':      'Impressions',
-    'ctr':              'URL CTR (%)',
-    'position':         'Average Position',
-    'competing_pages':  'Competing Pages',
-    'severity':         'Severity',
-}
-
-def rename_for_display(df: pd.DataFrame) -> pd.DataFrame:
-    """Rename internal column names to Edstellar GSC export labels."""
-    return df.rename(columns=DISPLAY_COLS)
-
+        st.progress(0.0, text=job.current or "queued…")
+    st.caption("  \n".join(_job_status_lines(job)) or "waiting for a worker…")
+    if st.button("✖ Cancel", key=f"cancel_{slot}"):
+        job.cancel()
+        st.rerun()
+
+
+def await_job(slot: str, title: str) -> PipelineJob:
+    """Return the finished job in `slot`, or show its progress and end this run."""
+    job = st.session_state['jobs'][slot]
+    if not job.done():
+        _job_progress(slot, title)
+        st.stop()
+    return st.session_state['jobs'].pop(slot)
 
-def apply_filters(df: pd.DataFrame,
-                  pos_min: float, pos_max: float,
-                  min_impressions: int, min_clicks: int,
-                  filter_anchors: bool, filter_templates: bool) -> tuple[pd.DataFrame, dict]:
-    """Apply all configured filters and return filtered df + audit log."""
-    audit = {}
-    audit['before'] = len(df)
 
-    # Anchor filter
-    if filter_anchors:
-        before = len(df)
-        df = df[~df['page'].astype(str).str.contains('#', na=False)].copy()
-        audit['anchors_removed'] = before - len(df)
-    else:
-        audit['anchors_removed'] = 0
-
-    # Templatized page filter
-    if filter_templates:
-        before = len(df)
-        df['_slug'] = df['page'].astype(str).apply(get_base_slug)
-        df = df[~df['_slug'].apply(is_template)].copy()
-        audit['templates_removed'] = before - len(df)
-    else:
-        audit['templates_removed'] = 0
-
-    # Position filter
-    df = df[(df['position'] >= pos_min) & (df['position'] <= pos_max)].copy()
-
-    # Impression / click filters
-    df = df[(df['impressions'] >= min_impressions) & (df['clicks'] >= min_clicks)].copy()
-
-    audit['after'] = len(df)
-    return df, audit
-
-
-def find_cannibalization(df: pd.DataFrame, min_pages: int) -> pd.DataFrame:
-    """Identify queries where multiple pages compete."""
-    if df.empty:
-        return pd.DataFrame()
-
-    slug_col = '_slug' if '_slug' in df.columns else 'page'
-
-    agg = df.groupby(['query', slug_col]).agg(
-        clicks=('clicks', 'sum'),
-        impressions=('impressions', 'sum'),
-        ctr=('ctr', 'mean'),
-        position=('position', 'mean'),
-    ).reset_index().rename(columns={slug_col: 'slug'})
-
-    agg['position'] = agg['position'].round(1)
-    agg['ctr']      = (agg['ctr'] * 100).round(2)
-
-    pages_per_query           = agg.groupby('query')['slug'].transform('count')
-    agg['competing_pages']    = pages_per_query
-    cannibs                   = agg[agg['competing_pages'] >= min_pages].copy()
-
-    return cannibs.sort_values(['competing_pages', 'impressions'], ascending=[False, False])
-
-
-def build_query_summary(df: pd.DataFrame) -> pd.DataFrame:
-    """One-row-per-query grouped view — uses Edstellar GSC column labels."""
-    rows = []
-    for q, grp in df.groupby('query'):
-        # Pick the canonical "best" page by traffic authority:
-        # Score = impressions + (clicks * 10) so clicks break ties on equal impressions.
-        # This ensures we always recommend consolidating INTO the page with real traffic,
-        # not the one that merely has the lowest position number.
-        grp = grp.copy()
-        grp['_score'] = grp['impressions'] + (grp['clicks'] * 10)
-        best = grp.sort_values('_score', ascending=False).iloc[0]
-        rows.append({
-            'Query':                   q,
-            'Competing Pages':         len(grp),
-            'Url Clicks':              int(grp['clicks'].sum()),
-            'Impressions':             int(grp['impressions'].sum()),
-            'URL CTR (%)':             round(grp['ctr'].mean(), 2),
-            'Best Average Position':   round(grp['position'].min(), 1),
-            'Worst Average Position':  round(grp['position'].max(), 1),
-            'Position Spread':         round(grp['position'].max() - grp['position'].min(), 1),
-            'Best Landing Page':       best['slug'],
-            'All Landing Pages':       ' | '.join(
-                grp.sort_values('_score', ascending=False)['slug'].tolist()
-            ),
-        })
-    out = pd.DataFrame(rows).sort_values('Impressions', ascending=False)
-    return out
+@st.cache_resource
+def page_meta_fetcher() -> PageMetaFetcher:
+    """Competing-page fetcher; its on-disk cache is shared by all sessions."""
+    return PageMetaFetcher()
 
 
-def severity(pos: float, impressions: int) -> str:
-    if pos <= 10 and impressions >= 1000: return 'High'
-    if pos <= 20 and impressions >= 200:  return 'Medium'
-    return 'Low'
+@st.cache_resource
+def dataset_cache() -> DatasetCache:
+    """Parsed uploads shared by all sessions — one copy per distinct export."""
+    return DatasetCache()
 
 
-def to_excel(df_dict: dict) -> bytes:
-    """Export multiple DataFrames to a single xlsx."""
-    buf = BytesIO()
-    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
-        for sheet, df in df_dict.items():
-            df.to_excel(writer, sheet_name=sheet[:31], index=False)
-    return buf.getvalue()
+def load_uploads(slot: str, files, title: str) -> dict:
+    """Parse `files` in a background job, once per distinct upload set.
 
+    Returns {raw_df, load_log, trace, lease}; raw_df is None when there are
+    no files. raw_df comes from the shared dataset cache and is read-only;
+    the lease keeps it cached for as long as this session holds it.
+    """
+    jobs = st.session_state.setdefault('jobs', {})
+    key  = tuple(f.file_id for f in files)
+    done = st.session_state.get(slot)
+    if done is not None and done['key'] == key:
+        return done
+    if not files:
+        st.session_state[slot] = {'key': key, 'raw_df': None, 'load_log': None, 'trace': None,
+                                  'lease': None}
+        st.session_state.pop('analysis', None)
+        return st.session_state[slot]
+
+    if slot not in jobs or jobs[slot].key != key:
+        if slot in jobs:
+            jobs.pop(slot).cancel()
+        if st.session_state.get(f'{slot}_cancelled') == key:
+            st.warning("File parsing was cancelled. Re-upload the files to try again.")
+            st.stop()
+        jobs[slot] = PipelineJob(slot, dataset_cache().load, job_executor(), key=key,
+                                 uploads=[(f.name, f.getvalue()) for f in files])
+
+    job = await_job(slot, title)
+    try:
+        lease = job.result()
+    except JobCancelled:
+        st.session_state[f'{slot}_cancelled'] = key
+        st.warning("File parsing was cancelled. Re-upload the files to try again.")
+        st.stop()
+    except Exception as e:
+        st.error(f"❌ Could not read file: {e}")
+        st.stop()
+    st.session_state[slot] = {'key': key, 'raw_df': lease.df, 'load_log': lease.load_log,
+                              'trace': job.trace, 'lease': lease}
+    st.session_state.pop('analysis', None)
+    return st.session_state[slot]
 
-def to_csv(df: pd.DataFrame) -> bytes:
-    return df.to_csv(index=False, encoding='utf-8-sig').encode('utf-8-sig')
 
+def template_series(loaded: dict) -> dict:
+    """Discovered template series for the loaded upload set, found once per upload.
 
-def generate_high_severity_docx(cannibs: pd.DataFrame,
-                                 query_sum_df: pd.DataFrame) -> bytes:
-    """
-    Generate a Word .docx report matching the High Severity tab layout:
-    - Cover section with summary stats
-    - One section per query: position / impressions header, URL table, suggested action
+    Returns {key, table, trace}; table is None if discovery was cancelled.
     """
-    import subprocess, json, tempfile, os
-
-    high_queries = query_sum_df[query_sum_df['_sev'] == 'High']['Query'].tolist()
-    if not high_queries:
-        return b""
-
-    # Build data structure to pass to JS
-    report_data = []
-    for q in high_queries:
-        qdata = cannibs[cannibs['query'] == q].copy()
-        qdata['_score'] = qdata['impressions'] + (qdata['clicks'] * 10)
-        qdata = qdata.sort_values('_score', ascending=False)
-        best_slug = qdata.iloc[0]['slug']
-        weaker    = qdata.iloc[1:]['slug'].tolist()
-        best_pos  = round(float(qdata['position'].min()), 1)
-        total_imp = int(qdata['impressions'].sum())
-        rows = []
-        for _, r in qdata.iterrows():
-            rows.append({
-                'slug':      str(r['slug']),
-                'clicks':    int(r['clicks']),
-                'impressions': int(r['impressions']),
-                'ctr':       round(float(r['ctr']), 2),
-                'position':  round(float(r['position']), 1),
-                'competing': int(r['competing_pages']),
-                'isBest':    str(r['slug']) == best_slug,
-            })
-        report_data.append({
-            'query':      q,
-            'bestSlug':   best_slug,
-            'weakerSlugs': weaker,
-            'bestPos':    best_pos,
-            'totalImp':   total_imp,
-            'numPages':   len(qdata),
-            'rows':       rows,
-        })
-
-    # Summary stats
-    summary = {
-        'totalHigh':   len(high_queries),
-        'totalImp':    int(query_sum_df[query_sum_df['_sev']=='High']['Impressions'].sum()),
-        'totalClicks': int(query_sum_df[query_sum_df['_sev']=='High']['Url Clicks'].sum()),
-        'date':        pd.Timestamp.now().strftime('%B %d, %Y'),
+    jobs = st.session_state['jobs']
+    key  = (loaded['key'], rules.version)
+    done = st.session_state.get('template_series')
+    if done is not None and done['key'] == key:
+        return done
+    if 'templates' not in jobs or jobs['templates'].key != key:
+        if 'templates' in jobs:
+            jobs.pop('templates').cancel()
+        jobs['templates'] = PipelineJob('templates', discover_template_series, job_executor(),
+                                        key=key, df=loaded['raw_df'])
+
+    job = await_job('templates', "Looking for template page series")
+    try:
+        table = job.result()
+    except JobCancelled:
+        table = None
+    st.session_state['template_series'] = {'key': key, 'table': table, 'trace': job.trace}
+    return st.session_state['template_series']
+
+
+def store_analysis(result: dict, trace: PipelineTrace, estimated: bool = False) -> None:
+    """Make `result` the analysis every table, tab and export below reads."""
+    st.session_state['analysis'] = {
+        **result,
+        'version':   st.session_state.get('analysis_version', 0) + 1,
+        'trace':     trace,
+        'views':     OrderedDict(),
+        'estimated': estimated,
     }
+    st.session_state['analysis_version'] = st.session_state['analysis']['version']
 
-    payload = json.dumps({'summary': summary, 'queries': report_data})
-
-    # Write JS script
-    js_script = r"""
-const fs = require('fs');
-const {
-  Document, Packer, Paragraph, TextRun, Table, TableRow, TableCell,
-  AlignmentType, BorderStyle, WidthType, ShadingType, VerticalAlign,
-} = require('docx');
-
-const data    = JSON.parse(fs.readFileSync(process.argv[2], 'utf8'));
-const summary = data.summary;
-const queries = data.queries;
 
-const NAVY='0F2340', BLUE='1B4F8A', MID_BLUE='2E6DA4', ORANGE='E8651A';
-const WHITE='FFFFFF', BEST_BG='E8F5EE', TABLE_HD='1B4F8A';
-const thinBorder = { style: BorderStyle.SINGLE, size: 1, color: 'D4DFE9' };
-const cellBorder = { top: thinBorder, bottom: thinBorder, left: thinBorder, right: thinBorder };
+@st.cache_resource
+def snapshot_store() -> SnapshotStore:
+    """Process-wide handle on the saved-runs store."""
+    return SnapshotStore()
 
-function spacer(pts) {
-  return new Paragraph({ children:[new TextRun('')], spacing:{before:pts*20,after:0} });
-}
-function sectionRule(color) {
-  return new Paragraph({
-    border:{ bottom:{style:BorderStyle.SINGLE, size:6, color:color||ORANGE, space:1} },
-    spacing:{before:0,after:120}, children:[],
-  });
-}
-function hdrCell(text, width) {
-  return new TableCell({
-    borders:cellBorder, width:{size:width,type:WidthType.DXA},
-    shading:{fill:TABLE_HD, type:ShadingType.CLEAR},
-    margins:{top:80,bottom:80,left:100,right:100},
-    children:[new Paragraph({children:[new TextRun({text,bold:true,color:WHITE,size:18,font:'Arial'})]})],
-  });
-}
-function dataCell(text, width, isBest, alignRight) {
-  return new TableCell({
-    borders:cellBorder, width:{size:width,type:WidthType.DXA},
-    shading:{fill:isBest?BEST_BG:WHITE, type:ShadingType.CLEAR},
-    margins:{top:60,bottom:60,left:100,right:100},
-    children:[new Paragraph({
-      alignment:alignRight?AlignmentType.RIGHT:AlignmentType.LEFT,
-      children:[new TextRun({text:String(text),size:18,font:'Arial',bold:isBest,color:isBest?'1A6B3A':'1A1A2E'})],
-    })],
-  });
-}
-function kpiCell(label, value, width) {
-  return new TableCell({
-    borders:cellBorder, width:{size:width,type:WidthType.DXA},
-    shading:{fill:'D6E8F5', type:ShadingType.CLEAR},
-    margins:{top:100,bottom:100,left:140,right:140},
-    children:[
-      new Paragraph({children:[new TextRun({text:String(value),bold:true,size:32,font:'Arial',color:NAVY})]}),
-      new Paragraph({children:[new TextRun({text:label,size:16,font:'Arial',color:'5A7FA0'})]}),
-    ],
-  });
-}
 
-const children = [];
-
-// Title block
-children.push(new Paragraph({
-  children:[new TextRun({text:'Edstellar  ·  Keyword Cannibalization Report',size:20,font:'Arial',bold:true,color:WHITE})],
-  shading:{fill:NAVY,type:ShadingType.CLEAR},
-  spacing:{before:0,after:0}, indent:{left:200},
-}));
-children.push(new Paragraph({
-  children:[new TextRun({text:'High Severity Issues — Urgent Fixes',size:48,bold:true,font:'Arial',color:WHITE})],
-  shading:{fill:NAVY,type:ShadingType.CLEAR},
-  spacing:{before:120,after:0}, indent:{left:200},
-}));
-children.push(new Paragraph({
-  children:[new TextRun({text:'Best position ≤10  ·  Impressions ≥1,000  ·  Generated: '+summary.date,size:20,font:'Arial',color:'FFB380'})],
-  shading:{fill:NAVY,type:ShadingType.CLEAR},
-  spacing:{before:80,after:280}, indent:{left:200},
-}));
-
-// KPI row
-const kpiW = Math.floor(9360/3);
-children.push(new Table({
-  width:{size:9360,type:WidthType.DXA}, columnWidths:[kpiW,kpiW,9360-kpiW*2],
-  rows:[new TableRow({children:[
-    kpiCell('High Severity Queries', summary.totalHigh, kpiW),
-    kpiCell('Total Impressions at Stake', summary.totalImp.toLocaleString(), kpiW),
-    kpiCell('Total Clicks at Stake', summary.totalClicks.toLocaleString(), 9360-kpiW*2),
-  ]})],
-}));
-children.push(spacer(10));
-children.push(new Paragraph({
-  children:[new TextRun({text:'🚨  These queries rank on page 1 but split click potential across multiple URLs. Consolidating them will have the most direct impact on organic traffic.',size:18,font:'Arial',color:'5A3000',italics:true})],
-  shading:{fill:'FDE8D8',type:ShadingType.CLEAR},
-  border:{left:{style:BorderStyle.SINGLE,size:16,color:ORANGE}},
-  indent:{left:200,right:200}, spacing:{before:100,after:100},
-}));
-children.push(spacer(14));
-children.push(sectionRule(ORANGE));
-
-// Per-query sections
-const COL_WIDTHS=[3200,900,1300,1000,1360,1600];
-const COL_HEADERS=['Landing Page','Url Clicks','Impressions','URL CTR (%)','Average Position','Competing Pages'];
-
-queries.forEach((q,qi)=>{
-  children.push(new Paragraph({
-    children:[
-      new TextRun({text:'🔴  ',size:24,font:'Arial'}),
-      new TextRun({text:q.query,size:26,bold:true,font:'Arial',color:NAVY}),
-      new TextRun({text:'  —  '+q.numPages+' pages · pos '+q.bestPos+' · '+q.totalImp.toLocaleString()+' impressions',size:20,font:'Arial',color:'5A7FA0'}),
-    ],
-    spacing:{before:180,after:80},
-  }));
-
-  const headerCells = COL_HEADERS.map((h,i)=>hdrCell(h,COL_WIDTHS[i]));
-  const dataRows = q.rows.map(row=>new TableRow({children:[
-    dataCell(row.slug,       COL_WIDTHS[0],row.isBest,false),
-    dataCell(row.clicks,     COL_WIDTHS[1],row.isBest,true),
-    dataCell(row.impressions,COL_WIDTHS[2],row.isBest,true),
-    dataCell(row.ctr,        COL_WIDTHS[3],row.isBest,true),
-    dataCell(row.position,   COL_WIDTHS[4],row.isBest,true),
-    dataCell(row.competing,  COL_WIDTHS[5],row.isBest,true),
-  ]}));
-
-  children.push(new Table({
-    width:{size:9360,type:WidthType.DXA}, columnWidths:COL_WIDTHS,
-    rows:[new TableRow({children:headerCells}),...dataRows],
-  }));
-
-  const weakerText = q.weakerSlugs.slice(0,2).join(', ')+(q.weakerSlugs.length>2?` +${q.weakerSlugs.length-2} more`:'');
-  children.push(new Paragraph({
-    children:[
-      new TextRun({text:'Suggested action: ',bold:true,size:18,font:'Arial',color:NAVY}),
-      new TextRun({text:'Consolidate ',size:18,font:'Arial',color:'5A3000'}),
-      new TextRun({text:weakerText,bold:true,size:18,font:'Courier New',color:MID_BLUE}),
-      new TextRun({text:' into ',size:18,font:'Arial',color:'5A3000'}),
-      new TextRun({text:q.bestSlug,bold:true,size:18,font:'Courier New',color:'1A6B3A'}),
-      new TextRun({text:' (highest traffic authority) · use ',size:18,font:'Arial',color:'5A3000'}),
-      new TextRun({text:'rel=canonical',bold:true,size:18,font:'Courier New',color:MID_BLUE}),
-      new TextRun({text:' or 301 redirect on weaker pages · strengthen internal links to ',size:18,font:'Arial',color:'5A3000'}),
-      new TextRun({text:q.bestSlug,bold:true,size:18,font:'Courier New',color:'1A6B3A'}),
-      new TextRun({text:'.',size:18,font:'Arial',color:'5A3000'}),
-    ],
-    shading:{fill:'FFF8E1',type:ShadingType.CLEAR},
-    border:{left:{style:BorderStyle.SINGLE,size:14,color:'F0A500',space:1}},
-    indent:{left:160,right:160}, spacing:{before:80,after:80},
-  }));
-
-  if(qi<queries.length-1){ children.push(spacer(6)); children.push(sectionRule('D4DFE9')); }
-});
-
-// Footer
-children.push(spacer(20));
-children.push(new Paragraph({
-  children:[new TextRun({text:'Generated by Edstellar Keyword Cannibalization Finder  ·  '+summary.date,size:16,font:'Arial',color:'8BA3BC',italics:true})],
-  alignment:AlignmentType.CENTER,
-  border:{top:{style:BorderStyle.SINGLE,size:2,color:'D4DFE9',space:4}},
-  spacing:{before:200,after:0},
-}));
-
-const doc = new Document({
-  styles:{ default:{ document:{ run:{ font:'Arial', size:20 } } } },
-  sections:[{
-    properties:{ page:{ size:{width:12240,height:15840}, margin:{top:720,right:900,bottom:900,left:900} } },
-    children,
-  }],
-});
-
-Packer.toBuffer(doc).then(buf=>{ fs.writeFileSync(process.argv[3],buf); console.log('OK '+buf.length+' bytes'); })
-  .catch(e=>{ console.error(e.message); process.exit(1); });
-"""
+def open_snapshot(run_id: str) -> bool:
+    """Make saved run `run_id` the current analysis; False if it's unknown or expired."""
+    trace = PipelineTrace('saved run')
+    try:
+        result = snapshot_store().load(run_id, trace=trace)
+    except SnapshotError as e:
+        st.warning(f"Saved runs are unavailable: {e}")
+        return False
+    if result is None:
+        return False
+    store_analysis({**result, 'run_id': run_id}, trace)
+    return True
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        data_file = os.path.join(tmpdir, 'data.json')
-        out_file  = os.path.join(tmpdir, 'report.docx')
-        js_file   = os.path.join(tmpdir, 'gen.js')
 
-        with open(data_file, 'w') as f:
-            f.write(payload)
-        with open(js_file, 'w') as f:
-            f.write(js_script)
+# Template rules are compiled once per process and reloaded when the file changes
+try:
+    rules = load_rules()
+except RuleError as e:
+    st.error(f"❌ Template rules could not be loaded: {e}")
+    st.stop()
 
-        result = subprocess.run(
-            ['node', js_file, data_file, out_file],
-            capture_output=True, text=True, timeout=30,
-            env={**os.environ, 'NODE_PATH': '/home/claude/.npm-global/lib/node_modules'}
-        )
-        if result.returncode != 0:
-            raise RuntimeError(f"Doc generation failed: {result.stderr}")
 
-        with open(out_file, 'rb') as f:
-            return f.read()
+# Uploads at least this big get a sampled preview while the exact analysis runs
+PREVIEW_MIN_ROWS = 200_000
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -777,10 +587,32 @@ with st.sidebar:
                                    help="Strips URL variants with #section anchors — these are the same page")
     filter_templates = st.checkbox("Remove geo-templated pages",   value=True,
                                    help="Excludes corporate-training-companies-<country>, skills-in-demand-in-<country>, <country>-work-culture, etc. These are intentionally different pages targeting different regions")
+    st.caption(f"Template rules `{rules.version}` from `{rules.path.name}` · {len(rules.sites)} site(s) · "
+               f"{len(rules.segments.labels)} query segmentation(s), {rules.segments.n_terms:,} terms")
+    if rules_error():
+        st.warning(f"Rules file edit not applied — still using the last good rules. {rules_error()}")
+
+    st.markdown('<div class="sidebar-section">Saved Runs</div>', unsafe_allow_html=True)
+    try:
+        saved_runs = snapshot_store().runs(limit=10)
+    except SnapshotError as e:
+        saved_runs = None
+        st.caption(f"Saved runs are unavailable: {e}")
+    if saved_runs is not None and saved_runs.empty:
+        st.caption("Finished analyses are saved here with a run ID you can share.")
+    elif saved_runs is not None:
+        st.markdown("  \n".join(
+            f"[`{r.run_id}`](?run={r.run_id}) · {pd.Timestamp(r.created, unit='s'):%d %b %H:%M} · "
+            f"{r.queries:,} queries · {', '.join(r.settings.get('files', []))[:40]}"
+            for r in saved_runs.itertuples()))
 
     st.markdown('<div class="sidebar-section">Display</div>', unsafe_allow_html=True)
     show_full_urls   = st.checkbox("Show full URLs",          value=False)
     group_by_query   = st.checkbox("Group results by query",  value=True)
+    quick_preview    = st.checkbox("Quick preview on large files", value=True,
+                                   help=f"Files over {PREVIEW_MIN_ROWS:,} rows first show estimates from a "
+                                        f"{PREVIEW_SAMPLE_QUERIES:,}-query sample (busiest queries always included), "
+                                        f"then switch to exact numbers once the full analysis finishes")
 
     st.markdown('<div class="sidebar-section">Recommended Settings</div>', unsafe_allow_html=True)
     st.markdown("""
@@ -827,19 +659,42 @@ with st.expander("📋 How to export from Google Search Console", expanded=False
         - Semrush / Ahrefs GSC-linked exports
         - Custom exports with `Avg Position` column names
 
-        **Supported file types:** `.csv`
+        **Supported file types:** `.csv`, `.csv.gz`, `.xlsx`, `.zip` (of those) — drop several at once;
+        overlapping rows across files are de-duplicated
         """)
 
-uploaded_file = st.file_uploader(
-    "Drop your GSC CSV here",
-    type=["csv"],
+uploaded_files = st.file_uploader(
+    "Drop your GSC CSVs here",
+    type=UPLOAD_TYPES,
+    accept_multiple_files=True,
     label_visibility="collapsed",
 )
 
-if uploaded_file is None:
+with st.expander("📈 Compare with a previous period (optional)", expanded=False):
+    st.markdown(
+        "Upload the export for the period **before** your redirects / consolidations shipped. "
+        "Both periods go through the same filters, and their conflicts are diffed query by query "
+        "into **new**, **resolved** and **persisting** (worsening / improving) issues."
+    )
+    prev_files = st.file_uploader(
+        "Previous-period GSC export(s)",
+        type=UPLOAD_TYPES,
+        accept_multiple_files=True,
+        key="prev_uploader",
+    )
+
+# A saved run in the URL (?run=<id>) opens once, without any uploads or recomputation
+run_param = st.query_params.get('run')
+if run_param and st.session_state.get('opened_run') != run_param:
+    st.session_state['opened_run'] = run_param
+    if not open_snapshot(run_param):
+        st.warning(f"Saved run `{run_param}` was not found — it may have expired. Upload the files to analyse them again.")
+viewing_saved = 'snapshot' in st.session_state.get('analysis', {})
+
+if not uploaded_files and not viewing_saved:
     st.markdown("""
     <div class="info-box">
-    👆 Upload a CSV export from Google Search Console to get started.
+    👆 Upload one or more CSV exports from Google Search Console (CSV, .gz, .xlsx or .zip) to get started.
     The file must contain columns for <strong>Query</strong>, <strong>Page</strong>,
     <strong>Clicks</strong>, <strong>Impressions</strong>, and <strong>Position</strong>.
     </div>
@@ -875,17 +730,55 @@ if uploaded_file is None:
 # LOAD & PREVIEW
 # ══════════════════════════════════════════════════════════════════════════════
 
-try:
-    raw_df = pd.read_csv(uploaded_file, dtype=str)
-    raw_df = read_gsc_data(raw_df)
-except Exception as e:
-    st.error(f"❌ Could not read file: {e}")
-    st.stop()
+# Parsed uploads and the last analysis live in session state so that widget
+# interactions (paging, sorting, display toggles) don't re-parse or re-analyse.
+# Parsing itself runs as a background job — see load_uploads().
+if uploaded_files:
+    loaded      = load_uploads('load', uploaded_files, "Reading uploaded files")
+    prev_loaded = load_uploads('prev_load', prev_files or [], "Reading previous-period files")
 
-st.success(f"✅ Loaded **{len(raw_df):,} rows** from `{uploaded_file.name}`")
+    raw_df      = loaded['raw_df']
+    load_log    = loaded['load_log']
+    prev_raw_df = prev_loaded['raw_df']
 
-with st.expander("👁 Preview raw data (first 20 rows)"):
-    st.dataframe(raw_df.head(20), use_container_width=True, hide_index=True)
+    if len(load_log['files']) == 1:
+        st.success(f"✅ Loaded **{len(raw_df):,} rows** from `{load_log['files'][0][0]}`")
+    else:
+        st.success(
+            f"✅ Loaded **{len(raw_df):,} rows** from **{len(load_log['files'])} files**"
+            + (f" · {load_log['duplicates_removed']:,} overlapping (query, page) rows de-duplicated"
+               if load_log['duplicates_removed'] else "")
+        )
+        with st.expander("📂 Files loaded"):
+            st.dataframe(pd.DataFrame(load_log['files'], columns=['File', 'Rows']),
+                         use_container_width=True, hide_index=True)
+    if loaded['lease'].shared_with:
+        st.caption(f"♻️ This export is already open in {loaded['lease'].shared_with} other "
+                   f"session(s) — they all share one parsed copy.")
+
+    if prev_raw_df is not None:
+        st.info(f"📈 Previous period loaded: **{len(prev_raw_df):,} rows** — results will include a Period Compare tab")
+
+    with st.expander("👁 Preview raw data (first 20 rows)"):
+        st.dataframe(raw_df.head(20), use_container_width=True, hide_index=True)
+
+    series = template_series(loaded)
+    extra_templates = []
+    if series['table'] is not None and not series['table'].empty:
+        with st.expander(f"🧩 Template series found in this data ({len(series['table']):,})"):
+            st.caption("Page families whose slugs differ in one spot — new geo or city series show up "
+                       "here before anyone adds them to the built-in patterns. **Shared Queries** counts "
+                       "queries where two or more pages of a family compete. Tick **Apply** to filter a "
+                       "series out on the next run.")
+            edited = st.data_editor(
+                series['table'].assign(Apply=False)[['Apply', *series['table'].columns]],
+                disabled=list(series['table'].columns), hide_index=True, use_container_width=True,
+                key=f"template_editor_{hash(loaded['key'])}",
+            )
+            extra_templates = edited.loc[edited['Apply'], 'Template'].tolist()
+else:
+    # Viewing a saved run with nothing uploaded
+    loaded = prev_loaded = series = {'trace': None}
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -893,9 +786,16 @@ with st.expander("👁 Preview raw data (first 20 rows)"):
 # ══════════════════════════════════════════════════════════════════════════════
 
 st.markdown("")
-run = st.button("🔍 Find Cannibalization Issues", type="primary", use_container_width=False)
-
-if not run:
+run = st.button("🔍 Find Cannibalization Issues", type="primary", use_container_width=False) if uploaded_files else False
+
+jobs = st.session_state.setdefault('jobs', {})
+current = st.session_state.get('analysis', {})
+# A saved run keeps the rules it ran with; only live results go stale
+stale = 'snapshot' not in current and current.get('rules_version', rules.version) != rules.version
+if stale and not run and not {'preview', 'analysis'} & jobs.keys():
+    st.session_state.pop('analysis')
+    st.info("🔄 The template rules file changed since the last run — run the analysis again to apply it.")
+if not run and 'analysis' not in st.session_state and not {'preview', 'analysis'} & jobs.keys():
     st.markdown("""
     <div class="filter-note">
     ⚙️ Configure filters in the sidebar, then click <strong>Find Cannibalization Issues</strong> above.
@@ -908,23 +808,242 @@ if not run:
 # PROCESSING
 # ══════════════════════════════════════════════════════════════════════════════
 
-with st.spinner("Analysing keyword cannibalization…"):
-    filtered_df, audit = apply_filters(
-        raw_df.copy(),
-        pos_min=pos_min, pos_max=pos_max,
-        min_impressions=min_impressions, min_clicks=min_clicks,
-        filter_anchors=filter_anchors, filter_templates=filter_templates,
-    )
-
-    if filtered_df.empty:
-        st.warning("No rows remain after applying filters. Try relaxing the position range or impression threshold.")
+if run:
+    for slot in ('preview', 'analysis'):
+        if slot in jobs:
+            jobs.pop(slot).cancel()
+    st.session_state.pop('analysis', None)
+    st.query_params.pop('run', None)
+    params = dict(pos_min=pos_min, pos_max=pos_max,
+                  min_impressions=min_impressions, min_clicks=min_clicks, min_pages=min_pages,
+                  filter_anchors=filter_anchors, filter_templates=filter_templates,
+                  extra_templates=extra_templates)
+    settings = dict(params, files=[name for name, _ in load_log['files']], rows=len(raw_df),
+                    previous_files=[name for name, _ in (prev_loaded['load_log'] or {}).get('files', [])])
+    fingerprint = load_log['fingerprint'] + (
+        ':' + prev_loaded['load_log']['fingerprint'] if prev_raw_df is not None else '')
+    exact = dict(raw_df=raw_df, prev_raw_df=prev_raw_df, store=snapshot_store(),
+                 fingerprint=fingerprint, settings=settings, cube=True, **params)
+    if quick_preview and len(raw_df) >= PREVIEW_MIN_ROWS:
+        # The exact run starts once the preview is in, so the two don't share the CPU
+        jobs['preview'] = PipelineJob('preview', analyze_preview, job_executor(),
+                                      raw_df=raw_df, **params)
+        st.session_state['exact_params'] = exact
+    else:
+        jobs['analysis'] = PipelineJob('analysis', analyze_and_save, job_executor(), **exact)
+
+if 'preview' in jobs:
+    job = await_job('preview', "Sampling for a quick preview…")
+    exact = st.session_state.pop('exact_params')
+    try:
+        store_analysis(job.result(), job.trace, estimated=True)
+    except JobCancelled:
+        st.warning("Analysis cancelled. Adjust the filters and run it again.")
         st.stop()
+    jobs['analysis'] = PipelineJob('analysis', analyze_and_save, job_executor(), **exact)
+
+previewing = st.session_state.get('analysis', {}).get('estimated', False)
+if 'analysis' in jobs and not (previewing and not jobs['analysis'].done()):
+    job = await_job('analysis', "Analysing keyword cannibalization…")
+    try:
+        store_analysis(job.result(), job.trace)
+        if st.session_state['analysis'].get('run_id'):
+            st.query_params['run'] = st.session_state['opened_run'] = st.session_state['analysis']['run_id']
+    except JobCancelled:
+        if not previewing:
+            st.warning("Analysis cancelled. Adjust the filters and run it again.")
+            st.stop()
+        st.warning("Exact analysis cancelled — the numbers below are still sample estimates.")
+
+analysis  = st.session_state['analysis']
+audit     = analysis['audit']
+
+DIMENSION_LABELS = {'country': 'Country', 'device': 'Device',
+                    'appearance': 'Search appearance', 'date': 'Date'}
+# Drill-down views kept per analysis (each holds its slice, summary and export bytes)
+MAX_VIEWS = 8
+
+
+def analysis_view(selection: dict[str, list[str]]) -> dict:
+    """cannibs, query_sum and exports for one drill-down selection, cached per analysis.
+
+    The full view is the analysis itself; slices come from its dimension cube.
+    Only the MAX_VIEWS most recently shown selections are kept.
+    """
+    key = tuple((d, tuple(v)) for d, v in selection.items() if v)
+    views = analysis['views']
+    if key in views:
+        views.move_to_end(key)
+    else:
+        if not key:
+            views[key] = {'cannibs': analysis['cannibs'], 'query_sum': analysis['query_sum']}
+        else:
+            label = ' · '.join(f"{DIMENSION_LABELS[d]}: {', '.join(v)}" for d, v in key)
+            with analysis['trace'].stage(f"slice: {label}") as rec:
+                sliced = analysis['cube'].slice(selection, analysis['min_pages'])
+                qs = pd.DataFrame()
+                if not sliced.empty:
+                    qs = build_query_summary(sliced)
+                    qs['_sev'] = severity_labels(qs['Best Average Position'], qs['Impressions'])
+                rec['rows_out'] = len(sliced)
+            views[key] = {'cannibs': sliced, 'query_sum': qs}
+        views[key].update(key=key, exports={})
+        while len(views) > MAX_VIEWS:
+            views.popitem(last=False)
+    return views[key]
+
+
+def redirect_map(view: dict) -> tuple[pd.DataFrame, dict]:
+    """The view's site-wide redirect map and its counts, built on first use."""
+    if 'redirects' not in view:
+        view['redirects'] = build_redirect_map(view['cannibs'], trace=analysis['trace'])
+    return view['redirects']
+
+
+def collect_page_meta(view: dict) -> None:
+    """Attach a finished page-metadata job to its view, rescoring slug similarity with titles."""
+    jobs = st.session_state.setdefault('jobs', {})
+    job = jobs.get('page_meta')
+    if job is None or not job.done():
+        return
+    jobs.pop('page_meta')
+    if job.key != (analysis['version'], view['key']):
+        return
+    try:
+        meta = job.result()
+    except JobCancelled:
+        return
+    except Exception as e:
+        st.warning(f"Fetching page metadata failed: {e}")
+        return
+    # page_meta_id identifies this fetch, so tables and exports keyed on it refresh
+    view.update(page_meta=meta, page_meta_trace=job.trace, page_meta_id=job.trace.run_id)
+    if not view['query_sum'].empty and meta['title'].notna().any():
+        view['query_sum'] = add_similarity(view['query_sum'], view['cannibs'],
+                                           titles=meta.set_index('slug')['title'], trace=job.trace)
+        view['exports'].clear()
+        view.pop('priority', None)
+
+
+def cached_export(name: str, build, variant=None, rows: int | None = None) -> bytes | None:
+    """Export bytes, built once per analysis view (and display variant) on the job executor.
+
+    Returns None while the export is still being built. Build errors are
+    re-raised here.
+    """
+    key = (name, variant)
+    if key not in view['exports']:
+        trace = analysis['trace']
+
+        def _build():
+            with trace.stage(f"export: {name}", rows_in=rows, concurrent=True):
+                return build()
+
+        view['exports'][key] = job_executor().submit(_build)
+    fut = view['exports'][key]
+    return fut.result() if fut.done() else None
+
+
+def export_button(label: str, name: str, build, file_name: str, mime: str,
+                  variant=None, rows: int | None = None) -> None:
+    """Download button for a background export, greyed out until it's ready."""
+    if analysis['estimated']:
+        st.button(f"⏳ {label.split(' ', 1)[-1]} — available with exact results", disabled=True,
+                  key=f"estimated_{name}_{variant}")
+        return
+    data = cached_export(name, build, variant=variant, rows=rows)
+    if data is None:
+        st.button(f"⏳ {label.split(' ', 1)[-1]} — preparing…", disabled=True,
+                  key=f"pending_{name}_{variant}")
+    else:
+        st.download_button(label, data=data, file_name=file_name, mime=mime)
 
-    cannibs    = find_cannibalization(filtered_df, min_pages)
-    query_sum  = build_query_summary(cannibs) if not cannibs.empty else pd.DataFrame()
 
-if cannibs.empty:
-    st.warning("No cannibalization issues found with the current filters. Try increasing Max Position or lowering Min Impressions.")
+@st.fragment(run_every=0.5)
+def _exports_ready() -> None:
+    """Rerun once every pending export has finished, to swap in its download button."""
+    if all(fut.done() for fut in view['exports'].values()):
+        st.rerun()
+
+
+def watch_exports() -> None:
+    """Keep polling while any of this view's exports is still being built."""
+    if not all(fut.done() for fut in view['exports'].values()):
+        _exports_ready()
+
+
+def period_compare() -> None:
+    """The Period Compare tab: previous → current conflicts, same filters."""
+    query_diff = analysis['compare']['query_diff']
+    pair_diff  = analysis['compare']['pair_diff']
+    status_counts = query_diff['Status'].value_counts()
+    n_worse = int((query_diff['Trend'] == 'Worsening').sum())
+    n_better = int((query_diff['Trend'] == 'Improving').sum())
+
+    st.markdown("#### Previous period → current period, same filters")
+    st.markdown(f"""
+    <div class="kpi-row">
+        <div class="kpi-card danger">
+            <div class="kpi-label">New Conflicts</div>
+            <div class="kpi-value">{status_counts.get('New', 0):,}</div>
+            <div class="kpi-sub">not cannibalized before</div>
+        </div>
+        <div class="kpi-card success">
+            <div class="kpi-label">Resolved</div>
+            <div class="kpi-value">{status_counts.get('Resolved', 0):,}</div>
+            <div class="kpi-sub">no longer competing</div>
+        </div>
+        <div class="kpi-card accent">
+            <div class="kpi-label">Persisting</div>
+            <div class="kpi-value">{status_counts.get('Persisting', 0):,}</div>
+            <div class="kpi-sub">{n_worse:,} worsening · {n_better:,} improving</div>
+        </div>
+    </div>
+    """, unsafe_allow_html=True)
+
+    paged_dataframe(query_diff, key='compare_table', version=analysis['version'])
+
+    with st.expander("Landing-page changes per query (added / removed / kept)"):
+        paged_dataframe(pair_diff, key='compare_pairs', version=analysis['version'])
+
+    cd1, cd2 = st.columns(2)
+    with cd1:
+        export_button("📥 Download Query Diff CSV", 'compare csv', lambda: to_csv(query_diff),
+            file_name="cannibalization_period_compare.csv", mime="text/csv",
+            rows=len(query_diff))
+    with cd2:
+        export_button("📥 Download Page Changes CSV", 'compare pairs csv', lambda: to_csv(pair_diff),
+            file_name="cannibalization_period_compare_pages.csv", mime="text/csv",
+            rows=len(pair_diff))
+
+
+def compare_before_stop() -> None:
+    """Results stop early when nothing conflicts now — which is when the period
+    comparison (everything resolved) matters most, so draw it before stopping."""
+    if analysis['compare'] is None:
+        return
+    st.markdown('<div class="section-hdr">📈 Period Compare</div>', unsafe_allow_html=True)
+    period_compare()
+    watch_exports()
+
+
+if analysis['estimated']:
+    sample = analysis['sample']
+    st.markdown(
+        f'<div class="filter-note">🔬 <strong>Preview — estimated.</strong> Figures come from '
+        f'{sample["queries"]:,} of {sample["of_queries"]:,} queries ({sample["rows"]:,} of '
+        f'{sample["of_rows"]:,} rows), sampled by impression band with the busiest queries '
+        f'always included. Tables list sampled queries only; exports unlock with the exact '
+        f'results, which replace this preview automatically.</div>',
+        unsafe_allow_html=True,
+    )
+    if 'analysis' in jobs:
+        _job_progress('analysis', "Refining to exact numbers…")
+
+if audit['after'] == 0:
+    st.warning("No rows remain after applying filters. Try relaxing the position range or impression threshold.")
+    view = analysis_view({})
+    compare_before_stop()
     st.stop()
 
 
@@ -934,8 +1053,32 @@ if cannibs.empty:
 
 st.markdown('<div class="section-hdr">Analysis Results</div>', unsafe_allow_html=True)
 
+# ── Dimension drill-down ──────────────────────────────────────────────────────
+cube = analysis.get('cube')
+selection = {}
+if cube is not None and not analysis['estimated']:
+    drill_cols = st.columns(len(cube.dims))
+    for col, dim in zip(drill_cols, cube.dims):
+        with col:
+            selection[dim] = st.multiselect(
+                DIMENSION_LABELS[dim], cube.values[dim], key=f"drill_{dim}",
+                placeholder="All", help=f"Only count rows for these {DIMENSION_LABELS[dim].lower()} values")
+
+view      = analysis_view(selection)
+collect_page_meta(view)
+cannibs   = view['cannibs']
+query_sum = view['query_sum']
+
+if cannibs.empty:
+    if view['key']:
+        st.warning("No cannibalization issues in this slice. Widen the drill-down selection above.")
+    else:
+        st.warning("No cannibalization issues found with the current filters. Try increasing Max Position or lowering Min Impressions.")
+    compare_before_stop()
+    st.stop()
+
 # ── Filter audit strip ─────────────────────────────────────────────────────────
-audit_parts = [f"**{audit['before']:,}** rows loaded"]
+audit_parts = [f"**{audit['before']:,}** rows {'sampled' if analysis['estimated'] else 'loaded'}"]
 if audit['anchors_removed']:
     audit_parts.append(f"**{audit['anchors_removed']:,}** anchor-URL rows removed")
 if audit['templates_removed']:
@@ -947,50 +1090,64 @@ st.markdown(
     unsafe_allow_html=True
 )
 
+snapshot = analysis.get('snapshot')
+if snapshot:
+    saved = snapshot['settings']
+    st.markdown(
+        f'<div class="filter-note">📌 <strong>Saved run <code>{snapshot["run_id"]}</code></strong> from '
+        f'{pd.Timestamp(snapshot["created"], unit="s"):%d %b %Y %H:%M} UTC · '
+        f'{saved.get("rows", 0):,} rows from {", ".join(map(html.escape, saved.get("files", []))) or "uploaded files"} · '
+        f'positions {saved["pos_min"]}–{saved["pos_max"]}, ≥{saved["min_impressions"]:,} impressions, '
+        f'≥{saved["min_clicks"]:,} clicks, ≥{saved["min_pages"]} pages. Reopened as saved — upload the '
+        f'files and run again to change filters or drill into dimensions.</div>',
+        unsafe_allow_html=True,
+    )
+elif analysis.get('run_id'):
+    st.caption(f"🔗 Saved as run `{analysis['run_id']}` — this page's URL (`?run={analysis['run_id']}`) reopens it.")
+elif analysis.get('snapshot_error'):
+    st.caption(f"⚠️ This run wasn't saved: {analysis['snapshot_error']}")
+
+# Filled in at the end of the script, once this rerun's exports are timed too
+perf_slot = st.empty()
+
 # ── KPI cards ─────────────────────────────────────────────────────────────────
-n_queries   = cannibs['query'].nunique()
-n_pages     = len(cannibs)
-total_impr  = int(cannibs['impressions'].sum())
-total_clicks= int(cannibs['clicks'].sum())
-avg_pages   = round(cannibs.groupby('query')['slug'].count().mean(), 1)
-max_pages   = int(cannibs['competing_pages'].max())
-
-query_sum['_sev'] = query_sum.apply(
-    lambda r: severity(r['Best Average Position'], r['Impressions']), axis=1)
-n_high   = len(query_sum[query_sum['_sev']=='High'])
-n_medium = len(query_sum[query_sum['_sev']=='Medium'])
-n_low    = len(query_sum[query_sum['_sev']=='Low'])
+kpis = analysis['estimate'] if analysis['estimated'] else cannibalization_kpis(cannibs, query_sum)
+est  = '≈' if analysis['estimated'] else ''
+n_queries, n_high, n_medium, n_low, total_impr, total_clicks = (
+    f"{est}{kpis[k]:,.0f}" for k in ('queries', 'high', 'medium', 'low', 'impressions', 'clicks'))
+avg_pages = f"{est}{kpis['avg_pages']}"
+max_pages = f"{kpis['max_pages']}{' in sample' if analysis['estimated'] else ''}"
 
 st.markdown(f"""
 <div class="kpi-row">
     <div class="kpi-card">
         <div class="kpi-label">Conflicting Queries</div>
-        <div class="kpi-value">{n_queries:,}</div>
+        <div class="kpi-value">{n_queries}</div>
         <div class="kpi-sub">unique search terms</div>
     </div>
     <div class="kpi-card danger">
         <div class="kpi-label">High Severity</div>
-        <div class="kpi-value">{n_high:,}</div>
+        <div class="kpi-value">{n_high}</div>
         <div class="kpi-sub">pos ≤10 · impr ≥1K</div>
     </div>
     <div class="kpi-card accent">
         <div class="kpi-label">Medium Severity</div>
-        <div class="kpi-value">{n_medium:,}</div>
+        <div class="kpi-value">{n_medium}</div>
         <div class="kpi-sub">pos ≤20 · impr ≥200</div>
     </div>
     <div class="kpi-card success">
         <div class="kpi-label">Low Severity</div>
-        <div class="kpi-value">{n_low:,}</div>
+        <div class="kpi-value">{n_low}</div>
         <div class="kpi-sub">lower priority</div>
     </div>
     <div class="kpi-card">
         <div class="kpi-label">Impressions at Stake</div>
-        <div class="kpi-value">{total_impr:,}</div>
+        <div class="kpi-value">{total_impr}</div>
         <div class="kpi-sub">across all conflicts</div>
     </div>
     <div class="kpi-card">
         <div class="kpi-label">Clicks at Stake</div>
-        <div class="kpi-value">{total_clicks:,}</div>
+        <div class="kpi-value">{total_clicks}</div>
         <div class="kpi-sub">across all conflicts</div>
     </div>
     <div class="kpi-card">
@@ -1001,13 +1158,58 @@ st.markdown(f"""
 </div>
 """, unsafe_allow_html=True)
 
+# ── Segment cards ─────────────────────────────────────────────────────────────
+segment_kpis = kpis.get('segments') or {}
+if segment_kpis:
+    seg_dim = st.radio("Break down by segment", list(segment_kpis), horizontal=True, key='segment_dim',
+                       help="Segments come from the \"segments\" dictionary in the rules file")
+    seg_total = sum(s['impressions'] for s in segment_kpis[seg_dim]) or 1
+    st.markdown('<div class="kpi-row">' + ''.join(f"""
+    <div class="kpi-card">
+        <div class="kpi-label">{html.escape(s['segment'])}</div>
+        <div class="kpi-value">{est}{s['queries']:,.0f}</div>
+        <div class="kpi-sub">{est}{s['high']:,.0f} high · {s['impressions'] / seg_total:.0%} of impressions</div>
+    </div>""" for s in segment_kpis[seg_dim]) + '</div>', unsafe_allow_html=True)
+
+# ── Search ─────────────────────────────────────────────────────────────────────
+SEARCH_LIMIT = 50
+
+search_text = st.text_input(
+    "🔎 Search queries and landing pages",
+    placeholder="e.g. power bi train — every word must match the start of a word in the query or a competing slug",
+    key='result_search')
+if search_text.strip() and not cannibs.empty:
+    if 'search' not in view:
+        # Built once per analysis view; every keystroke after that is a lookup
+        with st.spinner("Indexing queries and slugs…"):
+            view['search'] = SearchIndex(cannibs, trace=analysis['trace'])
+    t0 = time.perf_counter()
+    found, n_found = view['search'].search(search_text, limit=SEARCH_LIMIT)
+    took_ms = (time.perf_counter() - t0) * 1000
+    if n_found == 0:
+        st.caption(f"No query groups match “{search_text}” ({took_ms:.0f} ms).")
+    else:
+        st.caption(f"{n_found:,} query groups match · showing the top {min(n_found, SEARCH_LIMIT)} "
+                   f"by impressions with their competing pages · {took_ms:.0f} ms")
+        found = rename_for_display(found)
+        found.insert(2, 'Severity', severity_labels(found['Average Position'], found['Impressions']))
+        if view.get('page_meta') is not None:
+            found = with_page_meta(found, view['page_meta'])
+        if not show_full_urls:
+            found['Landing Page'] = found['Landing Page'].str[:70]
+        st.dataframe(found, use_container_width=True, hide_index=True)
+
 # ── Tabs ───────────────────────────────────────────────────────────────────────
-tab1, tab2, tab3, tab4 = st.tabs([
+tab_labels = [
     "📋 Query Summary",
     "🔍 Detail View",
     "🔴 High Severity",
     "💡 Recommendations",
-])
+]
+if analysis['compare'] is not None:
+    tab_labels.append("📈 Period Compare")
+tabs = st.tabs(tab_labels)
+tab1, tab2, tab3, tab4 = tabs[:4]
 
 # ─────────────────────────────────────────────────────────────────────────────
 # TAB 1: Query Summary
@@ -1016,15 +1218,15 @@ with tab1:
     st.markdown("#### One row per query — all competing slugs listed inline")
 
     display_qs = query_sum.copy()
-    display_qs.insert(2, 'Severity',
-        display_qs.apply(lambda r: severity(r['Best Average Position'], r['Impressions']), axis=1))
+    display_qs.insert(2, 'Severity', display_qs['_sev'])
 
     if not show_full_urls:
         display_qs['Best Landing Page'] = display_qs['Best Landing Page'].str[:60]
         display_qs['All Landing Pages'] = display_qs['All Landing Pages'].str[:120]
 
-    st.dataframe(display_qs.drop(columns=['_sev'], errors='ignore'),
-                 use_container_width=True, hide_index=True)
+    paged_dataframe(display_qs.drop(columns=['_sev'], errors='ignore'),
+                    key='summary_table',
+                    version=(analysis['version'], view['key'], show_full_urls, view.get('page_meta_id')))
 
     # Build detail export — referenced by Excel download button
     detail_export = cannibs.rename(columns={
@@ -1036,17 +1238,18 @@ with tab1:
 
     dl1, dl2 = st.columns(2)
     with dl1:
-        st.download_button("📥 Download CSV",
-            data=to_csv(display_qs.drop(columns=['_sev'], errors='ignore')),
-            file_name="cannibalization_query_summary.csv", mime="text/csv")
+        export_button("📥 Download CSV", 'summary csv',
+            lambda: to_csv(display_qs.drop(columns=['_sev'], errors='ignore')),
+            file_name="cannibalization_query_summary.csv", mime="text/csv",
+            variant=show_full_urls, rows=len(display_qs))
     with dl2:
-        st.download_button("📥 Download Excel",
-            data=to_excel({
+        export_button("📥 Download Excel", 'excel report', lambda: to_excel({
                 'Query Summary': display_qs.drop(columns=['_sev'], errors='ignore'),
                 'Detail View': detail_export,
             }),
             file_name="cannibalization_report.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            variant=show_full_urls, rows=len(display_qs) + len(detail_export))
 
 # ─────────────────────────────────────────────────────────────────────────────
 # TAB 2: Detail View
@@ -1063,15 +1266,56 @@ with tab2:
 
     # Severity column
     detail_display.insert(2, 'Severity',
-        detail_display.apply(lambda r: severity(r['Average Position'], r['Impressions']), axis=1))
+        severity_labels(detail_display['Average Position'], detail_display['Impressions']))
+
+    # ── Optional page metadata (title / H1 / canonical) ──
+    jobs = st.session_state['jobs']
+    meta_job = jobs.get('page_meta')
+    meta = view.get('page_meta')
+    if meta is not None:
+        detail_display = with_page_meta(detail_display, meta)
+
+    with st.expander("🌐 Page titles, H1s and canonicals", expanded=meta_job is not None):
+        if meta_job is not None:
+            _job_progress('page_meta', "Fetching competing pages")
+        else:
+            if meta is not None:
+                failed = int(meta['error'].notna().sum())
+                st.caption(f"{len(meta):,} pages · {int(meta['cached'].sum()):,} from cache · "
+                           f"{failed:,} could not be read (see Page Status)")
+            st.caption("Fetches the competing pages to compare their titles, H1s and canonical tags — "
+                       "pages canonicalized elsewhere or sharing a title are the first to merge.")
+            mc1, mc2 = st.columns([2, 1])
+            with mc1:
+                site_root = st.text_input(
+                    "Site root", placeholder="https://www.example.com/",
+                    help="Used for slugs with no full URL in the uploaded data (e.g. saved runs). "
+                         "Only public http(s) hosts are fetched unless KCF_FETCH_PRIVATE=1 is set.")
+            with mc2:
+                n_slugs = int(cannibs['slug'].nunique()) if not cannibs.empty else 0
+                meta_limit = st.number_input("Pages to fetch (most impressions first)",
+                                             min_value=1, max_value=max(n_slugs, 1),
+                                             value=min(500, max(n_slugs, 1)), step=50)
+            if st.button("🌐 Fetch page metadata", disabled=analysis['estimated'] or cannibs.empty,
+                         help="Available once exact results are in" if analysis['estimated'] else None):
+                jobs['page_meta'] = PipelineJob('page metadata', fetch_page_meta, job_executor(),
+                                                key=(analysis['version'], view['key']),
+                                                cannibs=cannibs,
+                                                fetcher=page_meta_fetcher(),
+                                                raw_df=loaded.get('raw_df'),
+                                                site_root=site_root or None, limit=meta_limit)
+                st.rerun()
+            if meta is not None and meta.empty:
+                st.caption("No page URLs known for these slugs — enter the site root above.")
 
     if not show_full_urls:
         detail_display['Landing Page'] = detail_display['Landing Page'].str[:70]
 
-    st.dataframe(detail_display, use_container_width=True, hide_index=True)
-    st.download_button("📥 Download Detail CSV",
-        data=to_csv(detail_display),
-        file_name="cannibalization_detail.csv", mime="text/csv")
+    paged_dataframe(detail_display, key='detail_table',
+                    version=(analysis['version'], view['key'], show_full_urls, view.get('page_meta_id')))
+    export_button("📥 Download Detail CSV", 'detail csv', lambda: to_csv(detail_display),
+        file_name="cannibalization_detail.csv", mime="text/csv",
+        variant=(show_full_urls, view.get('page_meta_id')), rows=len(detail_display))
 
 # ─────────────────────────────────────────────────────────────────────────────
 # TAB 3: High Severity
@@ -1097,6 +1341,10 @@ with tab3:
             'competing_pages': 'Competing Pages',
         })
 
+        # Actions follow the site-wide redirect map, not each query's own winner
+        redirects   = redirect_map(view)[0]
+        redirect_to = dict(zip(redirects['Redirect From'], redirects['Redirect To']))
+
         # Expandable per query
         for q in high_queries[:30]:
             qdata = cannibs[cannibs['query'] == q].copy()
@@ -1105,9 +1353,6 @@ with tab3:
             qdata_display   = qdata.sort_values('_score', ascending=False)
             best_pos        = qdata['position'].min()
             total_impr      = int(qdata['impressions'].sum())
-            # The winning page is the one with most traffic authority
-            best_slug       = qdata_display.iloc[0]['slug']
-            weaker_slugs    = qdata_display.iloc[1:]['slug'].tolist()
 
             with st.expander(
                 f"🔴  **{q}**  —  {len(qdata)} pages · pos {best_pos} · {total_impr:,} impressions"
@@ -1119,30 +1364,37 @@ with tab3:
                 })[['Landing Page', 'Url Clicks', 'Impressions', 'URL CTR (%)', 'Average Position', 'Competing Pages']]
                 st.dataframe(disp, use_container_width=True, hide_index=True)
 
-                weaker_preview = ', '.join(f'`{s}`' for s in weaker_slugs[:2])
-                if len(weaker_slugs) > 2:
-                    weaker_preview += f' +{len(weaker_slugs)-2} more'
-                st.markdown(
-                    f"**Suggested action:** Consolidate {weaker_preview} **into** "
-                    f"`{best_slug}` (highest traffic authority) · use `rel=canonical` "
-                    f"or 301 redirect on the weaker pages · then strengthen internal "
-                    f"links to `{best_slug}`."
-                )
+                def listed(slugs: list) -> str:
+                    text = ', '.join(f'`{s}`' for s in slugs[:2])
+                    return text + (f' +{len(slugs)-2} more' if len(slugs) > 2 else '')
+
+                plan  = query_redirects(qdata_display['slug'].tolist(), redirect_to)
+                steps = [f"301 redirect {listed(slugs)} **into** `{target}`"
+                         + ('' if target in qdata['slug'].values else ' (the winner across all queries)')
+                         for target, slugs in plan['into']]
+                if plan['kept']:
+                    steps.append(f"keep {listed(plan['kept'])} — "
+                                 + ('they win' if len(plan['kept']) > 1 else 'it wins')
+                                 + " more on other queries, so differentiate title / intent instead")
+                if plan['winner']:
+                    steps.append(f"strengthen internal links to `{plan['winner']}`")
+                st.markdown("**Suggested action:** " + ' · '.join(steps) + '.')
 
         # ── Download buttons ──────────────────────────────────────────────
         dl_c1, dl_c2 = st.columns(2)
         with dl_c1:
-            st.download_button("📥 Download CSV",
-                data=to_csv(high_detail_display),
-                file_name="cannibalization_high_severity.csv", mime="text/csv")
+            export_button("📥 Download CSV", 'high severity csv',
+                lambda: to_csv(high_detail_display),
+                file_name="cannibalization_high_severity.csv", mime="text/csv",
+                rows=len(high_detail_display))
         with dl_c2:
             try:
-                docx_bytes = generate_high_severity_docx(cannibs, query_sum)
-                st.download_button(
-                    "📄 Download Word Report (.docx)",
-                    data=docx_bytes,
+                export_button(
+                    "📄 Download Word Report (.docx)", 'word report',
+                    lambda: generate_high_severity_docx(cannibs, query_sum, redirect_map(view)[0]),
                     file_name="high_severity_cannibalization_report.docx",
                     mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                    rows=len(high_queries),
                 )
             except Exception as e:
                 st.warning(f"Word export unavailable: {e}")
@@ -1188,22 +1440,73 @@ with tab4:
     st.markdown("---")
     st.markdown("#### Priority matrix for this dataset")
 
-    priority_df = query_sum[['Query', 'Competing Pages', 'Impressions',
-                              'Url Clicks', 'Best Average Position', '_sev']]\
-                      .rename(columns={'_sev': 'Severity'})\
-                      .sort_values('Impressions', ascending=False)\
-                      .head(50)
-
-    priority_df['Recommended Action'] = priority_df.apply(lambda r: (
-        'Consolidate / 301 redirect'     if r['Severity'] == 'High'   else
-        'Add canonicals / differentiate' if r['Severity'] == 'Medium' else
-        'Monitor / internal linking'
-    ), axis=1)
+    if 'priority' not in view:
+        with analysis['trace'].stage('priority matrix', rows_in=len(query_sum)) as rec:
+            # Fitted on every filtered row by analyze(); runs saved without it refit on cannibs
+            curve = analysis.get('ctr_curve') or fit_ctr_curve(cannibs)
+            opp   = click_opportunity(query_sum, cannibs, curve)
+            view['priority'] = (priority_matrix(query_sum, opp, k=50), curve,
+                                int(opp['Recoverable Clicks'].sum()))
+            rec['rows_out'] = len(view['priority'][0])
+    priority_df, ctr_curve, recoverable = view['priority']
+    st.caption(
+        f"Ranked by **recoverable clicks**: each query's demand consolidated onto one page at its best "
+        f"position, on a CTR curve fitted to this data ({' · '.join(f'#{p}: {c:.1%}' for p, c in zip((1, 3, 5, 10), expected_ctr([1, 3, 5, 10], ctr_curve)))}), "
+        f"minus the clicks all competing pages earn today. ≈ **{recoverable:,}** clicks recoverable across "
+        f"all {len(query_sum):,} queries{' (sample)' if analysis['estimated'] else ''}.")
 
     st.dataframe(priority_df, use_container_width=True, hide_index=True)
-    st.download_button("📥 Download Priority Matrix CSV",
-        data=to_csv(priority_df),
-        file_name="cannibalization_priority_matrix.csv", mime="text/csv")
+    export_button("📥 Download Priority Matrix CSV", 'priority csv', lambda: to_csv(priority_df),
+        file_name="cannibalization_priority_matrix.csv", mime="text/csv",
+        rows=len(priority_df))
+
+    st.markdown("---")
+    st.markdown("#### Site-wide redirect map")
+    redirects, redirect_stats = redirect_map(view)
+    if redirects.empty:
+        st.info("No page loses enough across its queries to warrant a redirect.")
+    else:
+        st.markdown(f"""
+        <div class="filter-note">
+        🔀 One target per page across <b>all</b> queries: {redirect_stats['redirects']:,} pages redirect into
+        {redirect_stats['targets']:,} winners. {redirect_stats['split']:,} pages would have been sent to more than one
+        winner query by query, {redirect_stats['chains_collapsed']:,} redirect chains were collapsed, and
+        {redirect_stats['kept']:,} pages that lose somewhere but win more on other queries are left in place.
+        </div>
+        """, unsafe_allow_html=True)
+        paged_dataframe(redirects, key='redirect_map', version=(analysis['version'], view['key']))
+        export_button("📥 Download Redirect Map CSV", 'redirect map csv', lambda: to_csv(redirects),
+            file_name="cannibalization_redirect_map.csv", mime="text/csv",
+            rows=len(redirects))
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# TAB 5: Period Compare (only when a previous period was uploaded)
+# ─────────────────────────────────────────────────────────────────────────────
+if analysis['compare'] is not None:
+    with tabs[4]:
+        period_compare()
+
+
+# ── Performance panel ─────────────────────────────────────────────────────────
+with perf_slot.container():
+    with st.expander("⏱ Performance"):
+        perf_traces = [loaded['trace'], prev_loaded['trace'], series['trace'],
+                       analysis['trace'], analysis['prev_trace'], view.get('page_meta_trace')]
+        perf = pd.concat([t.to_frame().assign(Trace=t.label) for t in perf_traces if t is not None],
+                         ignore_index=True)
+        st.dataframe(perf, use_container_width=True, hide_index=True)
+        outer = perf[perf['Depth'] == 0]  # nested stages are already inside their parent's time
+        st.caption(f"Total {outer['Wall (s)'].sum():.2f}s wall · "
+                   f"{outer['CPU (s)'].sum():.2f}s CPU · "
+                   f"trace records appended to `{PERF_LOG_PATH}` "
+                   f"(runs {', '.join(dict.fromkeys(f'`{t.run_id}`' for t in perf_traces if t is not None))})")
+        cache = dataset_cache().stats()
+        st.caption(f"Dataset cache: {cache['datasets']} export(s) · {cache['bytes'] / 2**20:,.0f} MB · "
+                   f"{cache['leases']} session hold(s) on {cache['held']} of them")
+
+
+watch_exports()
 
 
 # ── Footer ─────────────────────────────────────────────────────────────────────